@@ -1,10 +1,23 @@
 import argparse
+import asyncio
+import json
+import os
 import socket
 import socketserver
 import struct
+import binascii
+import zlib
+import time
+import re
 import logging
 import serial
-import select
+import threading
+import queue
+import collections
+import contextlib
+import random
+import signal
+import sys
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -19,9 +32,41 @@ server_host = '0.0.0.0'
 server_port = 58266
 client_count = 1
 socket_buffer_size = 4096
-recv_timeout_sec = 0.01
 debug_enable = False
 data_encode = False
+proto_version = 3
+compress_enable = True
+compress_dict = None
+uart_queue_bytes = 0x10000
+client_queue_bytes = 0x10000
+send_queue_bytes = 0x100000
+flow_window = 0x2000
+server_engine = 'thread'
+transport_mode = 'tcp'
+udp_loss = 0.0
+udp_reorder = 0.0
+metrics_port = 0
+metrics_dump = ''
+metrics_interval_sec = 10.0
+capture = None
+capture_path = ''
+server_workers = 0
+coalesce_ms = 0.0
+coalesce_bytes = 0x1000
+frame_max_bytes = 0x10000
+reassembly_max_bytes = 0x100000
+mux_max = 8
+session_linger_sec = 0.0
+session_spool_bytes = 0x100000
+chunk_mode = 'immediate'
+chunk_devices = {} # uart path -> chunk mode
+chunk_gap_chars = 1.5
+chunk_max_bytes = 0x1000
+chunk_max_ms = 10.0
+pace_rate = 0.0
+pace_burst_bytes = 256
+pace_every_bytes = 0
+pace_delay_ms = 0.0
 
 
 """
@@ -33,66 +78,233 @@ Data Bytes - bytearray - [Packet Length] bytes
  > Value Bytes - bytearray - dynamic bytes (0~vN) - until end (allow empty)
 XOR Checksum - 1 byte
 End Symbol - uint16 - 0x24 0x23 (Optional)
+
+Packet Structure v2 (negotiated by 'proto' packet, binary only, no encode)
+Start Symbol - uint8 - 0xA5
+Opcode - uint8 - key of OPCODES, 0 means payload is 'key=value' like v1 data bytes, bit 7 set if Channel follows
+Channel - uint8 - only if opcode bit 7 is set, channel 0 otherwise (negotiated by 'mux' packet)
+Data Length - varint - 1~5 bytes, LEB128
+Header Check - uint8 - low byte of CRC-16/CCITT-FALSE of opcode + channel + length
+Payload Bytes - bytearray - [Data Length] bytes
+CRC16 - uint16 big endian - CRC-16/CCITT-FALSE of opcode + channel + length + header check + payload
+a false start symbol in garbage fails the header check at once (1 in 256 pass),
+instead of holding the decoder until [Data Length] bytes arrive.
+
+Packet Structure v3 (negotiated by 'proto' packet, COBS framed, binary only, no encode)
+Delimiter - uint8 - 0x00
+Frame Bytes - COBS encoded opcode + payload + CRC16, never contains 0x00
+ > Opcode - uint8 - same as v2
+ > Channel - uint8 - same as v2
+ > Payload Bytes - bytearray - until CRC16 (length is the frame size)
+ > CRC16 - uint16 big endian - CRC-16/CCITT-FALSE of opcode + channel + payload
+Delimiter - uint8 - 0x00
+0x00 never appears inside a frame, so resync after corruption is one find() of
+the next delimiter, the leading one cuts off garbage received before a frame.
+COBS costs 1 byte every 254 bytes, plus 2 delimiters and 1 code byte per frame.
+
+a Packet keeps only key and value (any bytes-like, a memoryview is not copied),
+header, checksum and data bytes are computed when asked for, get_parts() gives
+header, value and trailer apart for scatter-gather writes, get_bytes() joins
+them with one copy.
 """
 class Packet:
+    __slots__ = ('key_str', 'val_bytes', 'channel')
     SYMBOL_START = 0x2423
     SYMBOL_END = 0x2324
     SYMBOL_START_BYTES = b'\x23\x24'
     SYMBOL_END_BYTES = b'\x24\x23'
     PACKET_MIN = (2+4+1+1) # start + length + min data + checksum
+    SYMBOL_V2 = 0xA5
+    SYMBOL_V2_BYTES = b'\xa5'
+    PACKET_V2_MIN = (1+1+1+1+2) # start + opcode + length + header check + crc16
+    DELIMITER_V3 = 0x00
+    DELIMITER_V3_BYTES = b'\x00'
+    PACKET_V3_MIN = (1+2) # opcode + crc16, decoded
+    CHANNEL_FLAG = 0x80
+    CHANNEL_MAX = 0xFF
+    OPCODES = {'data': 0x01, 'error': 0x02, 'path': 0x03, 'baud': 0x04, 'start': 0x05, 'stop': 0x06,
+               'proto': 0x07, 'compress': 0x08, 'flow': 0x09, 'credit': 0x0A, 'more': 0x0B,
+               'mux': 0x0C, 'session': 0x0D}
+    OPCODE_KEYS = {v: k for k, v in OPCODES.items()}
+    CHECKSUM_FOLD_MIN = 32 # smaller data is faster with bytewise loop
+    # encode table: byte -> encoded bytes, non-word bytes and backslash in one regex run
+    ENCODE_PATTERN = re.compile(rb'[^\x20-\x5b\x5d-\x7e]+')
+    ENCODE_TABLE = [b'\\\\' if i == 0x5c else bytes([i]) if 0x20 <= i < 0x7F else b'\\x%02x' % i for i in range(256)]
+    # decode map: every '\\' and '\xHH' (any case) -> decoded byte, a lone backslash is not in map
+    DECODE_PATTERN = re.compile(rb'\\(?:\\|[xX][0-9a-fA-F]{2})?')
+    DECODE_MAP = dict([(b'\\\\', b'\\')] + [(b'\\' + x + (hi + lo).encode(), bytes([i]))
+        for i in range(256) for x in (b'x', b'X')
+        for hi in {'%x' % (i >> 4), '%X' % (i >> 4)} for lo in {'%x' % (i & 0xF), '%X' % (i & 0xF)}])
 
-    def __init__(self, key_str:str, val_bytes:bytearray=bytearray()):
-       self.key_str = ''
-       self.val_bytes = bytearray()
-       self.data_bytes = bytearray()
-       self.data_size = 0
-       self.checksum = 0
-       self.set_key_value(key_str, val_bytes)
+    def __init__(self, key_str:str, val_bytes:bytearray=b'', channel:int=0):
+        self.key_str = key_str
+        self.val_bytes = val_bytes
+        self.channel = channel
     
     def __str__(self):
         if self.val_bytes == None or len(self.val_bytes) == 0:
-            return "key=%s,val=None" % (self.key_str)
+            return "ch=%d,key=%s,val=None" % (self.channel, self.key_str)
         else:
-            return "key=%s,val=0x%s" % (self.key_str, self.val_bytes.hex())
+            return "ch=%d,key=%s,val=0x%s" % (self.channel, self.key_str, self.val_bytes.hex())
+
+    def opcode_bytes(self):
+        # opcode and channel byte if not channel 0
+        opcode = Packet.OPCODES.get(self.key_str, 0)
+        if self.channel > 0:
+            return bytes((opcode | Packet.CHANNEL_FLAG, self.channel))
+        return bytes((opcode,))
 
     def set_key_value(self, key_str:str, val_bytes:bytearray):
         self.key_str = key_str
         self.val_bytes = val_bytes
-        if len(val_bytes) > 0:
-            self.data_bytes = key_str.encode() + b'=' + val_bytes
-            self.data_size = len(self.data_bytes)
-        else:
-            self.data_bytes = key_str.encode()
-            self.data_size = len(self.data_bytes)
-        self.checksum = Packet.calc_checksum(self.data_bytes)
+
+    def key_bytes(self):
+        # data bytes before value, 'key=' or 'key' when value is empty
+        if len(self.val_bytes) > 0:
+            return self.key_str.encode() + b'='
+        return self.key_str.encode()
+
+    @property
+    def data_bytes(self):
+        return self.key_bytes() + bytes(self.val_bytes)
+
+    @property
+    def data_size(self):
+        return len(self.key_bytes()) + len(self.val_bytes)
+
+    @property
+    def checksum(self):
+        # xor of key bytes and value bytes apart, no need to join them
+        return Packet.calc_checksum(self.key_bytes()) ^ Packet.calc_checksum(self.val_bytes)
     
     def do_encode(self):
         if self.val_bytes == None or len(self.val_bytes) == 0:
             return
+        if not logger.isEnabledFor(logging.DEBUG):
+            self.val_bytes = Packet.bytes_encode(self.val_bytes)
+            return
         logger.debug("=== do_encode ===")
         logger.debug("0x" + self.val_bytes.hex())
-        self.set_key_value(self.key_str, Packet.bytes_encode(self.val_bytes))
+        self.val_bytes = Packet.bytes_encode(self.val_bytes)
         logger.debug("0x" + self.val_bytes.hex())
         logger.debug("=================")
     
     def do_decode(self):
         if self.val_bytes == None or len(self.val_bytes) == 0:
             return
+        if not logger.isEnabledFor(logging.DEBUG):
+            self.val_bytes = Packet.bytes_decode(self.val_bytes)
+            return
         logger.debug("=== do_decode ===")
         logger.debug("0x" + self.val_bytes.hex())
-        self.set_key_value(self.key_str, Packet.bytes_decode(self.val_bytes))
+        self.val_bytes = Packet.bytes_decode(self.val_bytes)
         logger.debug("0x" + self.val_bytes.hex())
         logger.debug("=================")
 
-    def get_bytes(self):
-        raw_bytes = struct.pack('<1H1I', self.SYMBOL_START, self.data_size)
-        raw_bytes += self.data_bytes
-        raw_bytes += self.checksum.to_bytes(1, 'little')
-        raw_bytes += Packet.SYMBOL_END_BYTES
-        return raw_bytes
+    def get_bytes(self, version:int=1):
+        return b''.join(self.get_parts(version))
+
+    def get_bytes_v2(self):
+        return b''.join(self.get_parts(2))
+
+    def get_parts(self, version:int=1):
+        # (header, value, trailer), value is val_bytes itself, key bytes if any are in header
+        val_bytes = self.val_bytes
+        if version >= 3:
+            head = self.opcode_bytes()
+            if self.key_str not in Packet.OPCODES:
+                head += self.key_bytes()
+            crc = binascii.crc_hqx(val_bytes, binascii.crc_hqx(head, 0xFFFF))
+            return Packet.DELIMITER_V3_BYTES, Packet.cobs_encode(b''.join((head, val_bytes, crc.to_bytes(2, 'big')))), Packet.DELIMITER_V3_BYTES
+        if version >= 2:
+            if self.key_str in Packet.OPCODES:
+                header = Packet.header_v2(self.opcode_bytes(), len(val_bytes))
+            else:
+                key_bytes = self.key_bytes()
+                header = Packet.header_v2(self.opcode_bytes(), len(key_bytes) + len(val_bytes)) + key_bytes
+            crc = binascii.crc_hqx(val_bytes, binascii.crc_hqx(memoryview(header)[1:], 0xFFFF))
+            return header, val_bytes, crc.to_bytes(2, 'big')
+        key_bytes = self.key_bytes()
+        header = struct.pack('<1H1I', Packet.SYMBOL_START, len(key_bytes) + len(val_bytes)) + key_bytes
+        checksum = Packet.calc_checksum(key_bytes) ^ Packet.calc_checksum(val_bytes)
+        return header, val_bytes, bytes((checksum,)) + Packet.SYMBOL_END_BYTES
+
+    @staticmethod
+    def varint_encode(value:int):
+        raw_bytes = bytearray()
+        while value >= 0x80:
+            raw_bytes.append((value & 0x7F) | 0x80)
+            value >>= 7
+        raw_bytes.append(value)
+        return bytes(raw_bytes)
+
+    @staticmethod
+    def header_v2(head:bytes, size:int):
+        # start symbol, opcode (and channel), length and check byte of them
+        head += Packet.varint_encode(size)
+        return Packet.SYMBOL_V2_BYTES + head + bytes((binascii.crc_hqx(head, 0xFFFF) & 0xFF,))
+
+    @staticmethod
+    def varint_decode(raw_bytes:bytearray, idx:int, end:int):
+        # return (value, next idx), value is None if bytes not enough
+        value = 0
+        for shift in range(0, 35, 7):
+            if idx >= end:
+                return None, idx
+            b = raw_bytes[idx]
+            idx += 1
+            value |= (b & 0x7F) << shift
+            if b < 0x80:
+                return value, idx
+        raise ValueError('varint too long')
     
+    @staticmethod
+    def cobs_encode(raw_bytes:bytes):
+        # every run without 0x00 becomes (run size + 1, run), runs longer than 254 are cut with code 0xFF
+        new_raw = bytearray()
+        for block in raw_bytes.split(b'\x00'):
+            idx = 0
+            while len(block) - idx >= 0xFE:
+                new_raw.append(0xFF)
+                new_raw += block[idx:idx+0xFE]
+                idx += 0xFE
+            new_raw.append(len(block) - idx + 1)
+            new_raw += block[idx:]
+        return new_raw
+
+    @staticmethod
+    def cobs_decode(raw_bytes:bytearray, idx:int=0, end:int=None):
+        # decode raw_bytes[idx:end], a run shorter than 254 is followed by 0x00 unless it is the last
+        if end is None:
+            end = len(raw_bytes)
+        view = memoryview(raw_bytes)
+        new_raw = bytearray()
+        while idx < end:
+            code = raw_bytes[idx]
+            next_idx = idx + code
+            if code == 0 or next_idx > end:
+                raise ValueError('cobs code err')
+            new_raw += view[idx+1:next_idx]
+            idx = next_idx
+            if code < 0xFF and idx < end:
+                new_raw.append(0)
+        return new_raw
+
     @staticmethod
     def calc_checksum(raw: bytearray):
+        size = len(raw)
+        if size < Packet.CHECKSUM_FOLD_MIN:
+            return Packet.calc_checksum_bytewise(raw)
+        # xor fold the whole data as one big int, half size each round, until 1 byte left
+        value = int.from_bytes(raw, 'little')
+        while size > 1:
+            half = (size + 1) >> 1
+            value = (value >> (half * 8)) ^ (value & ((1 << (half * 8)) - 1))
+            size = half
+        return value
+
+    @staticmethod
+    def calc_checksum_bytewise(raw: bytearray):
         checksum = 0
         for b in raw:
             checksum = checksum ^ b & 0xFF
@@ -111,6 +323,11 @@ class Packet:
     
     @staticmethod
     def bytes_encode(raw_bytes:bytearray):
+        return bytearray(Packet.ENCODE_PATTERN.sub(
+            lambda m: b''.join(map(Packet.ENCODE_TABLE.__getitem__, m.group())), raw_bytes))
+
+    @staticmethod
+    def bytes_encode_bytewise(raw_bytes:bytearray):
         new_raw = bytearray()
         for r in raw_bytes:
             # r is not word
@@ -126,6 +343,14 @@ class Packet:
 
     @staticmethod
     def bytes_decode(raw_bytes:bytearray):
+        try:
+            return bytearray(Packet.DECODE_PATTERN.sub(lambda m: Packet.DECODE_MAP[m.group()], raw_bytes))
+        except KeyError:
+            # malformed escape, let the state machine handle (and warn) it
+            return Packet.bytes_decode_bytewise(raw_bytes)
+
+    @staticmethod
+    def bytes_decode_bytewise(raw_bytes:bytearray):
         new_raw = bytearray()
         # states
         # 0: normal
@@ -186,72 +411,1860 @@ class Packet:
     @staticmethod
     def parse(raw_bytes:bytearray):
         try:
-            while raw_bytes is not None and len(raw_bytes) >= Packet.PACKET_MIN:
-                start_idx = raw_bytes.find(Packet.SYMBOL_START_BYTES)
-                if start_idx == 0:
-                    logger.debug("raw=0x" + raw_bytes.hex())
-                    _, data_size = struct.unpack('<1H1I', raw_bytes[:6])
-                    if len(raw_bytes) < 6+1+data_size:
-                        logger.debug('packet size not enough.')
-                        return None
-                    data_bytes = raw_bytes[6:6+data_size]
-                    checksum = raw_bytes[6+data_size]
-                    checktmp = Packet.calc_checksum(data_bytes)
-                    if checktmp == checksum:
-                        logger.debug("Packet Found!")
-                        split_idx = data_bytes.find(b'=')
-                        if split_idx > 0:
-                            key_str = data_bytes[:split_idx].decode()
-                            val_bytes = data_bytes[split_idx+1:]
-                        else:
-                            key_str = data_bytes.decode()
-                            val_bytes = bytearray()
-                        new_packet = Packet(key_str, val_bytes)
-                        logger.debug(str(new_packet))
-                        return new_packet
-                    raw_bytes = raw_bytes[2:]
-                elif start_idx > 0:
-                    raw_bytes = raw_bytes[start_idx:]
-                else:
-                    return None
+            return next(PacketStreamDecoder(len(raw_bytes), frame_max=max(len(raw_bytes), PacketStreamDecoder.FRAME_MAX))
+                        .feed(raw_bytes), None)
         except Exception as ex2:
             logger.error("[!] Packet parse err: %s" % str(ex2))
         return None
 
 
+"""
+Packet Stream Decoder
+keep a read cursor (head) and write cursor (tail) over a preallocated buffer,
+feed() only copies new bytes in, and yields every complete packet found.
+consumed bytes are dropped by moving the cursor, the buffer is compacted only
+when the free space at the end is not enough for the incoming bytes.
+checksum_errors and skipped_bytes (garbage and resync) are kept across reset().
+a length over frame_max is taken as corruption and resynced at once (counted
+in oversize_frames), so the buffer never holds more than one max frame and one
+received chunk, whatever the length field says.
+payloads over frame_max are sent in pieces: plain data as more data packets
+(data is a stream), anything else as 'more' packets, which are joined into the
+next other packet here, up to reassembly_max bytes, or the payload is dropped.
+pieces are cut by the smaller frame_max of both ends, each end advertises its
+own by 'frame' packet (no opcode, 'frame=N' in v2, so old peers reply unknown
+keyword), FRAME_MAX of a peer is assumed until then. a client limited to v1
+(-P 1) sends it only with a --frame_max of its own.
+peak_bytes and reassembly_peak keep the max bytes ever buffered.
+"""
+class PacketStreamDecoder:
+    HEADER_SIZE = (2+4) # start + length
+    FRAME_MAX = 0x10000
+    FRAME_MIN = 0x100 # smallest frame_max accepted, a piece keeps data after key room and encode
+    REASSEMBLY_MAX = 0x100000
+    FRAGMENT_ROOM = 0x40 # room for key in a piece, sent pieces are frame_max - room bytes
+
+    def __init__(self, buf_size:int=0x10000, version:int=1, frame_max:int=FRAME_MAX, reassembly_max:int=REASSEMBLY_MAX):
+        self.buffer = bytearray(max(buf_size, Packet.PACKET_MIN))
+        self.head = 0
+        self.tail = 0
+        self.version = version
+        self.frame_max = frame_max
+        self.reassembly_max = reassembly_max
+        self.fragments = bytearray()
+        self.fragments_dropped = False
+        self.checksum_errors = 0
+        self.skipped_bytes = 0
+        self.oversize_frames = 0
+        self.peak_bytes = 0
+        self.reassembly_peak = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def reset(self):
+        self.head = 0
+        self.tail = 0
+
+    def clear(self):
+        # new connection, pieces of a payload from the last one are dropped too
+        self.reset()
+        self.fragments = bytearray()
+        self.fragments_dropped = False
+
+    def compact(self):
+        if self.head == 0:
+            return
+        size = self.tail - self.head
+        if size > 0:
+            self.buffer[:size] = memoryview(self.buffer)[self.head:self.tail]
+        self.head = 0
+        self.tail = size
+
+    def append(self, raw_bytes):
+        size = len(raw_bytes)
+        if self.tail + size > len(self.buffer):
+            self.compact()
+            if self.tail + size > len(self.buffer):
+                # buffer still not enough, grow to double size at least
+                self.buffer.extend(bytes(max(self.tail + size - len(self.buffer), len(self.buffer))))
+        memoryview(self.buffer)[self.tail:self.tail+size] = raw_bytes
+        self.tail += size
+        if self.tail - self.head > self.peak_bytes:
+            self.peak_bytes = self.tail - self.head
+
+    def feed(self, raw_bytes):
+        if raw_bytes is not None and len(raw_bytes) > 0:
+            self.append(raw_bytes)
+        return self.frames()
+
+    def frames(self):
+        # version is checked for every packet, it may be switched by a handled packet
+        while True:
+            if self.version >= 3:
+                new_packet = self.next_packet_v3()
+            elif self.version >= 2:
+                new_packet = self.next_packet_v2()
+            else:
+                new_packet = self.next_packet_v1()
+            if new_packet is None:
+                return
+            if new_packet.key_str == 'more' or len(self.fragments) > 0 or self.fragments_dropped:
+                new_packet = self.reassemble(new_packet)
+                if new_packet is None:
+                    continue
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Packet Found! " + str(new_packet))
+            yield new_packet
+
+    def reassemble(self, new_packet:Packet):
+        # keep 'more' payloads, return the packet they belong to with them joined
+        if not self.fragments_dropped and len(self.fragments) + len(new_packet.val_bytes) > self.reassembly_max:
+            logger.error("[!] Packet reassembly over %d bytes, dropped." % self.reassembly_max)
+            self.oversize_frames += 1
+            self.skipped_bytes += len(self.fragments)
+            self.fragments = bytearray()
+            self.fragments_dropped = True
+        if self.fragments_dropped:
+            self.skipped_bytes += len(new_packet.val_bytes)
+            if new_packet.key_str != 'more':
+                self.fragments_dropped = False
+            return None
+        self.fragments += new_packet.val_bytes
+        if len(self.fragments) > self.reassembly_peak:
+            self.reassembly_peak = len(self.fragments)
+        if new_packet.key_str == 'more':
+            return None
+        new_packet.val_bytes = self.fragments
+        self.fragments = bytearray()
+        return new_packet
+
+    def oversize(self, size:int):
+        logger.debug('packet length over %d, resync.' % self.frame_max)
+        self.oversize_frames += 1
+        self.skipped_bytes += size
+        self.head += size
+
+    def new_packet(self, data_idx:int, data_end:int, key_str:str=None, buf:bytearray=None, channel:int=0):
+        if buf is None:
+            buf = self.buffer
+        try:
+            if key_str is not None:
+                return Packet(key_str, buf[data_idx:data_end], channel)
+            split_idx = buf.find(b'=', data_idx, data_end)
+            if split_idx > data_idx:
+                return Packet(buf[data_idx:split_idx].decode(), buf[split_idx+1:data_end], channel)
+            return Packet(buf[data_idx:data_end].decode(), b'', channel)
+        except Exception as ex1:
+            logger.error("[!] Packet parse err: %s" % str(ex1))
+        return None
+
+    def next_packet_v1(self):
+        buf = self.buffer
+        while self.tail - self.head >= Packet.PACKET_MIN:
+            start_idx = buf.find(Packet.SYMBOL_START_BYTES, self.head, self.tail)
+            if start_idx < 0:
+                # keep last byte if it possibly be the first byte of start symbol
+                if buf[self.tail-1] == Packet.SYMBOL_START_BYTES[0]:
+                    self.skipped_bytes += self.tail - 1 - self.head
+                    self.head = self.tail - 1
+                else:
+                    self.skipped_bytes += self.tail - self.head
+                    self.reset()
+                return None
+            self.skipped_bytes += start_idx - self.head
+            self.head = start_idx
+            if self.tail - self.head < Packet.PACKET_MIN:
+                return None
+            _, data_size = struct.unpack_from('<1H1I', buf, self.head)
+            if data_size > self.frame_max:
+                self.oversize(2)
+                continue
+            data_idx = self.head + PacketStreamDecoder.HEADER_SIZE
+            if self.tail - data_idx < data_size + 1:
+                # packet size not enough, wait for more bytes
+                return None
+            data_end = data_idx + data_size
+            checksum = buf[data_end]
+            if Packet.calc_checksum(memoryview(buf)[data_idx:data_end]) != checksum:
+                logger.debug('packet checksum err, resync.')
+                self.checksum_errors += 1
+                self.skipped_bytes += 2
+                self.head += 2
+                continue
+            self.head = data_end + 1
+            if buf.startswith(Packet.SYMBOL_END_BYTES, self.head, self.tail):
+                self.head += 2
+            if self.head == self.tail:
+                self.reset()
+            new_packet = self.new_packet(data_idx, data_end)
+            if new_packet is not None:
+                return new_packet
+        return None
+
+    def next_packet_v2(self):
+        buf = self.buffer
+        while self.tail - self.head >= Packet.PACKET_V2_MIN:
+            start_idx = buf.find(Packet.SYMBOL_V2_BYTES, self.head, self.tail)
+            if start_idx < 0:
+                self.skipped_bytes += self.tail - self.head
+                self.reset()
+                return None
+            self.skipped_bytes += start_idx - self.head
+            self.head = start_idx
+            if self.tail - self.head < Packet.PACKET_V2_MIN:
+                # start symbol found near the tail, wait for the header
+                return None
+            opcode = buf[self.head+1]
+            channel = 0
+            length_idx = self.head + 2
+            if opcode & Packet.CHANNEL_FLAG:
+                if self.tail - self.head < Packet.PACKET_V2_MIN + 1:
+                    return None
+                channel = buf[length_idx]
+                length_idx += 1
+            try:
+                data_size, data_idx = Packet.varint_decode(buf, length_idx, self.tail)
+            except ValueError:
+                logger.debug('packet length err, resync.')
+                self.skipped_bytes += 1
+                self.head += 1
+                continue
+            if data_size is None or data_idx >= self.tail:
+                # header not complete, wait for more bytes
+                return None
+            if buf[data_idx] != binascii.crc_hqx(memoryview(buf)[self.head+1:data_idx], 0xFFFF) & 0xFF:
+                logger.debug('packet header check err, resync.')
+                self.checksum_errors += 1
+                self.skipped_bytes += 1
+                self.head += 1
+                continue
+            data_idx += 1
+            if data_size > self.frame_max:
+                self.oversize(1)
+                continue
+            if self.tail - data_idx < data_size + 2:
+                # packet size not enough, wait for more bytes
+                return None
+            data_end = data_idx + data_size
+            crc = binascii.crc_hqx(memoryview(buf)[self.head+1:data_end], 0xFFFF)
+            if crc != (buf[data_end] << 8 | buf[data_end+1]):
+                logger.debug('packet crc err, resync.')
+                self.checksum_errors += 1
+                self.skipped_bytes += 1
+                self.head += 1
+                continue
+            self.head = data_end + 2
+            if self.head == self.tail:
+                self.reset()
+            opcode &= ~Packet.CHANNEL_FLAG
+            if opcode > 0 and opcode not in Packet.OPCODE_KEYS:
+                logger.error("[!] Packet parse err: unknown opcode %d" % opcode)
+                continue
+            new_packet = self.new_packet(data_idx, data_end, Packet.OPCODE_KEYS.get(opcode), channel=channel)
+            if new_packet is not None:
+                return new_packet
+        return None
+
+    def next_packet_v3(self):
+        buf = self.buffer
+        while self.head < self.tail:
+            end_idx = buf.find(Packet.DELIMITER_V3_BYTES, self.head, self.tail)
+            if end_idx < 0:
+                if self.tail - self.head > self.frame_max + self.frame_max // 254 + 8:
+                    # no delimiter in a max frame, the rest of it fails crc at the next one
+                    self.oversize(self.tail - self.head)
+                    self.reset()
+                    return None
+                # frame not complete, wait for more bytes
+                return None
+            frame_idx = self.head
+            try:
+                frame = Packet.cobs_decode(buf, frame_idx, end_idx)
+            except ValueError:
+                frame = b''
+            self.head = end_idx + 1
+            if self.head == self.tail:
+                self.reset()
+            if end_idx == frame_idx:
+                # empty frame, delimiters back to back
+                continue
+            if len(frame) < Packet.PACKET_V3_MIN or \
+                binascii.crc_hqx(memoryview(frame)[:-2], 0xFFFF) != (frame[-2] << 8 | frame[-1]):
+                logger.debug('packet crc err, resync.')
+                self.checksum_errors += 1
+                self.skipped_bytes += end_idx + 1 - frame_idx
+                continue
+            opcode = frame[0]
+            channel = 0
+            data_idx = 1
+            if opcode & Packet.CHANNEL_FLAG:
+                channel = frame[1]
+                data_idx = 2
+                opcode &= ~Packet.CHANNEL_FLAG
+            if opcode > 0 and opcode not in Packet.OPCODE_KEYS:
+                logger.error("[!] Packet parse err: unknown opcode %d" % opcode)
+                continue
+            new_packet = self.new_packet(data_idx, len(frame) - 2, Packet.OPCODE_KEYS.get(opcode), frame, channel)
+            if new_packet is not None:
+                return new_packet
+        return None
+
+
+"""
+Stream Compressor
+one zlib (raw deflate) context per direction for the whole connection, every
+data packet is a sync-flushed block so it decodes immediately on arrival, the
+sync flush tail 00 00 ff ff is dropped on the wire and put back before decode.
+a block that deflates to more than its raw size (binary or already compressed
+data) goes raw behind RAW_MARK instead, a first byte no deflate block starts
+with (BTYPE 11), so it costs one byte over raw at most. the sender history has
+the bytes already, the receiver feeds them to its context as a stored block,
+both windows stay the same.
+method string in 'compress' packet:
+- none: no compression
+- zlib: zlib without dictionary
+- zlib:<crc32 of dictionary>: zlib with preset dictionary, both sides must have the same one
+"""
+class StreamCompressor:
+    SYNC_TAIL = b'\x00\x00\xff\xff'
+    RAW_MARK = 0xff
+    STORED_MAX = 0xffff
+    # typical firmware log vocabulary, most frequent strings at the end
+    DEFAULT_DICT = (b'assert abort panic reboot reset boot version build heap free alloc task stack '
+                    b'timeout retry fail failed success ok done start stop init ready '
+                    b'uart spi i2c gpio adc pwm dma irq flash nvs ota partition '
+                    b'wifi sta ap ssid rssi dhcp ip mac connected disconnected '
+                    b'0x00000000 0x0000 0x00 0xff 0x ms us sec bytes len size '
+                    b'[DEBUG] [INFO] [WARN] [ERROR] DEBUG INFO WARN ERROR '
+                    b'D (0) I (0) W (0) E (0) error: warning: info: debug: \r\n')
+
+    def __init__(self, method:str, zdict:bytes=None, level:int=6):
+        self.method = method
+        self.zdict = zdict if method.startswith('zlib:') else None
+        if self.zdict is not None:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=self.zdict)
+            self.decompressor = zlib.decompressobj(-15, zdict=self.zdict)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            self.decompressor = zlib.decompressobj(-15)
+        self.tx_raw = 0
+        self.tx_zip = 0
+        self.tx_raw_blocks = 0
+        self.rx_raw = 0
+        self.rx_zip = 0
+        self.cpu_sec = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def dict_method(zdict:bytes):
+        return 'zlib:%08x' % zlib.crc32(zdict)
+
+    def compress(self, raw_bytes:bytes):
+        with self.lock:
+            start = time.thread_time()
+            zip_bytes = self.compressor.compress(raw_bytes) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            if zip_bytes.endswith(StreamCompressor.SYNC_TAIL):
+                zip_bytes = zip_bytes[:-4]
+            if len(zip_bytes) > len(raw_bytes):
+                zip_bytes = bytes((StreamCompressor.RAW_MARK,)) + raw_bytes
+                self.tx_raw_blocks += 1
+            self.cpu_sec += time.thread_time() - start
+            self.tx_raw += len(raw_bytes)
+            self.tx_zip += len(zip_bytes)
+        return zip_bytes
+
+    def decompress(self, zip_bytes:bytes):
+        with self.lock:
+            start = time.thread_time()
+            if len(zip_bytes) > 0 and zip_bytes[0] == StreamCompressor.RAW_MARK:
+                raw_bytes = bytes(zip_bytes[1:])
+                for idx in range(0, len(raw_bytes), StreamCompressor.STORED_MAX):
+                    block = raw_bytes[idx:idx+StreamCompressor.STORED_MAX]
+                    self.decompressor.decompress(b'\x00' + struct.pack('<HH', len(block), len(block) ^ 0xffff) + block)
+            else:
+                raw_bytes = self.decompressor.decompress(bytes(zip_bytes) + StreamCompressor.SYNC_TAIL)
+            self.cpu_sec += time.thread_time() - start
+            self.rx_raw += len(raw_bytes)
+            self.rx_zip += len(zip_bytes)
+        return raw_bytes
+
+    def summary(self):
+        return '%s tx %d->%d (%.1f%%, %d raw), rx %d->%d (%.1f%%), cpu %.3fs' % (self.method,
+            self.tx_raw, self.tx_zip, 100.0 * self.tx_zip / max(self.tx_raw, 1), self.tx_raw_blocks,
+            self.rx_zip, self.rx_raw, 100.0 * self.rx_zip / max(self.rx_raw, 1), self.cpu_sec)
+
+
+"""
+Byte Queue
+bounded by total bytes instead of item count, put() waits while the queue is
+full, high_water keeps the max bytes ever queued to show where data piles up.
+an item larger than the limit is still accepted when the queue is empty.
+get_batch() takes every queued item up to a byte limit at once, with the put
+time of the first one, for writers that join small items into one write.
+"""
+class ByteQueue:
+    def __init__(self, name:str, limit:int):
+        self.name = name
+        self.limit = limit
+        self.items = collections.deque()
+        self.size = 0
+        self.high_water = 0
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.size
+
+    def put(self, item, size:int, block:bool=True):
+        with self.cond:
+            while block and self.size > 0 and self.size + size > self.limit:
+                self.cond.wait()
+            self.items.append((item, size, time.perf_counter()))
+            self.size += size
+            if self.size > self.high_water:
+                self.high_water = self.size
+            self.cond.notify_all()
+
+    def get(self, block:bool=True):
+        with self.cond:
+            while len(self.items) == 0:
+                if not block:
+                    raise queue.Empty
+                self.cond.wait()
+            item, size, _ = self.items.popleft()
+            self.size -= size
+            self.cond.notify_all()
+            return item
+
+    def get_batch(self, limit:int, block:bool=True):
+        # (items, put time of the first item), at least one item, stops after a None item
+        with self.cond:
+            while len(self.items) == 0:
+                if not block:
+                    raise queue.Empty
+                self.cond.wait()
+            put_time = self.items[0][2]
+            items = []
+            size = 0
+            while len(self.items) > 0 and (len(items) == 0 or size + self.items[0][1] <= limit):
+                item, item_size, _ = self.items.popleft()
+                items.append(item)
+                size += item_size
+                if item is None:
+                    break
+            self.size -= size
+            self.cond.notify_all()
+            return items, put_time
+
+    def clear(self):
+        with self.cond:
+            self.items.clear()
+            self.size = 0
+            self.cond.notify_all()
+
+    def summary(self):
+        return '%s hwm %d/%d' % (self.name, self.high_water, self.limit)
+
+
+"""
+UART Chunker
+cuts uart rx into the chunks forwarded as data packets, by mode:
+- immediate: every uart read is a chunk, boundaries are wherever reads return
+- idle: a chunk ends when the line is idle for [gap_chars] character times
+  (10 bits per character at the baud), one message of a binary protocol, at
+  least IDLE_MIN_SEC as uart fifos and drivers hand bytes over in bursts
+- line: a chunk ends after a newline, log lines are not split
+any mode but immediate ends a chunk at [max_size] bytes or when its first byte
+is [max_age_sec] old. a thread reader polls with one fixed uart read timeout
+while bytes are pending and flushes once timeout() is due, every timeout change
+is a tcsetattr on the port. an event loop reader schedules flush() after
+timeout().
+uart_chunk_bytes is the chunk size, uart_chunk_seconds the time its first byte
+waited in the chunker.
+"""
+class UartChunker:
+    MODES = ('immediate', 'idle', 'line')
+    CHAR_BITS = 10
+    IDLE_MIN_SEC = 0.002
+
+    def __init__(self, mode:str, baud:int, gap_chars:float=1.5, max_size:int=0x1000, max_age_sec:float=0.01, metrics=None):
+        self.mode = mode
+        self.gap_sec = max(gap_chars * UartChunker.CHAR_BITS / baud, UartChunker.IDLE_MIN_SEC)
+        self.max_size = max_size
+        self.max_age = max_age_sec
+        # read timeout while bytes are pending, a due chunk is late by one poll at most
+        self.poll_sec = self.gap_sec if mode == 'idle' else max(max_age_sec / 4, UartChunker.IDLE_MIN_SEC)
+        self.metrics = metrics
+        self.pending = bytearray()
+        self.first_time = 0.0
+        self.last_time = 0.0
+        self.read_timeout = None
+
+    def timeout(self, now:float):
+        # seconds until pending bytes are due, None if nothing pending
+        if len(self.pending) == 0:
+            return None
+        deadline = self.first_time + self.max_age
+        if self.mode == 'idle':
+            deadline = min(deadline, self.last_time + self.gap_sec)
+        return max(deadline - now, 0.0)
+
+    def feed(self, rx_bytes:bytes, now:float):
+        # complete chunks, the rest waits for more bytes or its deadline
+        if self.mode == 'immediate':
+            self.observe(len(rx_bytes), 0.0)
+            return [rx_bytes]
+        if len(self.pending) == 0:
+            self.first_time = now
+        self.pending += rx_bytes
+        self.last_time = now
+        end = len(self.pending) - len(self.pending) % self.max_size
+        if self.mode == 'line':
+            end = max(end, self.pending.rfind(b'\n') + 1)
+        return self.cut(end, now)
+
+    def flush(self, now:float):
+        return self.cut(len(self.pending), now)
+
+    def cut(self, end:int, now:float):
+        chunks = []
+        for idx in range(0, end, self.max_size):
+            chunks.append(bytes(self.pending[idx:min(idx + self.max_size, end)]))
+            self.observe(len(chunks[-1]), now - self.first_time)
+        del self.pending[:end]
+        if end > 0:
+            # the rest came with the last read
+            self.first_time = self.last_time
+        return chunks
+
+    def observe(self, size:int, sec:float):
+        if self.metrics is not None:
+            self.metrics.observe_size('uart_chunk_bytes', size)
+            self.metrics.observe('uart_chunk_seconds', sec)
+
+    def read(self, uart_dev):
+        # blocking read of a thread reader, chunks due by now, maybe none
+        wait = self.poll_sec if len(self.pending) > 0 else None
+        if wait != self.read_timeout:
+            uart_dev.timeout = wait
+            self.read_timeout = wait
+        rx_bytes = uart_dev.read(max(uart_dev.in_waiting, 1))
+        now = time.perf_counter()
+        chunks = []
+        if rx_bytes is not None and len(rx_bytes) > 0:
+            chunks = self.feed(rx_bytes, now)
+        if self.timeout(now) == 0:
+            chunks += self.flush(now)
+        return chunks
+
+
+"""
+UART Pacer
+token bucket in front of uart writes, for targets with a small rx buffer that
+drop bytes when a paste or a file comes at full speed. tokens come at [rate]
+of the line rate (baud / 10 bytes per second), the bucket holds [burst] bytes,
+the size of the target rx buffer, a write goes in pieces of up to burst bytes
+and each waits for its tokens. optional [delay_sec] pause after every [every]
+bytes, for targets that process their buffer in blocks.
+uart_pace_seconds is the wait before each piece.
+"""
+class UartPacer:
+    def __init__(self, baud:int, rate:float=1.0, burst:int=256, every:int=0, delay_sec:float=0.0, metrics=None):
+        self.rate = baud / UartChunker.CHAR_BITS * rate if rate > 0 else 0.0
+        self.burst = burst if every <= 0 else min(burst, every)
+        self.every = every
+        self.delay_sec = delay_sec
+        self.metrics = metrics
+        self.tokens = float(self.burst)
+        self.last_time = time.perf_counter()
+        self.count = 0
+
+    def wait(self, size:int):
+        # sleep until size bytes may go, seconds slept
+        now = time.perf_counter()
+        delay = 0.0
+        if self.rate > 0:
+            self.tokens = min(self.tokens + (now - self.last_time) * self.rate, self.burst)
+            if self.tokens < size:
+                delay = (size - self.tokens) / self.rate
+        if self.every > 0 and self.count + size > self.every:
+            delay += self.delay_sec
+            self.count = 0
+        if delay > 0:
+            time.sleep(delay)
+            now = time.perf_counter()
+            if self.rate > 0:
+                self.tokens = min(self.tokens + delay * self.rate, self.burst)
+        self.tokens -= size
+        self.last_time = now
+        self.count += size
+        if self.metrics is not None:
+            self.metrics.observe('uart_pace_seconds', delay)
+        return delay
+
+    def write(self, uart_dev, val_bytes:bytes):
+        # seconds waited in total
+        view = memoryview(val_bytes)
+        delay = 0.0
+        for idx in range(0, len(view), self.burst):
+            piece = view[idx:idx+self.burst]
+            delay += self.wait(len(piece))
+            uart_dev.write(piece)
+        return delay
+
+
+"""
+Session Capture
+raw bytes of both directions, socket and uart, appended to a binary file by a
+background writer, bridge threads only queue the bytes with a timestamp.
+File Structure
+Magic - 8 bytes - 'WUCAP' 0x01 '\r\n'
+Records - v2 packet header with the kind as opcode, crc32 trailer
+  Start Symbol - uint8 - 0xA5
+  Kind - uint8 - KIND_SOCKET_RX(1), KIND_SOCKET_TX(2), KIND_UART_RX(3), KIND_UART_TX(4)
+  Record Length - varint - 8 + 2 + raw bytes length
+  Record - float64 unix time + uint16 session + raw bytes
+  CRC32 - uint32 big endian - zlib crc32 of kind + length + record, crc16 is
+          too slow for every byte of a busy session
+records are dropped (and counted) instead of blocking when the writer is more
+than [limit] bytes behind.
+Index File - [path].idx, sparse index to seek a big capture by time or offset
+  Magic - 8 bytes - 'WUIDX' 0x01 '\r\n'
+  Entries - float64 unix time + uint64 offset of a record start, one entry every
+            INDEX_INTERVAL bytes of capture, flushed with the capture
+"""
+class CaptureWriter:
+    MAGIC = b'WUCAP\x01\r\n'
+    KIND_SOCKET_RX = 1
+    KIND_SOCKET_TX = 2
+    KIND_UART_RX = 3
+    KIND_UART_TX = 4
+    KIND_NAMES = {1: 'socket_rx', 2: 'socket_tx', 3: 'uart_rx', 4: 'uart_tx'}
+    RECORD_HEADER = struct.Struct('<1d1H')
+    FRAME_HEADER_SHORT = struct.Struct('<1B1B1B1d1H') # start + kind + 1 byte varint + record header
+    INDEX_MAGIC = b'WUIDX\x01\r\n'
+    INDEX_ENTRY = struct.Struct('<1d1Q')
+    INDEX_INTERVAL = 0x40000
+
+    def __init__(self, path:str, limit:int=0x1000000):
+        self.path = path
+        self.limit = limit
+        self.file = open(path, 'ab', buffering=0x100000)
+        if self.file.tell() == 0:
+            self.file.write(CaptureWriter.MAGIC)
+            self.file.flush()
+        self.offset = self.file.tell()
+        self.index_file = open(path + '.idx', 'ab')
+        if self.index_file.tell() == 0:
+            self.index_file.write(CaptureWriter.INDEX_MAGIC)
+        self.index_offset = self.offset
+        self.items = collections.deque()
+        self.size = 0
+        self.cond = threading.Condition()
+        self.is_open = True
+        self.records = 0
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write_forever, daemon=True)
+        self.writer.start()
+
+    def write(self, kind:int, session:int, raw_bytes:bytes):
+        with self.cond:
+            if self.size > self.limit:
+                self.dropped += 1
+                return
+            self.items.append((kind, time.time(), session, bytes(raw_bytes)))
+            self.size += len(raw_bytes)
+            if len(self.items) == 1:
+                self.cond.notify()
+
+    @staticmethod
+    def frame(kind:int, timestamp:float, session:int, raw_bytes:bytes):
+        # header, raw bytes and crc are returned apart to skip copying raw bytes
+        size = len(raw_bytes) + CaptureWriter.RECORD_HEADER.size
+        if size < 0x80:
+            header = CaptureWriter.FRAME_HEADER_SHORT.pack(Packet.SYMBOL_V2, kind, size, timestamp, session)
+        else:
+            header = bytes((Packet.SYMBOL_V2, kind)) + Packet.varint_encode(size) \
+                + CaptureWriter.RECORD_HEADER.pack(timestamp, session)
+        crc = zlib.crc32(raw_bytes, zlib.crc32(header[1:]))
+        return header, raw_bytes, crc.to_bytes(4, 'big')
+
+    def write_forever(self):
+        while True:
+            with self.cond:
+                while len(self.items) == 0 and self.is_open:
+                    self.cond.wait()
+                if len(self.items) == 0:
+                    break
+                items = self.items
+                self.items = collections.deque()
+                self.size = 0
+            try:
+                write = self.file.write
+                for item in items:
+                    if self.offset >= self.index_offset:
+                        self.index_file.write(CaptureWriter.INDEX_ENTRY.pack(item[1], self.offset))
+                        self.index_offset = self.offset + CaptureWriter.INDEX_INTERVAL
+                    header, raw_bytes, crc = CaptureWriter.frame(*item)
+                    write(header)
+                    write(raw_bytes)
+                    write(crc)
+                    self.offset += len(header) + len(raw_bytes) + 4
+                self.records += len(items)
+                if len(self.items) == 0:
+                    self.file.flush()
+                    self.index_file.flush()
+            except Exception as ex1:
+                logger.error('[!] capture(%s) write fail: %s' % (self.path, str(ex1)))
+        self.file.close()
+        self.index_file.close()
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify()
+        self.writer.join()
+        logger.info('capture(%s) records %d, dropped %d' % (self.path, self.records, self.dropped))
+
+
+"""
+Metrics
+process wide registry of per-session counters, gauges and latency histograms.
+- counter: count(name, n), every counter is updated by one thread or under the
+  caller's lock, so the hot path is a dict add without another lock
+- gauge: a function read only when metrics are collected, like queue depth,
+  kind 'counter' for totals kept elsewhere, like decoder checksum errors
+- histogram: observe(name, seconds), log2 buckets from 1 us to 2^23 us,
+  observe_size(name, bytes) for sizes, log2 buckets from 1 to 2^23 bytes
+exposed as prometheus text (/metrics) and json (/metrics.json) by
+start_metrics_server(), and as a json file by start_metrics_dump().
+snapshot() and load() copy the sessions of one process into another one, the
+server supervisor uses them to aggregate its workers.
+per packet totals (socket tx/rx bytes and packets) are plain int adds read as
+'counter' gauges or counted once per feed(), send time is sampled, see
+SendCoalescer, so no metrics call runs per packet (bench metrics).
+--no_metrics hands out NullSessionMetrics, every hook is a no-op.
+"""
+class Histogram:
+    BUCKETS = 24
+
+    def __init__(self, scale:int=1000000):
+        self.counts = [0] * (Histogram.BUCKETS + 1)
+        self.sum = 0.0
+        self.scale = scale
+
+    def observe(self, sec:float):
+        # bucket i counts values below 2^i units (us by default), last one is +Inf
+        idx = int(sec * self.scale).bit_length()
+        self.counts[idx if idx < Histogram.BUCKETS else Histogram.BUCKETS] += 1
+        self.sum += sec
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def bound(self, idx:int):
+        return (1 << idx) / self.scale if idx < Histogram.BUCKETS else float('inf')
+
+    def percentile(self, pct:float):
+        # upper bound of the bucket holding pct
+        counts = list(self.counts)
+        target = sum(counts) * pct / 100
+        acc = 0
+        for idx, num in enumerate(counts):
+            acc += num
+            if num > 0 and acc >= target:
+                return self.bound(idx)
+        return 0.0
+
+
+class SessionMetrics:
+    def __init__(self, name:str):
+        self.name = name
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name:str, num:int=1):
+        counters = self.counters
+        counters[name] = counters.get(name, 0) + num
+
+    def observe(self, name:str, sec:float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(sec)
+
+    def observe_size(self, name:str, size:int):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(1)
+        histogram.observe(size)
+
+    def gauge(self, name:str, func, kind:str='gauge'):
+        self.gauges[name] = (func, kind)
+
+    def read_gauges(self):
+        values = {}
+        for name, (func, kind) in list(self.gauges.items()):
+            try:
+                values[name] = (func(), kind)
+            except Exception:
+                pass
+        return values
+
+
+class NullSessionMetrics(SessionMetrics):
+    def count(self, name:str, num:int=1):
+        pass
+
+    def observe(self, name:str, sec:float):
+        pass
+
+    def observe_size(self, name:str, size:int):
+        pass
+
+    def gauge(self, name:str, func, kind:str='gauge'):
+        pass
+
+
+class MetricsRegistry:
+    PREFIX = 'wuart_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.enable = True
+
+    def session(self, name:str):
+        if not self.enable:
+            return NullSessionMetrics(name)
+        with self.lock:
+            metrics = self.sessions.get(name)
+            if metrics is None:
+                metrics = self.sessions[name] = SessionMetrics(name)
+            return metrics
+
+    def close(self, metrics:SessionMetrics):
+        with self.lock:
+            if self.sessions.get(metrics.name) is metrics:
+                del self.sessions[metrics.name]
+
+    def snapshot(self):
+        # plain values of every session, json serializable
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {m.name: {
+            'counters': dict(m.counters),
+            'gauges': {name: [value, kind] for name, (value, kind) in m.read_gauges().items()},
+            'histograms': {name: [list(h.counts), h.sum, h.scale] for name, h in list(m.histograms.items())},
+        } for m in sessions}
+
+    def load(self, prefix:str, snapshot:dict):
+        # replace every session named [prefix]* by the sessions of a snapshot
+        loaded = {}
+        for name, values in snapshot.items():
+            m = loaded[prefix + name] = SessionMetrics(prefix + name)
+            m.counters = values['counters']
+            for gauge_name, (value, kind) in values['gauges'].items():
+                m.gauge(gauge_name, lambda value=value: value, kind)
+            for histogram_name, (counts, total, scale) in values['histograms'].items():
+                h = m.histograms[histogram_name] = Histogram(scale)
+                h.counts = counts
+                h.sum = total
+        with self.lock:
+            for name in [name for name in self.sessions if name.startswith(prefix)]:
+                del self.sessions[name]
+            self.sessions.update(loaded)
+
+    def to_json(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return {'time': time.time(), 'sessions': {m.name: {
+            'counters': dict(m.counters),
+            'gauges': {name: value for name, (value, _) in m.read_gauges().items()},
+            'histograms': {name: {'count': h.count, 'sum': h.sum, 'p50': h.percentile(50), 'p99': h.percentile(99),
+                                  'buckets': list(h.counts)} for name, h in list(m.histograms.items())},
+        } for m in sessions}}
+
+    def to_prometheus(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        series = collections.OrderedDict() # metric name -> (type, lines)
+        def add(name, kind, line):
+            series.setdefault(name, (kind, []))[1].append(line)
+        for m in sessions:
+            label = 'session="%s"' % m.name.replace('\\', '\\\\').replace('"', '\\"')
+            for name, value in list(m.counters.items()):
+                metric = MetricsRegistry.PREFIX + name + '_total'
+                add(metric, 'counter', '%s{%s} %d' % (metric, label, value))
+            for name, (value, kind) in m.read_gauges().items():
+                metric = MetricsRegistry.PREFIX + name + ('_total' if kind == 'counter' else '')
+                add(metric, kind, '%s{%s} %s' % (metric, label, value))
+            for name, h in list(m.histograms.items()):
+                metric = MetricsRegistry.PREFIX + name
+                acc = 0
+                for idx, num in enumerate(list(h.counts)):
+                    acc += num
+                    le = '+Inf' if idx == Histogram.BUCKETS else repr(h.bound(idx))
+                    add(metric, 'histogram', '%s_bucket{%s,le="%s"} %d' % (metric, label, le, acc))
+                add(metric, 'histogram', '%s_sum{%s} %.9f' % (metric, label, h.sum))
+                add(metric, 'histogram', '%s_count{%s} %d' % (metric, label, acc))
+        text = []
+        for metric, (kind, lines) in series.items():
+            text.append('# TYPE %s %s' % (metric, kind))
+            text.extend(lines)
+        return '\n'.join(text) + '\n'
+
+
+metrics = MetricsRegistry()
+
+
+def start_metrics_server(port:int, host:str='127.0.0.1'):
+    # imported here, http.server costs megabytes of rss when metrics are off
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics.to_prometheus().encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(metrics.to_json()).encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug('metrics %s %s' % (self.client_address[0], format % args))
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('+++ metrics on http://%s:%d/metrics +++' % server.server_address)
+    return server
+
+
+def start_metrics_dump(path:str, interval_sec:float):
+    def dump_forever():
+        while True:
+            time.sleep(interval_sec)
+            try:
+                with open(path + '.tmp', 'w') as dump_file:
+                    json.dump(metrics.to_json(), dump_file)
+                os.replace(path + '.tmp', path)
+            except Exception as ex1:
+                logger.warning('metrics dump err: ' + str(ex1))
+    threading.Thread(target=dump_forever, daemon=True).start()
+
+
+"""
+Send Coalescer
+every frame is sent as its header, value and trailer buffers by sendmsg(), no
+join, streams without sendmsg() (reliable udp, windows) get them joined.
+with a window ([delay_sec] > 0) a data frame waits until [limit] bytes are
+pending or [delay_sec] after the first pending one, so several small frames
+go out in one syscall and tcp segment, at most [delay_sec] later, other frames
+send the pending ones with them at once, so order is kept.
+socket_send_seconds and socket_flush_bytes histograms are observed on every
+SAMPLE-th flush, tx bytes and packets are totals read as gauges, so sending a
+frame makes no metrics call.
+"""
+class SendCoalescer:
+    IOV_MAX = 512
+    SAMPLE = 64
+
+    def __init__(self, stream, delay_sec:float, limit:int, metrics:SessionMetrics, capture=None, session:int=0):
+        self.stream = stream
+        self.delay_sec = delay_sec
+        self.limit = limit
+        self.metrics = metrics
+        self.capture = capture
+        self.session = session
+        self.cond = threading.Condition()
+        self.parts = []
+        self.size = 0
+        self.deadline = 0
+        self.is_open = True
+        self.tx_bytes = 0
+        self.tx_packets = 0
+        self.flushes = 0
+        metrics.gauge('socket_tx_bytes', lambda: self.tx_bytes, 'counter')
+        metrics.gauge('socket_tx_packets', lambda: self.tx_packets, 'counter')
+        if delay_sec > 0:
+            threading.Thread(target=self.flush_forever, daemon=True).start()
+
+    def reset(self, stream):
+        # new connection, frames of the last one are dropped
+        with self.cond:
+            self.stream = stream
+            self.parts = []
+            self.size = 0
+
+    def send(self, parts, delay:bool=False, packets:int=1):
+        with self.cond:
+            size = 0
+            for part in parts:
+                size += len(part)
+            if self.capture is not None:
+                self.capture.write(CaptureWriter.KIND_SOCKET_TX, self.session, b''.join(parts))
+            self.tx_bytes += size
+            self.tx_packets += packets
+            self.parts.extend(parts)
+            self.size += size
+            if not delay or self.delay_sec <= 0 or self.size >= self.limit:
+                self.flush()
+            elif len(self.parts) == len(parts):
+                self.deadline = time.perf_counter() + self.delay_sec
+                self.cond.notify()
+
+    def flush(self):
+        # cond must be held, it keeps frames of other threads out until sent
+        if len(self.parts) == 0:
+            return
+        parts = self.parts
+        size = self.size
+        self.parts = []
+        self.size = 0
+        self.flushes += 1
+        if self.flushes % SendCoalescer.SAMPLE != 0:
+            SendCoalescer.sendmsg_all(self.stream, parts)
+            return
+        start = time.perf_counter()
+        SendCoalescer.sendmsg_all(self.stream, parts)
+        self.metrics.observe('socket_send_seconds', time.perf_counter() - start)
+        self.metrics.observe_size('socket_flush_bytes', size)
+
+    def flush_forever(self):
+        with self.cond:
+            while self.is_open:
+                if len(self.parts) == 0:
+                    self.cond.wait()
+                    continue
+                remain = self.deadline - time.perf_counter()
+                if remain > 0:
+                    self.cond.wait(remain)
+                    continue
+                try:
+                    self.flush()
+                except Exception as ex1:
+                    logger.error('[!] coalesced send fail: %s' % str(ex1))
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    @staticmethod
+    def sendmsg_all(stream, parts):
+        # sendall() of several buffers, one sendmsg() call when the socket takes them all
+        if not hasattr(stream, 'sendmsg'):
+            stream.sendall(b''.join(parts))
+            return
+        views = [memoryview(part) for part in parts if len(part) > 0]
+        idx = 0
+        while idx < len(views):
+            sent = stream.sendmsg(views[idx:idx+SendCoalescer.IOV_MAX])
+            while sent > 0:
+                if sent >= len(views[idx]):
+                    sent -= len(views[idx])
+                    idx += 1
+                else:
+                    views[idx] = views[idx][sent:]
+                    sent = 0
+
+
+"""
+Reliable UDP Channel
+stream-like sendall()/recv()/settimeout() over UDP, so the Packet stream runs
+on top unchanged, without TCP head-of-line blocking on retransmission timeout.
+Datagram Structure
+Type - uint8 - DATA(1), ACK(2), PING(3), FIN(4)
+Session Id - uint32 - random per client connection
+Sequence - uint32 - DATA: datagram sequence, ACK: next expected sequence (cumulative)
+Payload - DATA: piece of the packet stream (max MTU bytes), ACK: uint32 selective
+          ack bitmap, bit i means sequence (ack + 1 + i) received
+- receiver delivers payloads in sequence order, out of order ones wait in a bounded map
+- sender keeps a window of unacked datagrams, retransmits when rto (from srtt)
+  expires, or earlier when a datagram sent later is selectively acked.
+- idle side sends PING every KEEPALIVE_SEC, channel closes after IDLE_TIMEOUT_SEC silence.
+"""
+class ReliableUdpChannel:
+    TYPE_DATA = 1
+    TYPE_ACK = 2
+    TYPE_PING = 3
+    TYPE_FIN = 4
+    HEADER = struct.Struct('<1B1I1I')
+    SACK = struct.Struct('<1I')
+    SACK_BITS = 32
+    MTU = 1200
+    WINDOW = 64
+    RTO_INIT = 0.2
+    RTO_MIN = 0.01
+    RTO_MAX = 1.0
+    KEEPALIVE_SEC = 5.0
+    IDLE_TIMEOUT_SEC = 30.0
+
+    def __init__(self, sock, addr, session_id:int, shim=None):
+        self.sock = sock
+        self.addr = addr
+        self.session_id = session_id
+        self.shim = shim
+        self.on_close = None
+        self.cond = threading.Condition()
+        self.is_open = True
+        self.timeout = None
+        # sender
+        self.send_next = 0
+        self.unacked = collections.OrderedDict() # seq -> [datagram, sent time, retransmitted]
+        self.last_send_time = time.monotonic()
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = ReliableUdpChannel.RTO_INIT
+        self.retransmits = 0
+        # receiver
+        self.recv_next = 0
+        self.out_of_order = {}
+        self.recv_buffer = bytearray()
+        self.last_recv_time = time.monotonic()
+        self.timer = threading.Thread(target=self.timer_forever, daemon=True)
+        self.timer.start()
+
+    @staticmethod
+    def connect(addr, shim=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(addr)
+        channel = ReliableUdpChannel(sock, addr, random.getrandbits(32), shim)
+        def close_sock():
+            try:
+                sock.shutdown(socket.SHUT_RDWR) # wake up recv_forever
+            except OSError:
+                pass
+            sock.close()
+        channel.on_close = close_sock
+        threading.Thread(target=channel.recv_forever, daemon=True).start()
+        # let server create the session before any data
+        channel.send_control(ReliableUdpChannel.TYPE_PING)
+        return channel
+
+    def recv_forever(self):
+        try:
+            while self.is_open:
+                self.receive_datagram(self.sock.recv(0x10000))
+        except Exception as ex1:
+            logger.debug('udp recv err: ' + str(ex1))
+        self.close()
+
+    def send_datagram(self, datagram:bytes):
+        self.last_send_time = time.monotonic()
+        try:
+            if self.shim is not None:
+                self.shim.sendto(datagram, self.addr)
+            else:
+                self.sock.sendto(datagram, self.addr)
+        except OSError as ex1:
+            logger.debug('udp send err: ' + str(ex1))
+
+    def send_control(self, kind:int):
+        self.send_datagram(ReliableUdpChannel.HEADER.pack(kind, self.session_id, 0))
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, raw_bytes:bytes):
+        view = memoryview(raw_bytes)
+        for i in range(0, len(view), ReliableUdpChannel.MTU):
+            with self.cond:
+                while self.is_open and len(self.unacked) >= ReliableUdpChannel.WINDOW:
+                    self.cond.wait()
+                if not self.is_open:
+                    raise ConnectionError('udp channel closed')
+                seq = self.send_next
+                self.send_next += 1
+                datagram = ReliableUdpChannel.HEADER.pack(ReliableUdpChannel.TYPE_DATA, self.session_id, seq) \
+                    + view[i:i+ReliableUdpChannel.MTU]
+                self.unacked[seq] = [datagram, time.monotonic(), False]
+                self.cond.notify_all()
+            self.send_datagram(datagram)
+
+    def recv(self, buf_size:int):
+        with self.cond:
+            deadline = None if self.timeout is None else time.monotonic() + self.timeout
+            while len(self.recv_buffer) == 0 and self.is_open:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remain = deadline - time.monotonic()
+                    if remain <= 0:
+                        raise socket.timeout('timed out')
+                    self.cond.wait(remain)
+            recv_raw = bytes(self.recv_buffer[:buf_size])
+            del self.recv_buffer[:buf_size]
+            return recv_raw
+
+    def close(self):
+        with self.cond:
+            if not self.is_open:
+                return
+            self.is_open = False
+            self.cond.notify_all()
+        self.send_control(ReliableUdpChannel.TYPE_FIN)
+        logger.debug('udp session %08x close, retransmits %d, srtt %s' % (
+            self.session_id, self.retransmits, 'none' if self.srtt is None else '%.2fms' % (self.srtt * 1000)))
+        if self.on_close is not None:
+            self.on_close()
+
+    def ack_datagram(self):
+        # cond must be held
+        sack = 0
+        for seq in self.out_of_order:
+            bit = seq - self.recv_next - 1
+            if bit < ReliableUdpChannel.SACK_BITS:
+                sack |= 1 << bit
+        return ReliableUdpChannel.HEADER.pack(ReliableUdpChannel.TYPE_ACK, self.session_id, self.recv_next) \
+            + ReliableUdpChannel.SACK.pack(sack)
+
+    def receive_datagram(self, datagram:bytes):
+        if len(datagram) < ReliableUdpChannel.HEADER.size:
+            return
+        kind, session_id, seq = ReliableUdpChannel.HEADER.unpack_from(datagram)
+        if session_id != self.session_id:
+            return
+        self.last_recv_time = time.monotonic()
+        if kind == ReliableUdpChannel.TYPE_DATA:
+            with self.cond:
+                if seq == self.recv_next:
+                    self.recv_buffer += datagram[ReliableUdpChannel.HEADER.size:]
+                    self.recv_next += 1
+                    while self.recv_next in self.out_of_order:
+                        self.recv_buffer += self.out_of_order.pop(self.recv_next)
+                        self.recv_next += 1
+                    self.cond.notify_all()
+                elif self.recv_next < seq < self.recv_next + ReliableUdpChannel.WINDOW * 2:
+                    self.out_of_order[seq] = datagram[ReliableUdpChannel.HEADER.size:]
+                ack = self.ack_datagram()
+            self.send_datagram(ack)
+        elif kind == ReliableUdpChannel.TYPE_ACK:
+            sack = 0
+            if len(datagram) >= ReliableUdpChannel.HEADER.size + ReliableUdpChannel.SACK.size:
+                sack, = ReliableUdpChannel.SACK.unpack_from(datagram, ReliableUdpChannel.HEADER.size)
+            self.handle_ack(seq, sack)
+        elif kind == ReliableUdpChannel.TYPE_PING:
+            with self.cond:
+                ack = self.ack_datagram()
+            self.send_datagram(ack)
+        elif kind == ReliableUdpChannel.TYPE_FIN:
+            with self.cond:
+                self.is_open = False
+                self.cond.notify_all()
+            if self.on_close is not None:
+                self.on_close()
+
+    def handle_ack(self, ack_seq:int, sack:int):
+        now = time.monotonic()
+        resend = []
+        with self.cond:
+            acked = []
+            while len(self.unacked) > 0 and next(iter(self.unacked)) < ack_seq:
+                acked.append(self.unacked.popitem(last=False)[1])
+            for bit in range(ReliableUdpChannel.SACK_BITS):
+                if (sack >> bit) & 1:
+                    entry = self.unacked.pop(ack_seq + 1 + bit, None)
+                    if entry is not None:
+                        acked.append(entry)
+            latest_sent = None
+            for _, sent_time, retransmitted in acked:
+                if not retransmitted:
+                    self.update_rtt(now - sent_time)
+                if latest_sent is None or sent_time > latest_sent:
+                    latest_sent = sent_time
+            # a datagram sent before a selectively acked one is lost, allow a little reorder
+            if sack != 0 and latest_sent is not None:
+                slack = (self.srtt or ReliableUdpChannel.RTO_MIN) / 4
+                for seq, entry in self.unacked.items():
+                    if seq > ack_seq + ReliableUdpChannel.SACK_BITS:
+                        break
+                    if entry[1] < latest_sent and now - entry[1] > slack:
+                        entry[1] = now
+                        entry[2] = True
+                        resend.append(entry[0])
+            self.retransmits += len(resend)
+            self.cond.notify_all()
+        for datagram in resend:
+            self.send_datagram(datagram)
+
+    def update_rtt(self, rtt:float):
+        # cond must be held, RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, ReliableUdpChannel.RTO_MIN), ReliableUdpChannel.RTO_MAX)
+
+    def timer_forever(self):
+        while True:
+            resend = []
+            ping = False
+            with self.cond:
+                if not self.is_open:
+                    break
+                now = time.monotonic()
+                if now - self.last_recv_time > ReliableUdpChannel.IDLE_TIMEOUT_SEC:
+                    logger.warning('udp session %08x idle timeout' % self.session_id)
+                    break
+                for entry in self.unacked.values():
+                    if now - entry[1] >= self.rto:
+                        entry[1] = now
+                        entry[2] = True
+                        resend.append(entry[0])
+                if len(resend) > 0:
+                    self.retransmits += len(resend)
+                    self.rto = min(self.rto * 2, ReliableUdpChannel.RTO_MAX)
+                ping = now - self.last_send_time >= ReliableUdpChannel.KEEPALIVE_SEC
+                # sleep until next retransmit, keepalive or idle deadline
+                deadline = min([self.last_send_time + ReliableUdpChannel.KEEPALIVE_SEC,
+                                self.last_recv_time + ReliableUdpChannel.IDLE_TIMEOUT_SEC]
+                               + [entry[1] + self.rto for entry in self.unacked.values()])
+                if len(resend) == 0 and not ping:
+                    self.cond.wait(max(deadline - now, 0.001))
+                    continue
+            for datagram in resend:
+                self.send_datagram(datagram)
+            if ping:
+                self.send_control(ReliableUdpChannel.TYPE_PING)
+        self.close()
+
+
+"""
+Lossy Datagram Shim
+for local tests only, drops datagrams at [loss] rate and delays [reorder] rate
+of them by [delay_ms] so they arrive after later ones.
+"""
+class LossyDatagramShim:
+    def __init__(self, sock, loss:float=0.0, reorder:float=0.0, delay_ms:float=5.0, seed=None):
+        self.sock = sock
+        self.loss = loss
+        self.reorder = reorder
+        self.delay_ms = delay_ms
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.reordered = 0
+
+    def sendto(self, datagram:bytes, addr):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+        elif self.random.random() < self.reorder:
+            self.reordered += 1
+            threading.Timer(self.delay_ms / 1000, self.sock.sendto, (datagram, addr)).start()
+        else:
+            self.sock.sendto(datagram, addr)
+
+
+"""
+UART Device Registry
+one UartDevice per uart path in this process, shared by every client that
+starts the same path, the handle is reference counted and closed when the last
+client leaves.
+- rx: a single reader reads the uart once and broadcasts each chunk to every
+  attached client, the data packet is encoded once per chunk, not per client.
+  the reader never waits on a socket, a thread engine client queues frames
+  for its own sender thread (send_queue), an event loop client writes to its
+  transport.
+- tx: writes from all clients go through one bounded queue per device, a writer
+  thread joins queued payloads into writes of up to WRITE_BATCH bytes in order,
+  and drains the uart (flush, waits until sent on the wire) only when the queue
+  is empty or the device closes, so a slow uart never holds a socket reader.
+  an event loop client never waits on the queue, its socket reading is paused
+  once the queue is full and resumed by the writer below half of it.
+  uart_tx_queue_seconds is the time from queued to written, uart_write_seconds
+  the write call, uart_drain_seconds the drain, uart_write_batch_bytes sizes.
+  with --pace_rate or --pace_every writes go through a UartPacer, its wait is
+  not in uart_write_seconds.
+- chunks: rx is cut by the chunk mode of the path (UartChunker) before the
+  broadcast, a loop reader flushes pending bytes from a call_later timer.
+captured uart bytes use session 0x8000 + device number, clients use client id.
+"""
+class UartDevice:
+    WRITE_BATCH = 0x1000
+    device_count = 0
+
+    def __init__(self, path:str, baud:int, loop=None):
+        global uart_queue_bytes, capture, chunk_mode, chunk_devices, chunk_gap_chars, chunk_max_bytes, chunk_max_ms, \
+            pace_rate, pace_burst_bytes, pace_every_bytes, pace_delay_ms
+        UartDevice.device_count += 1
+        self.device_id = 0x8000 | (UartDevice.device_count & 0x7FFF)
+        self.capture = capture
+        self.path = path
+        self.baud = baud
+        self.loop = loop
+        self.clients = ()
+        self.tx_queue = ByteQueue('uart(%s) tx' % path, uart_queue_bytes)
+        self.serial = serial.Serial(path, baud)
+        self.is_open = True
+        self.metrics = metrics.session('uart(%s)' % path)
+        self.metrics.gauge('uart_tx_queue_bytes', self.tx_queue.__len__)
+        self.metrics.gauge('clients', lambda: len(self.clients))
+        self.chunker = UartChunker(chunk_devices.get(path, chunk_mode), baud, chunk_gap_chars, chunk_max_bytes,
+                                   chunk_max_ms / 1000, self.metrics)
+        self.flush_timer = None
+        self.pacer = None
+        if pace_rate > 0 or pace_every_bytes > 0:
+            self.pacer = UartPacer(baud, pace_rate, pace_burst_bytes, pace_every_bytes, pace_delay_ms / 1000, self.metrics)
+        self.reader = None
+        if self.loop is not None:
+            self.loop.add_reader(self.serial.fileno(), self.read_ready)
+        else:
+            self.reader = threading.Thread(target=self.read_forever, daemon=True)
+            self.reader.start()
+        self.paused = set() # event loop clients with reading paused
+        self.paused_lock = threading.Lock()
+        self.writer = threading.Thread(target=self.write_forever, daemon=True)
+        self.writer.start()
+
+    def attach(self, client):
+        self.clients = self.clients + (client,)
+
+    def detach(self, client):
+        self.clients = tuple(c for c in self.clients if c is not client)
+
+    def replace(self, client, new_client):
+        self.clients = tuple(new_client if c is client else c for c in self.clients)
+
+    def write(self, val_bytes:bytes, client=None):
+        # clients with flow control are bounded by their window, no need to wait
+        if client is not None and client.loop is not None:
+            self.tx_queue.put((client, val_bytes), len(val_bytes), False)
+            if not client.flow_enable and len(self.tx_queue) >= self.tx_queue.limit:
+                self.pause_reading(client)
+            return
+        block = client is None or not client.flow_enable
+        self.tx_queue.put((client, val_bytes), len(val_bytes), block)
+
+    def pause_reading(self, client):
+        # loop thread, the queue is checked again in case the writer drained it already
+        with self.paused_lock:
+            self.paused.add(client)
+            client.pause_reading()
+            if len(self.tx_queue) < self.tx_queue.limit // 2:
+                self.paused.discard(client)
+                client.resume_reading()
+
+    def resume_reading(self):
+        # writer thread
+        with self.paused_lock:
+            if len(self.paused) == 0 or len(self.tx_queue) >= self.tx_queue.limit // 2:
+                return
+            clients = self.paused
+            self.paused = set()
+        for client in clients:
+            client.loop.call_soon_threadsafe(client.resume_reading)
+
+    def write_forever(self):
+        try:
+            while True:
+                items, put_time = self.tx_queue.get_batch(UartDevice.WRITE_BATCH)
+                stop = items[-1] is None
+                if stop:
+                    items.pop()
+                if len(items) > 0:
+                    val_bytes = items[0][1] if len(items) == 1 else b''.join(val for _, val in items)
+                    delay = 0.0
+                    start = time.perf_counter()
+                    if self.pacer is not None:
+                        delay = self.pacer.write(self.serial, val_bytes)
+                    else:
+                        self.serial.write(val_bytes)
+                    end = time.perf_counter()
+                    self.metrics.observe('uart_write_seconds', end - start - delay)
+                    self.metrics.observe('uart_tx_queue_seconds', end - put_time)
+                    self.metrics.observe_size('uart_write_batch_bytes', len(val_bytes))
+                    self.metrics.count('uart_tx_bytes', len(val_bytes))
+                    if self.capture is not None:
+                        self.capture.write(CaptureWriter.KIND_UART_TX, self.device_id, val_bytes)
+                    written = {}
+                    for client, val in items:
+                        if client is not None:
+                            written[client] = written.get(client, 0) + len(val)
+                    for client, size in written.items():
+                        client.uart_written(size)
+                    self.resume_reading()
+                if stop or len(self.tx_queue) == 0:
+                    start = time.perf_counter()
+                    self.serial.flush()
+                    self.metrics.observe('uart_drain_seconds', time.perf_counter() - start)
+                if stop:
+                    break
+        except Exception as ex1:
+            logger.error('uart(%s) write fail: %s' % (self.path, str(ex1)))
+        try:
+            self.serial.close()
+        except Exception as ex1:
+            logger.warn('device(%s) close fail: %s' % (self.path, str(ex1)))
+
+    def read_ready(self):
+        try:
+            rx_bytes = self.serial.read(max(self.serial.in_waiting, 1))
+        except Exception as ex1:
+            self.read_fail(ex1)
+            return
+        now = time.perf_counter()
+        for chunk in self.chunker.feed(rx_bytes, now):
+            self.broadcast(chunk)
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        wait = self.chunker.timeout(now)
+        if wait is not None:
+            self.flush_timer = self.loop.call_later(wait, self.flush_ready)
+
+    def flush_ready(self):
+        self.flush_timer = None
+        if self.is_open:
+            for chunk in self.chunker.flush(time.perf_counter()):
+                self.broadcast(chunk)
+
+    def read_forever(self):
+        try:
+            while self.is_open:
+                for rx_bytes in self.chunker.read(self.serial):
+                    self.broadcast(rx_bytes)
+        except Exception as ex1:
+            if self.is_open:
+                self.read_fail(ex1)
+
+    def read_fail(self, ex1:Exception):
+        for client in self.clients:
+            client.uart_lost('uart read fail: ' + str(ex1))
+
+    def broadcast(self, rx_bytes:bytes):
+        clients = [c for c in self.clients if c.is_running]
+        if rx_bytes is None or len(rx_bytes) == 0:
+            return
+        self.metrics.count('uart_rx_bytes', len(rx_bytes))
+        if self.capture is not None:
+            self.capture.write(CaptureWriter.KIND_UART_RX, self.device_id, rx_bytes)
+        if len(clients) == 0:
+            return
+        # encode once for every protocol version in use, compressed clients have own context
+        raw_cache = {}
+        for client in clients:
+            try:
+                spool = client.spool
+                if spool is None:
+                    self.send_client(client, rx_bytes, raw_cache)
+                    continue
+                with spool.lock:
+                    if spool.owner is None:
+                        # session detached, kept for the client to resume
+                        spool.append(rx_bytes)
+                    else:
+                        # the owner, a resumed session may not be in clients yet
+                        self.send_client(spool.owner, rx_bytes, raw_cache)
+            except Exception as ex1:
+                logger.error('client.%d send err: %s' % (client.client_id, str(ex1)))
+
+    def send_client(self, client, rx_bytes:bytes, raw_cache:dict):
+        if client.flow_enable:
+            client.send_data(rx_bytes)
+            return
+        if client.spool is not None:
+            client.spool.append(rx_bytes)
+        if client.compressor is not None:
+            parts = client.packet_parts(Packet('data', client.compressor.compress(rx_bytes)))
+        else:
+            parts = raw_cache.get((client.proto_version, client.channel))
+        if parts is None:
+            parts = client.packet_parts(Packet('data', rx_bytes))
+            raw_cache[(client.proto_version, client.channel)] = parts
+        client.send_parts(parts, True)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        try:
+            if self.loop is not None:
+                self.loop.remove_reader(self.serial.fileno())
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+            elif hasattr(self.serial, 'cancel_read'):
+                self.serial.cancel_read() # wake up reader
+        except Exception as ex1:
+            logger.warn('device(%s) reader stop fail: %s' % (self.path, str(ex1)))
+        # writer closes serial after queued bytes are written
+        self.tx_queue.put(None, 0, block=False)
+        metrics.close(self.metrics)
+        logger.info('uart(%s) queue %s' % (self.path, self.tx_queue.summary()))
+
+
+class UartDeviceRegistry:
+    def __init__(self):
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, path:str, baud:int, client, loop=None):
+        with self.lock:
+            device = self.devices.get(path)
+            if device is None:
+                device = UartDevice(path, baud, loop)
+                self.devices[path] = device
+                logger.info('+++ uart(%s,%d) open ok +++' % (path, baud))
+            elif device.baud != baud:
+                raise Exception('uart(%s) already opened with baud %d' % (path, device.baud))
+            device.attach(client)
+            logger.info('uart(%s) attach client.%d, %d clients' % (path, client.client_id, len(device.clients)))
+            return device
+
+    def release(self, device:UartDevice, client):
+        with self.lock:
+            device.detach(client)
+            logger.info('uart(%s) detach client.%d, %d clients' % (device.path, client.client_id, len(device.clients)))
+            if len(device.clients) == 0:
+                if self.devices.get(device.path) is device:
+                    del self.devices[device.path]
+                device.close()
+                logger.info('--- uart(%s) close ok ---' % device.path)
+
+    def replace(self, device:UartDevice, client, new_client):
+        with self.lock:
+            device.replace(client, new_client)
+            logger.info('uart(%s) client.%d taken over by client.%d' % (device.path, client.client_id, new_client.client_id))
+
+
+uart_registry = UartDeviceRegistry()
+
+
+"""
+UART Spool
+uart rx bytes of one session channel, kept for a client to resume after its
+connection is lost. offsets count every byte for the client since the session
+began, start is the offset of the oldest byte kept, at least [limit] bytes are
+kept (trimmed only when twice that, so appends stay cheap).
+owner is the channel handler that gets live bytes, None while detached, the
+spool lock orders spooling against detach and resume, taken before flow_lock.
+"""
+class UartSpool:
+    def __init__(self, limit:int):
+        self.limit = limit
+        self.buffer = bytearray()
+        self.start = 0
+        self.owner = None
+        self.lock = threading.Lock()
+
+    @property
+    def end(self):
+        return self.start + len(self.buffer)
+
+    def append(self, raw_bytes):
+        self.buffer += raw_bytes
+        if len(self.buffer) > self.limit * 2:
+            trim = len(self.buffer) - self.limit
+            del self.buffer[:trim]
+            self.start += trim
+
+    def read_from(self, offset:int):
+        # offset of the first byte returned (older ones may be gone) and bytes until end
+        offset = min(max(offset, self.start), self.end)
+        return offset, bytes(self.buffer[offset - self.start:])
+
+
+"""
+Session Registry
+sessions by id, a handler is here while connected and, after its connection
+is lost, detached for [linger] seconds with its uarts still open, then its
+channels are closed. a client resuming by id takes the session over from
+either, a connection not noticed dead yet is dropped.
+"""
+class SessionRegistry:
+    def __init__(self):
+        self.sessions = {} # id -> [handler, expire timer while detached]
+        self.lock = threading.Lock()
+
+    def attach(self, handler):
+        with self.lock:
+            self.sessions[handler.session_id] = [handler, None]
+
+    def take(self, session_id:str):
+        # handler of the session, its channels (handed over, nothing left for it
+        # to close) and if it is still connected, None if unknown or expired
+        with self.lock:
+            item = self.sessions.pop(session_id, None)
+            if item is None:
+                return None, {}, False
+            channels = item[0].channels
+            item[0].channels = {}
+            item[0].session_id = None
+        if item[1] is not None:
+            item[1].cancel()
+        return item[0], channels, item[1] is None
+
+    def detach(self, handler, linger_sec:float):
+        with self.lock:
+            item = self.sessions.get(handler.session_id)
+            if item is None or item[0] is not handler:
+                return False
+            item[1] = threading.Timer(linger_sec, self.expire, (handler,))
+            item[1].daemon = True
+            item[1].start()
+        logger.info('client.%d session %s detached, linger %.1f sec' % (handler.client_id, handler.session_id, linger_sec))
+        return True
+
+    def expire(self, handler):
+        with self.lock:
+            item = self.sessions.get(handler.session_id)
+            if item is None or item[0] is not handler:
+                return
+            del self.sessions[handler.session_id]
+        logger.info('client.%d session %s expired' % (handler.client_id, handler.session_id))
+        if handler.loop is not None:
+            # uart readers are on the loop
+            handler.loop.call_soon_threadsafe(handler.close_channels)
+        else:
+            handler.close_channels()
+
+
+session_registry = SessionRegistry()
+
+
 class WirelessUartClientHandler(socketserver.BaseRequestHandler):
+    CONNECTION_KEYS = ('proto', 'frame', 'compress', 'flow', 'mux', 'session')
+    # connection state and options a channel reads from the handler, the rest is set by init_channel
+    CHANNEL_SHARED = ('request', 'client_address', 'server', 'client_id', 'decoder', 'frame_max', 'peer_frame_max',
+                      'buf_size', 'data_encode', 'proto_version', 'proto_max', 'compressor', 'coalescer', 'send_queue',
+                      'send_failed', 'sender', 'coalesce_sec', 'coalesce_bytes', 'flow_window', 'flow_enable',
+                      'flow_peer_window', 'rx_pending_limit', 'channels', 'mux_max', 'session_id', 'session_linger',
+                      'session_spool', 'loop', 'capture')
+
     def __init__(self, request, client_address, server):
-        global client_count, socket_buffer_size, recv_timeout_sec, data_encode
+        self.init_session()
+        super().__init__(request, client_address, server)
+
+    def init_session(self):
+        global client_count, socket_buffer_size, data_encode, proto_version, \
+            client_queue_bytes, flow_window, capture, coalesce_ms, coalesce_bytes, frame_max_bytes, reassembly_max_bytes, \
+            mux_max, session_linger_sec, session_spool_bytes, send_queue_bytes
         self.client_id = client_count
-        self.recv_buffer = bytearray()
+        self.decoder = PacketStreamDecoder(socket_buffer_size * 16, frame_max=frame_max_bytes, reassembly_max=reassembly_max_bytes)
+        self.frame_max = frame_max_bytes
+        self.peer_frame_max = PacketStreamDecoder.FRAME_MAX
         self.buf_size = socket_buffer_size
-        self.recv_timeout = recv_timeout_sec
         self.uart_dev = None
         self.uart_path = ''
         self.uart_baud = 0
         self.is_running = False
         self.data_encode = data_encode
+        self.proto_version = 1
+        self.proto_max = proto_version
+        self.compressor = None
+        self.coalescer = None
+        self.send_queue = ByteQueue('socket tx', send_queue_bytes)
+        self.send_failed = False
+        self.sender = None
+        self.coalesce_sec = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        self.flow_window = flow_window
+        self.flow_enable = False
+        self.flow_lock = threading.Lock()
+        self.flow_peer_window = 0
+        self.send_credit = 0
+        self.recv_consumed = 0
+        self.rx_pending = bytearray()
+        self.rx_pending_limit = client_queue_bytes
+        self.rx_pending_hwm = 0
+        self.rx_dropped = 0
+        self.rx_replayed = 0
+        self.channel = 0
+        self.channels = {0: self}
+        self.mux_max = mux_max
+        self.spool = None
+        self.session_id = None
+        self.session_linger = session_linger_sec
+        self.session_spool = session_spool_bytes
+        self.loop = None
+        self.capture = capture
+        self.metrics = metrics.session('client.%d' % self.client_id)
+        self.channel_gauges()
+        self.metrics.gauge('send_queue_bytes', self.send_queue.__len__)
+        self.metrics.gauge('checksum_errors', lambda: self.decoder.checksum_errors, 'counter')
+        self.metrics.gauge('resync_bytes', lambda: self.decoder.skipped_bytes, 'counter')
+        self.metrics.gauge('oversize_frames', lambda: self.decoder.oversize_frames, 'counter')
+        self.metrics.gauge('decoder_peak_bytes', lambda: self.decoder.peak_bytes)
+        self.metrics.gauge('reassembly_peak_bytes', lambda: self.decoder.reassembly_peak)
         client_count = client_count + 1
-        super().__init__(request, client_address, server)
 
     def error(self, msg):
         logger.error('[!] client.%d err: %s' % (self.client_id, str(msg)))
         self.send_packet('error', msg)
 
+    """
+    channels (negotiated by 'mux' packet with channel count, v2 and later)
+    every channel is a uart session of its own (path, baud, flow credit,
+    compress context and metrics session) on the same connection. a channel
+    takes CHANNEL_SHARED from the handler, so socket, decoder, coalescer and
+    send queue are shared, it never handles the socket itself.
+    received packets are routed by channel, connection options go to channel 0.
+    """
+    def open_channel(self, channel:int):
+        chan = type(self).__new__(type(self))
+        for name in self.CHANNEL_SHARED:
+            setattr(chan, name, getattr(self, name))
+        chan.init_channel(channel)
+        self.channels[channel] = chan
+        return chan
+
+    def init_channel(self, channel:int):
+        self.channel = channel
+        self.uart_dev = None
+        self.uart_path = ''
+        self.uart_baud = 0
+        self.is_running = False
+        if self.compressor is not None:
+            self.compressor = StreamCompressor(self.compressor.method, self.compressor.zdict)
+        self.flow_lock = threading.Lock()
+        self.send_credit = self.flow_peer_window if self.flow_enable else 0
+        self.recv_consumed = 0
+        self.rx_pending = bytearray()
+        self.rx_pending_hwm = 0
+        self.rx_dropped = 0
+        self.rx_replayed = 0
+        self.spool = None
+        self.metrics = metrics.session('client.%d/ch%d' % (self.client_id, channel))
+        self.channel_gauges()
+
+    def channel_gauges(self):
+        self.metrics.gauge('rx_pending_bytes', lambda: len(self.rx_pending))
+        self.metrics.gauge('rx_dropped_bytes', lambda: self.rx_dropped, 'counter')
+        self.metrics.gauge('send_credit_bytes', lambda: self.send_credit)
+
+    def close_channels(self):
+        for chan in self.channels.values():
+            chan.is_running = False
+            chan.uart_close()
+
     def uart_open(self):
         try:
             if isinstance(self.uart_baud, int) and self.uart_baud > 0 \
                 and isinstance(self.uart_path, str) and len(self.uart_path) > 0:
-                if isinstance(self.uart_dev, serial.Serial):
-                    if self.uart_dev.portstr == self.uart_path and self.uart_dev.baudrate == self.uart_baud:
+                if isinstance(self.uart_dev, UartDevice):
+                    if self.uart_dev.path == self.uart_path and self.uart_dev.baud == self.uart_baud:
                         logger.debug('device(%s, %d) already opened.' % (self.uart_path, self.uart_baud))
                         return True
-                    logger.warn("last device(%s) still using, try to close." % self.uart_dev.portstr)
+                    logger.warn("last device(%s) still using, try to close." % self.uart_dev.path)
                     self.uart_close()
-                self.uart_dev = serial.Serial(self.uart_path, self.uart_baud)
-                if self.uart_dev != None and self.uart_dev.is_open:
-                    logger.info('+++ uart(%s,%d) open ok +++' % (self.uart_path, self.uart_baud))
-                    return True
+                self.uart_dev = uart_registry.acquire(self.uart_path, self.uart_baud, self, self.loop)
+                return True
             else:
                 self.error('uart setup not ready.')
         except Exception as ex1:
@@ -260,16 +2273,124 @@ class WirelessUartClientHandler(socketserver.BaseRequestHandler):
 
     def uart_close(self):
         try:
-            if isinstance(self.uart_dev, serial.Serial):
-                try:
-                    self.uart_dev.close()
-                    self.uart_dev = None
-                    return True
-                except:
-                    logger.warn("device(%s) close fail..." % self.uart_dev.portstr)
+            if isinstance(self.uart_dev, UartDevice):
+                uart_dev = self.uart_dev
+                self.uart_dev = None
+                uart_registry.release(uart_dev, self)
+                return True
         except Exception as ex1:
             logger.error('uart close fail: ' + str(ex1))
         return False
+
+    """
+    sessions (negotiated by 'session' packet with 'id:offset,...', the id is
+    empty for a new session, offsets are rx bytes received on every channel,
+    the reply is the session id and the offsets replay starts from)
+    a session outlives its connection, see SessionRegistry, the uarts stay
+    open and their rx bytes go to the channel spools. a resumed session takes
+    the uarts over without reopening them and gets the spools replayed from
+    the offsets, bytes already trimmed from a spool are lost.
+    sessions are opt-in by --session_linger, a lingering session holds its
+    uarts open and keeps reading them until it expires, and single process
+    only, a client resuming on another worker would open the uarts twice.
+    """
+    def open_session(self, request:str):
+        if self.session_linger <= 0:
+            self.error('session disabled.')
+            return
+        session_id, _, offsets = request.partition(':')
+        try:
+            offsets = [int(offset) for offset in offsets.split(',') if len(offset) > 0]
+        except ValueError:
+            self.error('session invalid.')
+            return
+        old, old_channels, connected = session_registry.take(session_id) if len(session_id) > 0 else (None, {}, False)
+        if old is None:
+            self.session_id = os.urandom(8).hex()
+            offsets = []
+        else:
+            if connected:
+                # the old connection is not noticed dead yet
+                for old_chan in old_channels.values():
+                    old_chan.detach_spool()
+                old.drop_connection()
+            self.session_id = session_id
+            for channel, old_chan in old_channels.items():
+                chan = self.channels.get(channel) or self.open_channel(channel)
+                chan.adopt_channel(old_chan)
+            logger.info('client.%d session %s resumed from client.%d' % (self.client_id, self.session_id, old.client_id))
+        channels = [self.channels[channel] for channel in sorted(self.channels)]
+        for chan in channels:
+            if chan.spool is None:
+                chan.spool = UartSpool(self.session_spool)
+        session_registry.attach(self)
+        with contextlib.ExitStack() as stack:
+            for chan in channels:
+                stack.enter_context(chan.spool.lock)
+                stack.enter_context(chan.flow_lock)
+            starts = [chan.spool.read_from(offsets[idx] if idx < len(offsets) else 0)[0] for idx, chan in enumerate(channels)]
+            self.send_packet('session', '%s:%s' % (self.session_id, ','.join(str(start) for start in starts)))
+            for chan, start in zip(channels, starts):
+                chan.replay_spool(start)
+
+    def adopt_channel(self, old):
+        # uart and spool of the same channel of the old session, the uart stays open
+        self.uart_dev = old.uart_dev
+        self.uart_path = old.uart_path
+        self.uart_baud = old.uart_baud
+        self.is_running = old.is_running
+        self.spool = old.spool
+        old.uart_dev = None
+        if self.uart_dev is not None:
+            uart_registry.replace(self.uart_dev, old, self)
+
+    def replay_spool(self, start:int):
+        # spool lock and flow_lock must be held, live bytes follow the replayed ones
+        _, backlog = self.spool.read_from(start)
+        if len(backlog) > 0:
+            self.metrics.count('session_replay_bytes', len(backlog))
+            if self.flow_enable:
+                # in front of pending bytes, already spooled
+                self.rx_pending[:0] = backlog
+                self.rx_replayed += len(backlog)
+                self.flush_pending()
+            else:
+                self.send_packet('data', self.compressor.compress(backlog) if self.compressor is not None else backlog)
+        self.spool.owner = self
+
+    def detach_spool(self):
+        # from now on the uart reader spools, bytes waiting for credit too
+        if self.spool is None:
+            return
+        with self.spool.lock:
+            self.spool.owner = None
+            with self.flow_lock:
+                self.spool.append(self.rx_pending[self.rx_replayed:])
+                self.rx_pending = bytearray()
+                self.rx_replayed = 0
+                self.flow_enable = False
+
+    def drop_connection(self):
+        try:
+            if isinstance(self.request, socket.socket):
+                self.request.shutdown(socket.SHUT_RDWR)
+            else:
+                self.request.close()
+        except OSError as ex1:
+            logger.debug('client.%d drop err: %s' % (self.client_id, str(ex1)))
+
+    def close_session(self):
+        if self.session_id is not None and self.session_linger > 0:
+            for chan in list(self.channels.values()):
+                chan.detach_spool()
+            if session_registry.detach(self, self.session_linger):
+                return
+        self.close_channels()
+
+    def uart_lost(self, msg):
+        self.error(msg)
+        self.is_running = False
+        self.uart_close()
     
     def handle_packet(self, new_packet: Packet):
         if not isinstance(new_packet, Packet):
@@ -296,9 +2417,82 @@ class WirelessUartClientHandler(socketserver.BaseRequestHandler):
                 self.error('service is not running.')
             elif new_packet.data_size <= 0:
                 self.error('recv empty data.')
+            elif self.compressor is not None:
+                try:
+                    val_bytes = self.compressor.decompress(new_packet.val_bytes)
+                    self.metrics.count('uart_tx_bytes', len(val_bytes))
+                    self.uart_dev.write(val_bytes, self)
+                except zlib.error as ex1:
+                    self.error('decompress fail: ' + str(ex1))
             else:
-                self.uart_dev.write(new_packet.val_bytes)
-                self.uart_dev.flush()
+                self.metrics.count('uart_tx_bytes', len(new_packet.val_bytes))
+                self.uart_dev.write(new_packet.val_bytes, self)
+        elif new_packet.key_str == 'flow':
+            try:
+                window = int(new_packet.val_bytes.decode())
+            except:
+                self.error('flow window invalid.')
+                return
+            if self.flow_window <= 0 or window <= 0:
+                self.error('flow control disabled.')
+                return
+            self.send_packet('flow', self.flow_window)
+            with self.flow_lock:
+                self.flow_peer_window = window
+                self.send_credit = window
+                self.recv_consumed = 0
+                self.flow_enable = True
+            logger.info('client.%d flow window %d/%d' % (self.client_id, window, self.flow_window))
+        elif new_packet.key_str == 'credit':
+            try:
+                credit = int(new_packet.val_bytes.decode())
+            except ValueError:
+                self.error('credit invalid.')
+                return
+            # never more than the window the client gave, nor without one
+            if credit <= 0 or credit > self.flow_peer_window:
+                self.error('credit invalid.')
+                return
+            self.add_credit(credit)
+        elif new_packet.key_str == 'compress':
+            self.set_compress(new_packet.val_bytes.decode())
+        elif new_packet.key_str == 'proto':
+            try:
+                version = max(min(int(new_packet.val_bytes.decode()), self.proto_max), 1)
+            except:
+                self.error('proto invalid.')
+                return
+            # reply in current version, then switch
+            self.send_packet('proto', version)
+            self.set_proto(version)
+        elif new_packet.key_str == 'frame':
+            try:
+                peer_frame_max = int(new_packet.val_bytes.decode())
+            except ValueError:
+                self.error('frame invalid.')
+                return
+            if peer_frame_max < PacketStreamDecoder.FRAME_MIN:
+                self.error('frame invalid.')
+                return
+            self.send_packet('frame', self.frame_max)
+            for chan in self.channels.values():
+                chan.peer_frame_max = peer_frame_max
+            logger.info('client.%d frame max %d/%d' % (self.client_id, peer_frame_max, self.frame_max))
+        elif new_packet.key_str == 'mux':
+            try:
+                count = min(int(new_packet.val_bytes.decode()), self.mux_max, Packet.CHANNEL_MAX + 1)
+            except ValueError:
+                self.error('mux invalid.')
+                return
+            if self.proto_version < 2:
+                self.error('mux needs proto v2.')
+                return
+            for channel in range(len(self.channels), count):
+                self.open_channel(channel)
+            self.send_packet('mux', len(self.channels))
+            logger.info('client.%d mux %d channels' % (self.client_id, len(self.channels)))
+        elif new_packet.key_str == 'session':
+            self.open_session(new_packet.val_bytes.decode())
         elif new_packet.key_str == 'error':
             logger.error('[!] client.%d recv err: %s' % (self.client_id, new_packet.val_bytes.decode()))
         else:
@@ -313,57 +2507,509 @@ class WirelessUartClientHandler(socketserver.BaseRequestHandler):
             elif isinstance(val, str):
                 self.send_packet(key_str, val.encode())
             else:
-                val_bytes = bytes(val)
+                # any bytes-like, serialized right here so a memoryview is not copied before
+                val_bytes = val
                 # # if end with \r, append \n
                 # if len(val_bytes) > 0 and val_bytes[-1] == 0x0d:
                 #     val_bytes += b'\n'
                 pack = Packet(key_str, val_bytes)
-                if self.data_encode:
-                    pack.do_encode()
-                raw_bytes = pack.get_bytes()
-                logger.debug("Packet Send!")
-                logger.debug(str(pack))
-                logger.debug("raw=0x" + raw_bytes.hex())
-                self.request.sendall(raw_bytes)
+                parts = self.packet_parts(pack)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Packet Send!")
+                    logger.debug(str(pack))
+                    logger.debug("raw=0x" + b''.join(parts).hex())
+                self.send_parts(parts, key_str == 'data')
         except Exception as ex1:
             logger.error('send packet err: ' + str(ex1))
+
+    """
+    socket sender (thread engine): every frame goes through send_queue to the
+    sender thread of the connection, so the shared uart reader never waits on
+    a slow or stalled client, and frames keep the order they were made in,
+    which compressed streams need. a client that lets more than
+    [send_queue_bytes] pile up is disconnected, dropping frames would break its
+    stream.
+    """
+    def send_parts(self, parts, delay:bool=False):
+        # parts of one frame, data frames are delayed by the coalescing window if any
+        size = 0
+        for part in parts:
+            size += len(part)
+        if self.send_failed:
+            return
+        if len(self.send_queue) > 0 and len(self.send_queue) + size > self.send_queue.limit:
+            self.send_fail('[!] client.%d send queue full (%d bytes), disconnect' % (self.client_id, len(self.send_queue)))
+            return
+        self.send_queue.put((parts, delay), size, block=False)
+
+    def send_fail(self, msg:str):
+        # every channel stops queueing, the connection is dropped once
+        if self.send_failed:
+            return
+        for chan in self.channels.values():
+            chan.send_failed = True
+        logger.error(msg)
+        self.drop_connection()
+
+    def send_forever(self):
+        while True:
+            items, _ = self.send_queue.get_batch(self.coalesce_bytes)
+            parts = []
+            delay = True
+            for item in items:
+                if item is not None:
+                    parts += item[0]
+                    delay = delay and item[1]
+            if len(parts) > 0 and not self.send_failed:
+                try:
+                    self.coalescer.send(parts, delay, len(items) - (items[-1] is None))
+                except Exception as ex1:
+                    self.send_fail('client.%d send err: %s' % (self.client_id, str(ex1)))
+            if items[-1] is None:
+                return
+
+    def packet_parts(self, pack:Packet):
+        # data encode is only for v1, v2 is binary safe
+        pack.channel = self.channel
+        encode = self.data_encode and self.proto_version < 2
+        size = min(self.frame_max, self.peer_frame_max) - PacketStreamDecoder.FRAGMENT_ROOM
+        if encode:
+            # encode takes up to 4 bytes per byte
+            size //= 4
+        if len(pack.val_bytes) > size:
+            return self.fragment_parts(pack, size)
+        if encode:
+            pack.do_encode()
+        return pack.get_parts(self.proto_version)
+
+    def fragment_parts(self, pack:Packet, size:int):
+        # parts of all pieces in one list, so no other packet is sent between them
+        key_str = 'data' if pack.key_str == 'data' and self.compressor is None else 'more'
+        view = memoryview(pack.val_bytes)
+        parts = []
+        while len(view) > size:
+            parts += self.packet_parts(Packet(key_str, view[:size]))
+            view = view[size:]
+        parts += self.packet_parts(Packet(pack.key_str, view))
+        self.metrics.count('fragmented_packets')
+        return parts
+
+    def set_proto(self, version:int):
+        if version != self.proto_version:
+            logger.info('client.%d proto v%d' % (self.client_id, version))
+        for chan in self.channels.values():
+            chan.proto_version = version
+        self.decoder.version = version
+
+    def set_compress(self, method:str):
+        global compress_enable, compress_dict
+        zdict = compress_dict if compress_dict is not None else StreamCompressor.DEFAULT_DICT
+        if not compress_enable or not method.startswith('zlib'):
+            accept = 'none'
+        elif method.startswith('zlib:') and method == StreamCompressor.dict_method(zdict):
+            accept = method
+        else:
+            # unknown dictionary, still able to compress without it
+            accept = 'zlib'
+        self.send_packet('compress', accept)
+        self.compressor = StreamCompressor(accept, zdict) if accept != 'none' else None
+        logger.info('client.%d compress %s' % (self.client_id, accept))
+
+    """
+    credit flow control (negotiated by 'flow' packet with window bytes)
+    - sender: uart rx bytes wait in rx_pending until client gives credit, the
+      pending buffer is bounded, oldest bytes are dropped when it overflows so
+      a slow client never stalls the shared uart reader.
+    - receiver: bytes written to uart are given back by 'credit' packet, once
+      at least a quarter of window is consumed.
+    credit counts uart payload bytes, before compression and encoding.
+    """
+    def send_data(self, rx_bytes:bytes):
+        with self.flow_lock:
+            self.rx_pending += rx_bytes
+            # replayed bytes are bounded by the spool, not dropped here
+            overflow = len(self.rx_pending) - self.rx_replayed - self.rx_pending_limit
+            if overflow > 0:
+                del self.rx_pending[self.rx_replayed:self.rx_replayed+overflow]
+                self.rx_dropped += overflow
+            if len(self.rx_pending) > self.rx_pending_hwm:
+                self.rx_pending_hwm = len(self.rx_pending)
+            self.flush_pending()
+
+    def add_credit(self, size:int):
+        with self.flow_lock:
+            self.send_credit += size
+            self.flush_pending()
+
+    def flush_pending(self):
+        # flow_lock must be held
+        size = min(self.send_credit, len(self.rx_pending))
+        if size <= 0:
+            return
+        self.send_credit -= size
+        val_bytes = self.rx_pending[:size]
+        del self.rx_pending[:size]
+        if self.spool is not None:
+            # replayed bytes are spooled already
+            replayed = min(size, self.rx_replayed)
+            self.rx_replayed -= replayed
+            self.spool.append(memoryview(val_bytes)[replayed:])
+        if self.compressor is not None:
+            val_bytes = self.compressor.compress(val_bytes)
+        self.send_packet('data', val_bytes)
+
+    def uart_written(self, size:int):
+        if not self.flow_enable:
+            return
+        with self.flow_lock:
+            self.recv_consumed += size
+            if self.recv_consumed < self.flow_window // 4:
+                return
+            size = self.recv_consumed
+            self.recv_consumed = 0
+        self.send_packet('credit', size)
+
+    def log_summary(self):
+        for chan in self.channels.values():
+            metrics.close(chan.metrics)
+        if self.compressor is not None:
+            logger.info('client.%d compress %s' % (self.client_id, self.compressor.summary()))
+        if self.flow_enable:
+            logger.info('client.%d queue rx pending hwm %d/%d, dropped %d' % (
+                self.client_id, self.rx_pending_hwm, self.rx_pending_limit, self.rx_dropped))
+
+    def handle_recv(self, recv_raw:bytes):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("recv:0x" + recv_raw.hex())
+        self.metrics.count('socket_rx_bytes', len(recv_raw))
+        if self.capture is not None:
+            self.capture.write(CaptureWriter.KIND_SOCKET_RX, self.client_id, recv_raw)
+        packets = 0
+        for packets, new_packet in enumerate(self.decoder.feed(recv_raw), 1):
+            if self.data_encode and self.proto_version < 2:
+                new_packet.do_decode()
+            if new_packet.channel == 0 or new_packet.key_str in self.CONNECTION_KEYS:
+                self.handle_packet(new_packet)
+            elif new_packet.channel in self.channels:
+                self.channels[new_packet.channel].handle_packet(new_packet)
+            else:
+                self.error('channel %d not open.' % new_packet.channel)
+        self.metrics.count('socket_rx_packets', packets)
     
     def handle(self):
         logger.info('+++ client.%d join %s +++' % (self.client_id, str(self.client_address)))
+        if isinstance(self.request, socket.socket):
+            # small credit/control packets must not wait for the delayed ack of the last one
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.coalescer = SendCoalescer(self.request, self.coalesce_sec, self.coalesce_bytes, self.metrics,
+                                       self.capture, self.client_id)
+        self.sender = threading.Thread(target=self.send_forever, daemon=True)
+        self.sender.start()
         try:
             while self.request:
-                ready = select.select([self.request], [], [], self.recv_timeout)
-                if ready[0]:
-                    recv_raw = self.request.recv(self.buf_size).strip()
-                    if recv_raw is not None and len(recv_raw) > 0:
-                        logger.debug("recv:0x" + recv_raw.hex())
-                        self.recv_buffer += recv_raw
-                        while self.recv_buffer.find(Packet.SYMBOL_START_BYTES) >= 0:
-                            new_packet = Packet.parse(self.recv_buffer)
-                            if new_packet is not None:
-                                if self.data_encode:
-                                    new_packet.do_decode()
-                                self.recv_buffer = self.recv_buffer[2+4+1+new_packet.data_size:]
-                                self.handle_packet(new_packet)
-                            else:
-                                break
-                        # make sure that start symbol not exists and last byte do not possentially being a start symbol
-                        if len(self.recv_buffer) > 0 and \
-                            self.recv_buffer.find(Packet.SYMBOL_START_BYTES) < 0 and \
-                            self.recv_buffer[-1] != (Packet.PACKET_MIN & 0xFF):
-                            self.recv_buffer = bytearray()
-                if isinstance(self.uart_dev, serial.Serial) and self.uart_dev.in_waiting > 0:
-                    rx_bytes = self.uart_dev.read_all() # always read to avoid too many data hanged
-                    if self.is_running and rx_bytes != None and len(rx_bytes) > 0:
-                        self.send_packet('data', rx_bytes)
+                recv_raw = self.request.recv(self.buf_size)
+                if recv_raw is None or len(recv_raw) == 0:
+                    # connection closed by client
+                    break
+                self.handle_recv(recv_raw)
         except Exception as ex1:
             logger.error("client.%d err: %s" % (self.client_id, str(ex1)))
+        self.close_session()
+        self.send_queue.put(None, 0, block=False)
+        self.sender.join()
+        self.coalescer.close()
+        self.log_summary()
         logger.info('--- client.%d exit %s ---' % (self.client_id, str(self.client_address)))
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+"""
+asyncio engine
+every client socket and every opened uart fd are registered on one event loop,
+socket bytes come from data_received(), uart bytes are read only when the fd is
+readable (UartDevice uses loop.add_reader), so no timeout polling and no thread
+per client.
+uart fd readiness relies on selectors, so this engine is for posix hosts only.
+"""
+class AsyncWirelessUartClientHandler(WirelessUartClientHandler, asyncio.Protocol):
+    # no request and server here, the transport is the socket
+    CHANNEL_SHARED = tuple(name for name in WirelessUartClientHandler.CHANNEL_SHARED if name not in ('request', 'server')) \
+        + ('loop_thread', 'transport')
+
+    def __init__(self):
+        self.init_session()
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self.transport = None
+        self.client_address = None
+        # no coalescer here, same totals and sampling as SendCoalescer
+        self.tx_bytes = 0
+        self.tx_packets = 0
+        self.metrics.gauge('socket_tx_bytes', lambda: self.tx_bytes, 'counter')
+        self.metrics.gauge('socket_tx_packets', lambda: self.tx_packets, 'counter')
+
+    def pause_reading(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.pause_reading()
+            self.metrics.count('socket_read_pauses')
+
+    def resume_reading(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        logger.info('+++ client.%d join %s +++' % (self.client_id, str(self.client_address)))
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.error("client.%d err: %s" % (self.client_id, str(exc)))
+        self.close_session()
+        self.log_summary()
+        logger.info('--- client.%d exit %s ---' % (self.client_id, str(self.client_address)))
+
+    def drop_connection(self):
+        self.transport.abort()
+
+    def data_received(self, recv_raw):
+        try:
+            self.handle_recv(recv_raw)
+        except Exception as ex1:
+            logger.error("client.%d err: %s" % (self.client_id, str(ex1)))
+            self.transport.close()
+
+    def send_parts(self, parts, delay:bool=False):
+        # the transport buffers while the socket is busy, no coalescing window here
+        if threading.get_ident() != self.loop_thread:
+            # from uart writer thread (credit), transport is not thread safe
+            self.loop.call_soon_threadsafe(self.send_parts, parts, delay)
+        elif self.transport is not None and not self.transport.is_closing():
+            # totals of the connection, kept by channel 0
+            root = self.channels[0]
+            root.tx_packets += 1
+            if root.tx_packets % SendCoalescer.SAMPLE != 0:
+                self.transport.writelines(parts)
+            else:
+                start = time.perf_counter()
+                self.transport.writelines(parts)
+                root.metrics.observe('socket_send_seconds', time.perf_counter() - start)
+            size = 0
+            for part in parts:
+                size += len(part)
+            if self.capture is not None:
+                self.capture.write(CaptureWriter.KIND_SOCKET_TX, self.client_id, b''.join(parts))
+            root.tx_bytes += size
+
+
+"""
+UDP server
+one udp socket for all clients, datagrams are dispatched by (address, session
+id) to a ReliableUdpChannel, each new session runs the same client handler in
+its own thread with the channel as the request socket.
+"""
+class UdpServer:
+    def __init__(self, server_address, handler_class, loss:float=0.0, reorder:float=0.0):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.server_address = self.socket.getsockname()
+        self.handler_class = handler_class
+        self.shim = LossyDatagramShim(self.socket, loss, reorder) if loss > 0 or reorder > 0 else None
+        self.sessions = {}
+
+    def serve_forever(self):
+        while True:
+            datagram, addr = self.socket.recvfrom(0x10000)
+            if len(datagram) < ReliableUdpChannel.HEADER.size:
+                continue
+            kind, session_id, _ = ReliableUdpChannel.HEADER.unpack_from(datagram)
+            channel = self.sessions.get((addr, session_id))
+            if channel is None:
+                if kind == ReliableUdpChannel.TYPE_FIN:
+                    continue
+                channel = ReliableUdpChannel(self.socket, addr, session_id, self.shim)
+                channel.on_close = lambda key=(addr, session_id): self.sessions.pop(key, None)
+                self.sessions[(addr, session_id)] = channel
+                threading.Thread(target=self.process_session, args=(channel, addr), daemon=True).start()
+            channel.receive_datagram(datagram)
+
+    def process_session(self, channel, addr):
+        try:
+            self.handler_class(channel, addr, self)
+        finally:
+            channel.close()
+
+
+async def serve_asyncio(host:str, port:int, reuse_port:bool=False):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(AsyncWirelessUartClientHandler, host, port, reuse_address=True,
+                                      reuse_port=reuse_port or None)
+    logger.info("+++ start server %s (asyncio) +++" % str(server.sockets[0].getsockname()))
+    async with server:
+        await server.serve_forever()
+
+
+def run_server(reuse_port:bool=False):
+    if transport_mode == 'udp':
+        if server_engine != 'thread':
+            raise ValueError('udp transport supports thread engine only')
+        server = UdpServer((server_host, server_port), WirelessUartClientHandler, udp_loss, udp_reorder)
+        logger.info("+++ start server %s (udp) +++" % str(server.server_address))
+        server.serve_forever()
+    elif server_engine == 'asyncio':
+        asyncio.run(serve_asyncio(server_host, server_port, reuse_port))
+    else:
+        socketserver.TCPServer.allow_reuse_address = True
+        ThreadedTCPServer.reuse_port = reuse_port
+        server = ThreadedTCPServer((server_host, server_port), WirelessUartClientHandler)
+        logger.info("+++ start server %s +++" % str(server.server_address))
+        server.serve_forever()
+
+
+"""
+Worker Supervisor
+--workers N pre-forks N server processes, each one binds its own listening
+socket to the same port with SO_REUSEPORT and the kernel spreads new
+connections over them, so sessions run on N cores instead of behind one GIL.
+posix hosts with SO_REUSEPORT only, tcp transport only, since reliable udp
+sessions are kept in one process.
+- every worker holds a socketpair to the supervisor, sends a metrics snapshot
+  line on it every metrics interval, and exits when the supervisor is gone
+- a dead worker is restarted after RESTART_DELAY_SEC, doubled up to
+  RESTART_DELAY_MAX_SEC while it keeps dying within STABLE_SEC
+- metrics endpoint and dump run in the supervisor only, worker sessions are
+  named 'wN/<session>', a restarted worker counts from zero again
+- each worker writes its own capture, [capture].wN
+- the uart registry is per process, clients sharing one uart path may land on
+  different workers and open it twice, so give every client its own uart
+- no sessions, a reconnect lands on any worker while a lingering session of
+  another one still reads the uart
+"""
+class WorkerSupervisor:
+    RESTART_DELAY_SEC = 1.0
+    RESTART_DELAY_MAX_SEC = 30.0
+    STABLE_SEC = 10.0
+
+    def __init__(self, count:int, report_sec:float, metrics_server=None):
+        self.count = count
+        self.report_sec = report_sec
+        self.metrics_server = metrics_server
+        self.workers = {} # pid -> (worker id, supervisor side socket, start time)
+        self.delays = [WorkerSupervisor.RESTART_DELAY_SEC] * count
+        self.metrics = metrics.session('supervisor')
+        self.metrics.gauge('workers', lambda: len(self.workers))
+
+    def spawn(self, worker_id:int):
+        supervisor_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            supervisor_sock.close()
+            code = 0
+            try:
+                self.run_worker(worker_id, worker_sock)
+            except BaseException as ex1:
+                logger.error('[!] worker %d err: %s' % (worker_id, str(ex1)))
+                code = 1
+            finally:
+                os._exit(code)
+        worker_sock.close()
+        self.workers[pid] = (worker_id, supervisor_sock, time.monotonic())
+        threading.Thread(target=self.read_forever, args=(worker_id, supervisor_sock), daemon=True).start()
+        logger.info('+++ worker %d started, pid %d +++' % (worker_id, pid))
+
+    def run_worker(self, worker_id:int, sock:socket.socket):
+        global capture
+        # drop what belongs to the supervisor
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for _, supervisor_sock, _ in self.workers.values():
+            supervisor_sock.close()
+        if self.metrics_server is not None:
+            self.metrics_server.socket.close()
+        metrics.lock = threading.Lock()
+        metrics.sessions = {}
+        threading.Thread(target=self.report_forever, args=(worker_id, sock), daemon=True).start()
+        if len(capture_path) > 0:
+            capture = CaptureWriter('%s.w%d' % (capture_path, worker_id))
+        try:
+            run_server(reuse_port=True)
+        finally:
+            if capture is not None:
+                capture.close()
+
+    def report_forever(self, worker_id:int, sock:socket.socket):
+        # the supervisor never writes, recv returns only when it is gone
+        sock.settimeout(self.report_sec if self.report_sec > 0 else None)
+        while True:
+            try:
+                if len(sock.recv(1)) == 0:
+                    break
+            except socket.timeout:
+                try:
+                    sock.sendall(json.dumps(metrics.snapshot()).encode() + b'\n')
+                except socket.timeout:
+                    pass
+            except OSError:
+                break
+        logger.error('[!] worker %d lost supervisor, exit.' % worker_id)
+        os._exit(1)
+
+    def read_forever(self, worker_id:int, sock:socket.socket):
+        prefix = 'w%d/' % worker_id
+        try:
+            with sock.makefile('rb') as lines:
+                for line in lines:
+                    try:
+                        metrics.load(prefix, json.loads(line))
+                    except (ValueError, KeyError):
+                        # a line cut by a send timeout, the next one is whole
+                        pass
+        except OSError:
+            pass
+        metrics.load(prefix, {})
+
+    def serve_forever(self):
+        for worker_id in range(self.count):
+            self.spawn(worker_id)
+        try:
+            while True:
+                pid, status = os.wait()
+                if pid not in self.workers:
+                    continue
+                worker_id, supervisor_sock, start = self.workers.pop(pid)
+                supervisor_sock.close()
+                if time.monotonic() - start > WorkerSupervisor.STABLE_SEC:
+                    self.delays[worker_id] = WorkerSupervisor.RESTART_DELAY_SEC
+                delay = self.delays[worker_id]
+                self.delays[worker_id] = min(delay * 2, WorkerSupervisor.RESTART_DELAY_MAX_SEC)
+                logger.error('[!] worker %d (pid %d) exit %d, restart in %.1f sec' % (
+                    worker_id, pid, os.waitstatus_to_exitcode(status), delay))
+                self.metrics.count('worker_restarts')
+                time.sleep(delay)
+                self.spawn(worker_id)
+        finally:
+            for pid in self.workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in self.workers:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            logger.info('--- workers stopped ---')
 
 
 if __name__ == "__main__":
@@ -403,31 +3049,274 @@ if __name__ == "__main__":
             type=int,
             help='Set Socket Receive Buffer Size (Default %dKB)' % (socket_buffer_size / 1024))
         parser.add_argument(
-            "-t",
-            "--recv_timeout",
-            default=recv_timeout_sec,
+            "-g",
+            "--engine",
+            default=server_engine,
+            choices=['thread', 'asyncio'],
+            help='Set Server Engine, asyncio runs all clients on one event loop, posix only (Default %s)' % server_engine)
+        parser.add_argument(
+            "-P",
+            "--proto",
+            default=proto_version,
+            type=int,
+            choices=[1, 2, 3],
+            help='Set Max Packet Protocol Version Accepted From Clients (Default %d)' % proto_version)
+        parser.add_argument(
+            "-nz",
+            "--no_compress",
+            default=not compress_enable,
+            action='store_true',
+            help='Set Compression Requested By Clients Disable (Default Enable)')
+        parser.add_argument(
+            "-zd",
+            "--compress_dict",
+            default='',
+            type=str,
+            help='Set Compression Preset Dictionary File, Same As Clients (Default Built-in Log Dictionary)')
+        parser.add_argument(
+            "-w",
+            "--flow_window",
+            default=flow_window,
+            type=int,
+            help='Set Flow Control Window Bytes Offered To Clients, 0 To Disable (Default %d)' % flow_window)
+        parser.add_argument(
+            "-q",
+            "--client_queue",
+            default=client_queue_bytes,
+            type=int,
+            help='Set Max Pending Uart Bytes Per Flow Controlled Client, Oldest Dropped (Default %d)' % client_queue_bytes)
+        parser.add_argument(
+            "-sq",
+            "--send_queue",
+            default=send_queue_bytes,
+            type=int,
+            help='Set Max Queued Socket Bytes Per Thread Engine Client, Client Disconnected When Full (Default %d)' % send_queue_bytes)
+        parser.add_argument(
+            "-T",
+            "--transport",
+            default=transport_mode,
+            choices=['tcp', 'udp'],
+            help='Set Transport, udp uses selective ack and retransmission, thread engine only (Default %s)' % transport_mode)
+        parser.add_argument(
+            "--udp_loss",
+            default=udp_loss,
+            type=float,
+            help='Set Simulated UDP Send Loss Rate For Testing (Default %.2f)' % udp_loss)
+        parser.add_argument(
+            "--udp_reorder",
+            default=udp_reorder,
+            type=float,
+            help='Set Simulated UDP Send Reorder Rate For Testing (Default %.2f)' % udp_reorder)
+        parser.add_argument(
+            "-m",
+            "--metrics_port",
+            default=metrics_port,
+            type=int,
+            help='Set Local Port For Prometheus /metrics And /metrics.json, 0 To Disable (Default %d)' % metrics_port)
+        parser.add_argument(
+            "-md",
+            "--metrics_dump",
+            default=metrics_dump,
+            type=str,
+            help='Set Json File Metrics Are Dumped To Periodically (Default None)')
+        parser.add_argument(
+            "-mi",
+            "--metrics_interval",
+            default=metrics_interval_sec,
+            type=float,
+            help='Set Metrics Dump Interval Seconds (Default %.1f)' % metrics_interval_sec)
+        parser.add_argument(
+            "-nm",
+            "--no_metrics",
+            default=False,
+            action='store_true',
+            help='Set Metrics Disable, Every Metrics Hook Is A No-op (Default Enable)')
+        parser.add_argument(
+            "-cap",
+            "--capture",
+            default='',
+            type=str,
+            help='Set Binary Capture File Of Socket And Uart Bytes, Read By tools/wireless_uart_replay.py (Default None)')
+        parser.add_argument(
+            "-W",
+            "--workers",
+            default=server_workers,
+            type=int,
+            help='Set Worker Processes Sharing The Port By SO_REUSEPORT, 0 For Single Process (Default %d)' % server_workers)
+        parser.add_argument(
+            "-cw",
+            "--coalesce_ms",
+            default=coalesce_ms,
+            type=float,
+            help='Set Max Ms Data Packets Wait To Be Sent Together In One Syscall, 0 To Send At Once, Thread Engine Only (Default %.1f)' % coalesce_ms)
+        parser.add_argument(
+            "-cb",
+            "--coalesce_bytes",
+            default=coalesce_bytes,
+            type=int,
+            help='Set Pending Bytes That Send Coalesced Data Packets Before --coalesce_ms (Default %d)' % coalesce_bytes)
+        parser.add_argument(
+            "-fm",
+            "--frame_max",
+            default=frame_max_bytes,
+            type=int,
+            help='Set Max Data Bytes Of One Packet, Longer Ones Are Resynced And Sent In Pieces (Default %d)' % frame_max_bytes)
+        parser.add_argument(
+            "-fr",
+            "--reassembly_max",
+            default=reassembly_max_bytes,
+            type=int,
+            help='Set Max Bytes Of One Payload Joined From Pieces (Default %d)' % reassembly_max_bytes)
+        parser.add_argument(
+            "-mx",
+            "--mux_max",
+            default=mux_max,
+            type=int,
+            help='Set Max UART Channels Of One Connection (Default %d)' % mux_max)
+        parser.add_argument(
+            "-sl",
+            "--session_linger",
+            default=session_linger_sec,
             type=float,
-            help='Set Socket Receive Timeout Seconds (Default %.1f)' % recv_timeout_sec)
+            help='Set Seconds A Session Keeps UARTs Open After Its Connection Is Lost, 0 Disables Sessions, Single Process Only (Default %.1f)' % session_linger_sec)
+        parser.add_argument(
+            "-ss",
+            "--session_spool",
+            default=session_spool_bytes,
+            type=int,
+            help='Set UART Rx Bytes Kept Per Session Channel For Replay On Resume (Default %d)' % session_spool_bytes)
+        parser.add_argument(
+            "-k",
+            "--chunk",
+            default=chunk_mode,
+            choices=UartChunker.MODES,
+            help='Set How UART Rx Is Cut Into Data Packets, Per Read, On Idle Gap Or On Newline (Default %s)' % chunk_mode)
+        parser.add_argument(
+            "-kd",
+            "--chunk_device",
+            default=[],
+            action='append',
+            help='Set Chunk Mode Of One UART, PATH=CHUNK_MODE, Repeat For More (Default --chunk)')
+        parser.add_argument(
+            "-kg",
+            "--chunk_gap",
+            default=chunk_gap_chars,
+            type=float,
+            help='Set Idle Gap That Ends A Chunk In Character Times At The UART Baud (Default %.1f)' % chunk_gap_chars)
+        parser.add_argument(
+            "-ks",
+            "--chunk_size",
+            default=chunk_max_bytes,
+            type=int,
+            help='Set Max Bytes Of A Chunk (Default %d)' % chunk_max_bytes)
+        parser.add_argument(
+            "-ka",
+            "--chunk_age",
+            default=chunk_max_ms,
+            type=float,
+            help='Set Max Milliseconds The First Byte Of A Chunk Waits (Default %.1f)' % chunk_max_ms)
+        parser.add_argument(
+            "-pr",
+            "--pace_rate",
+            default=pace_rate,
+            type=float,
+            help='Set UART Write Pace As Ratio Of The Line Rate, 0 Writes As Fast As Accepted (Default %.1f)' % pace_rate)
+        parser.add_argument(
+            "-pb",
+            "--pace_burst",
+            default=pace_burst_bytes,
+            type=int,
+            help='Set UART Write Burst Bytes Without Pacing, The Target Rx Buffer Size (Default %d)' % pace_burst_bytes)
+        parser.add_argument(
+            "-pn",
+            "--pace_every",
+            default=pace_every_bytes,
+            type=int,
+            help='Set UART Write Bytes Between Pauses Of --pace_delay, 0 Disables (Default %d)' % pace_every_bytes)
+        parser.add_argument(
+            "-pd",
+            "--pace_delay",
+            default=pace_delay_ms,
+            type=float,
+            help='Set UART Write Pause Milliseconds After Every --pace_every Bytes (Default %.1f)' % pace_delay_ms)
 
         args = parser.parse_args()
 
         server_host = args.host
         server_port = args.port
         socket_buffer_size = args.buffer_size
-        recv_timeout_sec = args.recv_timeout
         debug_enable = args.debug
         data_encode = args.encode
+        server_engine = args.engine
+        proto_version = args.proto
+        compress_enable = not args.no_compress
+        flow_window = args.flow_window
+        client_queue_bytes = args.client_queue
+        send_queue_bytes = args.send_queue
+        transport_mode = args.transport
+        udp_loss = args.udp_loss
+        udp_reorder = args.udp_reorder
+        metrics_port = args.metrics_port
+        metrics_dump = args.metrics_dump
+        metrics_interval_sec = args.metrics_interval
+        metrics.enable = not args.no_metrics
+        capture_path = args.capture
+        server_workers = args.workers
+        coalesce_ms = args.coalesce_ms
+        coalesce_bytes = args.coalesce_bytes
+        frame_max_bytes = args.frame_max
+        if frame_max_bytes < PacketStreamDecoder.FRAME_MIN:
+            raise ValueError('frame_max must be at least %d' % PacketStreamDecoder.FRAME_MIN)
+        reassembly_max_bytes = args.reassembly_max
+        mux_max = args.mux_max
+        session_linger_sec = args.session_linger
+        session_spool_bytes = args.session_spool
+        chunk_mode = args.chunk
+        chunk_gap_chars = args.chunk_gap
+        chunk_max_bytes = args.chunk_size
+        chunk_max_ms = args.chunk_age
+        pace_rate = args.pace_rate
+        pace_burst_bytes = args.pace_burst
+        pace_every_bytes = args.pace_every
+        pace_delay_ms = args.pace_delay
+        for spec in args.chunk_device:
+            path, _, mode = spec.rpartition('=')
+            if mode not in UartChunker.MODES:
+                raise Exception('chunk device %s mode invalid' % spec)
+            chunk_devices[path] = mode
+        if len(args.compress_dict) > 0:
+            with open(args.compress_dict, 'rb') as dict_file:
+                compress_dict = dict_file.read()
         if debug_enable:
             logger.setLevel(logging.DEBUG)
             logger.warning('[!] Debug Mode Enable')
-        logger.debug("[!] config: host %s, port %d, buffer %d, timeout %.1f, debug %s" % (
-        server_host, server_port, socket_buffer_size, recv_timeout_sec, str(debug_enable)))
+        logger.debug("[!] config: host %s, port %d, buffer %d, debug %s, engine %s" % (
+        server_host, server_port, socket_buffer_size, str(debug_enable), server_engine))
 
-        socketserver.TCPServer.allow_reuse_address = True
-        server = ThreadedTCPServer((server_host, server_port), WirelessUartClientHandler)
-        logger.info("+++ start server %s +++" % str(server.server_address))
-        server.serve_forever()
+        metrics_server = None
+        if metrics_port > 0:
+            metrics_server = start_metrics_server(metrics_port)
+        if len(metrics_dump) > 0:
+            start_metrics_dump(metrics_dump, metrics_interval_sec)
+        if server_workers > 0:
+            if transport_mode == 'udp':
+                raise ValueError('workers support tcp transport only')
+            if session_linger_sec > 0:
+                raise ValueError('workers do not support sessions, set --session_linger 0')
+            if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+                raise ValueError('workers need fork and SO_REUSEPORT')
+            # SIGTERM unwinds the supervisor so it stops its workers
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            report_sec = min(metrics_interval_sec, 1.0) if metrics_server is not None or len(metrics_dump) > 0 else 0
+            WorkerSupervisor(server_workers, report_sec, metrics_server).serve_forever()
+        else:
+            if len(capture_path) > 0:
+                capture = CaptureWriter(capture_path)
+            run_server()
     except Exception as ex1:
         logger.error("[!] server running err: %s" % str(ex1))
         input("\n[!] Press key to exit...")
+    finally:
+        if capture is not None:
+            capture.close()
     logger.debug("--- on stop ---")
@@ -0,0 +1,36 @@
+import importlib.util
+import logging
+import os
+
+import pytest
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, rel_path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root_path, rel_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# both scripts keep their own copy of the shared classes, loaded once per test run
+modules = {'server': load_module('wireless_uart_server', 'server/wireless_uart_server.py'),
+           'client': load_module('wireless_uart_client', 'client/wireless_uart_client.py')}
+logging.getLogger().setLevel(logging.WARNING)
+
+
+@pytest.fixture(params=sorted(modules))
+def wuart(request):
+    # a test of the shared classes runs against the server and the client copy
+    return modules[request.param]
+
+
+@pytest.fixture
+def wuart_server():
+    return modules['server']
+
+
+@pytest.fixture
+def wuart_client():
+    return modules['client']
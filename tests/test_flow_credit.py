@@ -0,0 +1,52 @@
+import pytest
+
+bad_credits = [b'0', b'-5', b'1001', b'x']
+
+
+def server_handler(wuart_server):
+    handler = wuart_server.WirelessUartClientHandler.__new__(wuart_server.WirelessUartClientHandler)
+    handler.init_session()
+    return handler
+
+
+@pytest.mark.parametrize('val', bad_credits)
+def test_server_rejects_bad_credit(wuart_server, monkeypatch, val):
+    handler = server_handler(wuart_server)
+    errors = []
+    monkeypatch.setattr(handler, 'error', errors.append)
+    handler.flow_peer_window = 1000
+    handler.flow_enable = True
+    handler.handle_packet(wuart_server.Packet('credit', val))
+    assert errors == ['credit invalid.']
+    assert handler.send_credit == 0
+
+
+def test_server_takes_credit_within_window(wuart_server, monkeypatch):
+    handler = server_handler(wuart_server)
+    errors = []
+    monkeypatch.setattr(handler, 'error', errors.append)
+    handler.handle_packet(wuart_server.Packet('credit', b'10'))
+    # no window given, no credit taken
+    assert errors == ['credit invalid.']
+    handler.flow_peer_window = 1000
+    handler.flow_enable = True
+    handler.handle_packet(wuart_server.Packet('credit', b'1000'))
+    assert errors == ['credit invalid.']
+    assert handler.send_credit == 1000
+
+
+@pytest.mark.parametrize('val', bad_credits)
+def test_client_rejects_bad_credit(wuart_client, monkeypatch, val):
+    helper = wuart_client.WirelessUartConnectHelper('127.0.0.1', 1)
+    try:
+        errors = []
+        monkeypatch.setattr(helper, 'error', errors.append)
+        helper.flow_peer_window = 1000
+        helper.handle_packet(wuart_client.Packet('credit', val))
+        assert errors == ['credit invalid.']
+        assert helper.send_credit == 0
+        helper.handle_packet(wuart_client.Packet('credit', b'1000'))
+        assert errors == ['credit invalid.']
+        assert helper.send_credit == 1000
+    finally:
+        helper.close()
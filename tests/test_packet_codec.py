@@ -0,0 +1,25 @@
+import random
+
+import pytest
+
+# fast checksum/encode/decode against the bytewise reference
+rand = random.Random(1)
+samples = [rand.randbytes(size % 300) for size in range(2000)]
+
+
+def test_checksum_matches_bytewise(wuart):
+    for raw in samples:
+        assert wuart.Packet.calc_checksum(raw) == wuart.Packet.calc_checksum_bytewise(raw)
+
+
+def test_encode_decode_match_bytewise(wuart):
+    Packet = wuart.Packet
+    for raw in samples:
+        encoded = Packet.bytes_encode_bytewise(raw)
+        assert Packet.bytes_encode(raw) == encoded
+        assert Packet.bytes_decode(encoded) == Packet.bytes_decode_bytewise(encoded) == raw
+
+
+@pytest.mark.parametrize('raw', [b'\\', b'a\\qb', b'\\x4', b'\\X4F\\\\', b'\\x\\x41', b'\\x4\\'])
+def test_malformed_escape_matches_bytewise(wuart, raw):
+    assert wuart.Packet.bytes_decode(raw) == wuart.Packet.bytes_decode_bytewise(raw)
@@ -0,0 +1,20 @@
+def test_start_symbol_at_buffer_end(wuart):
+    decoder = wuart.PacketStreamDecoder(16, version=2)
+    assert list(decoder.feed(b'\x00' * 15 + wuart.Packet.SYMBOL_V2_BYTES)) == []
+
+
+def test_channel_header_split(wuart):
+    raw = b'\x00' * 13 + wuart.Packet('data', b'xyz', channel=3).get_bytes(2)
+    decoder = wuart.PacketStreamDecoder(16, version=2)
+    packets = []
+    for idx in range(len(raw)):
+        packets += decoder.feed(raw[idx:idx+1])
+    assert [(p.key_str, p.channel, bytes(p.val_bytes)) for p in packets] == [('data', 3, b'xyz')]
+
+
+def test_false_start_does_not_hold_packets(wuart):
+    # stray start symbol with a huge length, the packet behind it comes out at once
+    raw = b'\xa5\x01\xff\xff\x03\x5a' + wuart.Packet('data', b'abc').get_bytes(2)
+    decoder = wuart.PacketStreamDecoder(0x10000, version=2)
+    packets = list(decoder.feed(raw))
+    assert [(p.key_str, bytes(p.val_bytes)) for p in packets] == [('data', b'abc')]
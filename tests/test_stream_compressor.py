@@ -0,0 +1,16 @@
+import os
+
+
+def test_raw_fallback_keeps_contexts_in_sync(wuart):
+    text = b'[INFO] wifi sta connected, rssi -42, ip 192.168.0.10\r\n' * 8
+    frames = [text, os.urandom(300), text, os.urandom(0x12000), text, b'\x00', text]
+    for method in ('zlib', wuart.StreamCompressor.dict_method(wuart.StreamCompressor.DEFAULT_DICT)):
+        tx = wuart.StreamCompressor(method, wuart.StreamCompressor.DEFAULT_DICT)
+        rx = wuart.StreamCompressor(method, wuart.StreamCompressor.DEFAULT_DICT)
+        for raw in frames:
+            zip_bytes = tx.compress(raw)
+            assert len(zip_bytes) <= len(raw) + 1
+            assert rx.decompress(zip_bytes) == raw
+        assert tx.tx_raw_blocks == 3
+        # text after the raw blocks still refers back to the history
+        assert len(tx.compress(text)) < len(text) // 4
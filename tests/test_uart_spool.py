@@ -0,0 +1,19 @@
+import time
+
+
+def test_failed_send_keeps_record(wuart_client, tmp_path, monkeypatch):
+    path = str(tmp_path / 'uart.spool')
+    monkeypatch.setattr(wuart_client, 'spool_path', path)
+    helper = wuart_client.WirelessUartConnectHelper('127.0.0.1', 1)
+    try:
+        helper.spool.append(b'spooled while offline\r\n', time.time())
+        # never connected, the socket takes nothing
+        helper.is_running = True
+        helper.spool_send_forever()
+        assert len(helper.spool) == wuart_client.UartSpoolFile.RECORD.size + 23
+    finally:
+        helper.spool.close()
+        helper.close()
+    spool = wuart_client.UartSpoolFile(path, wuart_client.spool_bytes)
+    assert spool.read(0x100)[1] == b'spooled while offline\r\n'
+    spool.close()
@@ -0,0 +1,1140 @@
+import argparse
+import binascii
+import collections
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import select
+import selectors
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import tty
+
+app_version = '0.1'
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, rel_path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root_path, rel_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logging.getLogger().setLevel(logging.WARNING)
+    return module
+
+
+"""
+decoder benchmark
+a burst of [backlog] bytes made of small packets is received in [chunk] bytes
+pieces, the decoder should keep the same per-byte cost no matter how large the
+burst is, the legacy recv_buffer reslicing way copies the rest of the buffer
+after every packet found, which is quadratic.
+"""
+def legacy_feed(wuart, recv_buffer, recv_raw):
+    recv_buffer += recv_raw
+    while recv_buffer.find(wuart.Packet.SYMBOL_START_BYTES) >= 0:
+        new_packet = None
+        raw_bytes = recv_buffer
+        while len(raw_bytes) >= wuart.Packet.PACKET_MIN:
+            start_idx = raw_bytes.find(wuart.Packet.SYMBOL_START_BYTES)
+            if start_idx > 0:
+                raw_bytes = raw_bytes[start_idx:]
+                continue
+            _, data_size = struct.unpack('<1H1I', raw_bytes[:6])
+            if len(raw_bytes) < 6+1+data_size:
+                break
+            data_bytes = raw_bytes[6:6+data_size]
+            if wuart.Packet.calc_checksum(data_bytes) == raw_bytes[6+data_size]:
+                split_idx = data_bytes.find(b'=')
+                new_packet = wuart.Packet(data_bytes[:split_idx].decode(), data_bytes[split_idx+1:])
+                break
+            raw_bytes = raw_bytes[2:]
+        if new_packet is None:
+            break
+        recv_buffer = recv_buffer[2+4+1+new_packet.data_size:]
+    return recv_buffer
+
+
+def bench_decoder(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+    raw = wuart.Packet('data', os.urandom(args.size)).get_bytes()
+    print('%10s %16s %16s' % ('backlog', 'decoder ns/byte', 'legacy ns/byte'))
+    for backlog in args.backlog:
+        count = max(backlog // len(raw), 1)
+        burst = raw * count
+        chunks = [burst[i:i+args.chunk] for i in range(0, len(burst), args.chunk)]
+        decoder = wuart.PacketStreamDecoder(args.buffer_size)
+        start = time.perf_counter()
+        found = 0
+        for chunk in chunks:
+            for _ in decoder.feed(chunk):
+                found += 1
+        decoder_cost = (time.perf_counter() - start) * 1e9 / len(burst)
+        assert found == count
+        legacy_cost = float('nan')
+        if backlog <= args.legacy_max:
+            recv_buffer = bytearray()
+            start = time.perf_counter()
+            for chunk in chunks:
+                recv_buffer = legacy_feed(wuart, recv_buffer, chunk)
+            legacy_cost = (time.perf_counter() - start) * 1e9 / len(burst)
+        print('%10d %16.2f %16.2f' % (len(burst), decoder_cost, legacy_cost))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if len(values) == 0:
+        return float('nan')
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+"""
+client latency benchmark
+client local uart is a pty pair, server is a plain socket inside this script,
+one byte is written into the pty and the time until its data packet arrives at
+the server is measured, legacy mode is the 10 ms select + in_waiting polling.
+"""
+def bench_client_latency(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+
+    class LegacyConnectHelper(wuart.WirelessUartConnectHelper):
+        POLL_SEC = 0.01 # the select timeout legacy polling used
+
+        def handle(self):
+            try:
+                while self.is_running:
+                    ready = select.select([self], [], [], self.POLL_SEC)
+                    if ready[0]:
+                        recv_raw = self.recv(self.buf_size)
+                        if len(recv_raw) == 0:
+                            break
+                    if self.uart_dev.in_waiting > 0:
+                        self.send_packet('data', self.uart_dev.read_all())
+            except Exception:
+                pass
+            self.is_running = False
+
+    print('%8s %10s %10s %10s %10s' % ('mode', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for mode in args.mode:
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        listener = socket.create_server(('127.0.0.1', 0))
+        wuart.uart_local_path = os.ttyname(slave)
+        wuart.proto_version = 1
+        wuart.flow_window = 0
+        wuart.session_enable = False
+        helper_class = LegacyConnectHelper if mode == 'legacy' else wuart.WirelessUartConnectHelper
+        helper = helper_class('127.0.0.1', listener.getsockname()[1])
+        helper.uart_open()
+        helper.connect((helper.host, helper.port))
+        helper.is_running = True
+        helper_thread = threading.Thread(target=helper.handle, daemon=True)
+        helper_thread.start()
+        conn, _ = listener.accept()
+        decoder = wuart.PacketStreamDecoder()
+        latency = []
+        for _ in range(args.count):
+            time.sleep(args.interval)
+            start = time.perf_counter()
+            os.write(master, b'k')
+            found = False
+            while not found:
+                found = any(p.key_str == 'data' for p in decoder.feed(conn.recv(4096)))
+            latency.append((time.perf_counter() - start) * 1000)
+        conn.close()
+        helper_thread.join()
+        helper.uart_close()
+        helper.close()
+        listener.close()
+        os.close(master)
+        os.close(slave)
+        print('%8s %10.3f %10.3f %10.3f %10.3f' % (mode, percentile(latency, 50), percentile(latency, 90),
+                                                  percentile(latency, 99), max(latency)))
+
+
+"""
+codec benchmark
+MB/s of fast Packet.calc_checksum / bytes_encode / bytes_decode and of the
+bytewise reference, same output of both is checked by tests/test_packet_codec.py.
+"""
+def codec_samples(size):
+    printable = bytes(range(0x20, 0x7F))
+    text = (printable * (size // len(printable) + 1))[:size]
+    log = (b'[  12.345678] wifi: sta connected, rssi -42\r\n' * (size // 44 + 1))[:size]
+    return {'binary': os.urandom(size), 'text': text, 'log': log}
+
+
+def bench_codec(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+    Packet = wuart.Packet
+    print('%-10s %-8s %12s %12s' % ('function', 'sample', 'fast MB/s', 'bytewise MB/s'))
+    for name, raw in codec_samples(args.size).items():
+        encoded = Packet.bytes_encode(raw)
+        for func, fast, bytewise, data in [
+                ('checksum', Packet.calc_checksum, Packet.calc_checksum_bytewise, raw),
+                ('encode', Packet.bytes_encode, Packet.bytes_encode_bytewise, raw),
+                ('decode', Packet.bytes_decode, Packet.bytes_decode_bytewise, encoded)]:
+            speed = []
+            for f in (fast, bytewise):
+                start = time.perf_counter()
+                for _ in range(args.count):
+                    f(data)
+                speed.append(len(data) * args.count / (time.perf_counter() - start) / 1e6)
+            print('%-10s %-8s %12.2f %12.2f' % (func, name, speed[0], speed[1]))
+
+
+"""
+framing benchmark
+bytes on the wire per data packet for v1, v1 with encode, v2 and v3 framing.
+then resync: [count] data packets of [packet] random bytes, each behind
+[garbage] random bytes, are decoded in 4KB pieces. found is packets decoded
+right, false is packets decoded from garbage, a false v1 start symbol with a
+huge length holds the decoder until that many bytes arrive.
+"""
+def bench_framing(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+    print('%8s %-8s %10s %10s %10s %10s' % ('payload', 'sample', 'v1', 'v1 encode', 'v2', 'v3'))
+    for size in args.size:
+        for name, raw in codec_samples(size).items():
+            v1 = len(wuart.Packet('data', raw).get_bytes())
+            pack = wuart.Packet('data', raw)
+            pack.do_encode()
+            v1_encode = len(pack.get_bytes())
+            v2 = len(wuart.Packet('data', raw).get_bytes(2))
+            v3 = len(wuart.Packet('data', raw).get_bytes(3))
+            print('%8d %-8s %10d %10d %10d %10d' % (size, name, v1, v1_encode, v2, v3))
+    rand = random.Random(1)
+    payloads = [rand.randbytes(args.packet) for _ in range(args.count)]
+    garbage = [rand.randbytes(args.garbage) for _ in range(args.count)]
+    expected = set(payloads)
+    print()
+    print('%-10s %8s %8s %8s %10s %10s' % ('framing', 'found', 'lost', 'false', 'wire', 'ns/byte'))
+    for name, version, encode in [('v1', 1, False), ('v1 encode', 1, True), ('v2', 2, False), ('v3', 3, False)]:
+        chunks = []
+        for raw, junk in zip(payloads, garbage):
+            pack = wuart.Packet('data', raw)
+            if encode:
+                pack.do_encode()
+            chunks += [junk, pack.get_bytes(version)]
+        stream = b''.join(chunks)
+        decoder = wuart.PacketStreamDecoder(0x10000, version)
+        decoded = []
+        start = time.perf_counter()
+        for i in range(0, len(stream), 0x1000):
+            decoded += decoder.feed(stream[i:i+0x1000])
+        elapsed = time.perf_counter() - start
+        found = 0
+        for pack in decoded:
+            if encode:
+                pack.do_decode()
+            if pack.key_str == 'data' and bytes(pack.val_bytes) in expected:
+                found += 1
+        print('%-10s %8d %8d %8d %10d %10.1f' % (name, found, args.count - found, len(decoded) - found,
+                                                 len(stream), elapsed / len(stream) * 1e9))
+
+
+"""
+compress benchmark
+compress samples in [chunk] bytes data packets with one stream context, like a
+session does, and report ratio and cpu time of each method.
+"""
+def bench_compress(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+    zdict = wuart.StreamCompressor.DEFAULT_DICT
+    print('%-8s %-16s %10s %10s %8s %10s' % ('sample', 'method', 'raw', 'zip', 'ratio', 'cpu ms'))
+    for name, raw in codec_samples(args.size).items():
+        for method in ['zlib', wuart.StreamCompressor.dict_method(zdict)]:
+            tx = wuart.StreamCompressor(method, zdict)
+            rx = wuart.StreamCompressor(method, zdict)
+            for i in range(0, len(raw), args.chunk):
+                assert rx.decompress(tx.compress(raw[i:i+args.chunk])) == raw[i:i+args.chunk]
+            print('%-8s %-16s %10d %10d %7.1f%% %10.2f' % (name, method, tx.tx_raw, tx.tx_zip,
+                                                         100.0 * tx.tx_zip / tx.tx_raw, tx.cpu_sec * 1000))
+
+
+"""
+udp benchmark
+one-way latency of [size] bytes messages sent every [interval] seconds, over
+tcp loopback and over ReliableUdpChannel with LossyDatagramShim dropping [loss]
+of datagrams in both directions.
+loopback tcp never loses, so 'tcp stall' models a lost segment by holding the
+stream for [stall] ms (linux min rto is 200 ms) in a relay, everything behind it
+waits, that is the head-of-line blocking udp mode avoids. use netem on a real
+link for real tcp numbers.
+"""
+def bench_udp(args):
+    wuart = load_module('wireless_uart_server', 'server/wireless_uart_server.py')
+    message = struct.Struct('<1d')
+    pad = bytes(max(args.size - message.size, 0))
+    msg_size = message.size + len(pad)
+
+    def receive(stream, latency):
+        recv_raw = bytearray()
+        while len(latency) < args.count:
+            chunk = stream.recv(0x10000)
+            if len(chunk) == 0:
+                break
+            recv_raw += chunk
+            while len(recv_raw) >= msg_size:
+                sent, = message.unpack_from(recv_raw)
+                latency.append((time.perf_counter() - sent) * 1000)
+                del recv_raw[:msg_size]
+
+    def tcp_pair():
+        listener = socket.create_server(('127.0.0.1', 0))
+        client = socket.create_connection(listener.getsockname())
+        conn, _ = listener.accept()
+        listener.close()
+        for sock in (client, conn):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return client, conn
+
+    def relay(src, dst, loss):
+        rand = random.Random(1)
+        while True:
+            chunk = src.recv(0x10000)
+            if len(chunk) == 0:
+                break
+            if rand.random() < loss:
+                time.sleep(args.stall / 1000)
+            dst.sendall(chunk)
+        dst.close()
+
+    print('%-10s %6s %10s %10s %10s %10s %8s' % ('transport', 'loss', 'p50 ms', 'p99 ms', 'p99.9 ms', 'max ms', 'retx'))
+    for loss in args.loss:
+        for transport in args.transport:
+            latency = []
+            retransmits = ''
+            if transport == 'udp':
+                done = threading.Event()
+
+                class Receiver:
+                    def __init__(self, channel, addr, server):
+                        receive(channel, latency)
+                        done.set()
+                server = wuart.UdpServer(('127.0.0.1', 0), Receiver, loss)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                sender = wuart.ReliableUdpChannel.connect(server.server_address)
+                sender.shim = wuart.LossyDatagramShim(sender.sock, loss, seed=2)
+                receiver = threading.Thread(target=done.wait)
+            else:
+                sender, relay_in = tcp_pair()
+                relay_out, sink = tcp_pair()
+                threading.Thread(target=relay, args=(relay_in, relay_out, loss if transport == 'tcp_stall' else 0),
+                                 daemon=True).start()
+                receiver = threading.Thread(target=receive, args=(sink, latency))
+            receiver.start()
+            for _ in range(args.count):
+                time.sleep(args.interval)
+                sender.sendall(message.pack(time.perf_counter()) + pad)
+            receiver.join(args.count * args.interval + 10)
+            if transport == 'udp':
+                retransmits = str(sender.retransmits)
+                server.socket.close()
+            sender.close()
+            print('%-10s %5.1f%% %10.3f %10.3f %10.3f %10.3f %8s' % (
+                transport, loss * 100, percentile(latency, 50), percentile(latency, 99), percentile(latency, 99.9),
+                max(latency), retransmits))
+
+
+"""
+metrics benchmark
+cost of the metrics hooks a packet goes through, SendCoalescer.send() into a
+null socket with metrics on minus the same with --no_metrics, against the
+cheapest per packet work there is, decoding it from a v2 stream. the real path
+also has syscalls and uart io, so the ratio is an upper bound of the metrics
+overhead, bench e2e with -sa/-ca '-nm' and --baseline gives the end to end one.
+on and off take turns for [repeat] runs and the best of each counts, the
+difference is a few ns.
+"""
+class NullStream:
+    def sendmsg(self, views):
+        return sum(len(view) for view in views)
+
+
+def bench_metrics(args):
+    wuart = load_module('wireless_uart_server', 'server/wireless_uart_server.py')
+    print('%8s %14s %14s %14s %8s' % ('payload', 'decode ns/pkt', 'send ns/pkt', 'metrics ns/pkt', 'ratio'))
+    for size in args.size:
+        frame = wuart.Packet('data', os.urandom(size)).get_bytes(2)
+        raw = frame * args.count
+        decoder = wuart.PacketStreamDecoder(len(raw), 2)
+        start = time.perf_counter()
+        for _ in decoder.feed(raw):
+            pass
+        decode_ns = (time.perf_counter() - start) / args.count * 1e9
+        coalescers = {}
+        for enable in (False, True):
+            wuart.metrics.enable = enable
+            coalescers[enable] = wuart.SendCoalescer(NullStream(), 0, 0x1000, wuart.metrics.session('bench'))
+        wuart.metrics.enable = True
+        send_ns = {False: float('inf'), True: float('inf')}
+        # on and off take turns in both orders, so drift of the host hits both
+        for run in range(args.repeat):
+            for enable in ((False, True) if run % 2 == 0 else (True, False)):
+                coalescer = coalescers[enable]
+                start = time.perf_counter()
+                for _ in range(args.count):
+                    coalescer.send([frame], True)
+                send_ns[enable] = min(send_ns[enable], (time.perf_counter() - start) / args.count * 1e9)
+        metrics_ns = max(send_ns[True] - send_ns[False], 0)
+        print('%8d %14.0f %14.0f %14.1f %7.2f%%' % (size, decode_ns, send_ns[False], metrics_ns,
+                                                   100.0 * metrics_ns / decode_ns))
+
+
+"""
+chunk benchmark
+messages are written into a pty at the pace of a [baud] uart, [burst] bytes at
+a time like a uart driver hands them over, with an idle gap between messages,
+log lines for 'log', random binary frames for 'binary'. the UartChunker of each
+mode reads the other end: chunks per message is the packet count it costs,
+split is the share of messages cut over more than one chunk, latency is from
+the last byte of a message written until the chunk with it is out.
+"""
+def chunk_messages(pattern, count):
+    messages = []
+    for idx in range(count):
+        if pattern == 'log':
+            messages.append(b'[%12.6f] wifi: sta %d rssi -%d' % (idx * 0.01, idx, random.randint(30, 90))
+                            + b'.' * random.randint(0, 60) + b'\r\n')
+        else:
+            messages.append(os.urandom(random.randint(8, 64)))
+    return messages
+
+
+def bench_chunk(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+    char_sec = wuart.UartChunker.CHAR_BITS / args.baud
+    print('%8s %10s %8s %10s %8s %10s %10s' % ('pattern', 'mode', 'chunks', 'chunks/msg', 'split', 'p50 ms', 'p99 ms'))
+    for pattern in args.pattern:
+        messages = chunk_messages(pattern, args.count)
+        for mode in args.mode:
+            master, slave = os.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            uart_dev = wuart.serial.Serial(os.ttyname(slave), args.baud)
+            chunker = wuart.UartChunker(mode, args.baud, args.gap, 0x1000, args.age / 1000)
+            ends = [] # (end offset of a message, write time of its last byte)
+            out = [] # (end offset of a chunk, time it is out)
+
+            def write_forever():
+                offset = 0
+                for message in messages:
+                    for idx in range(0, len(message), args.burst):
+                        piece = message[idx:idx+args.burst]
+                        time.sleep(len(piece) * char_sec)
+                        os.write(master, piece)
+                    offset += len(message)
+                    ends.append((offset, time.perf_counter()))
+                    time.sleep(random.uniform(args.idle / 2, args.idle) / 1000)
+
+            writer = threading.Thread(target=write_forever, daemon=True)
+            writer.start()
+            total = sum(len(message) for message in messages)
+            offset = 0
+            while offset < total:
+                for chunk in chunker.read(uart_dev):
+                    offset += len(chunk)
+                    out.append((offset, time.perf_counter()))
+            writer.join()
+            uart_dev.close()
+            os.close(master)
+            os.close(slave)
+            latency = []
+            split = 0
+            idx = 0
+            start = 0
+            for end, write_time in ends:
+                # first chunk with a byte of the message, then the one with its last byte
+                while out[idx][0] <= start:
+                    idx += 1
+                first = idx
+                while out[idx][0] < end:
+                    idx += 1
+                if idx > first:
+                    split += 1
+                latency.append(max(out[idx][1] - write_time, 0) * 1000)
+                start = end
+            print('%8s %10s %8d %10.2f %7.1f%% %10.3f %10.3f' % (pattern, mode, len(out), len(out) / len(messages),
+                100.0 * split / len(messages), percentile(latency, 50), percentile(latency, 99)))
+
+
+"""
+packet benchmark
+bytes allocated per forwarded chunk, in copies of the chunk, from the
+tracemalloc peak of each step with its result kept alive, and us per chunk:
+- build: Packet('data', chunk) as the uart reader creates it
+- serialize: get_bytes() of the built packet for the socket
+- parse: the data packet found by the decoder in the serialized bytes
+legacy is the eager Packet the slotted one replaced, it joined key, '=' and
+value into data_bytes on every set and concatenated the wire bytes piece by
+piece, so every step copied the chunk once more.
+"""
+class LegacyPacket:
+    base = None # Packet of the loaded module, for checksum and varint
+
+    def __init__(self, key_str:str, val_bytes:bytearray=bytearray()):
+        self.set_key_value(key_str, val_bytes)
+
+    def set_key_value(self, key_str:str, val_bytes:bytearray):
+        self.key_str = key_str
+        self.val_bytes = val_bytes
+        if len(val_bytes) > 0:
+            self.data_bytes = key_str.encode() + b'=' + val_bytes
+        else:
+            self.data_bytes = key_str.encode()
+        self.data_size = len(self.data_bytes)
+        self.checksum = LegacyPacket.base.calc_checksum(self.data_bytes)
+
+    def get_bytes(self, version:int=1):
+        Packet = LegacyPacket.base
+        if version >= 2:
+            opcode = Packet.OPCODES.get(self.key_str, 0)
+            payload = self.val_bytes if opcode > 0 else self.data_bytes
+            header = Packet.header_v2(bytes((opcode,)), len(payload))
+            crc = binascii.crc_hqx(payload, binascii.crc_hqx(header[1:], 0xFFFF))
+            return header + payload + crc.to_bytes(2, 'big')
+        raw_bytes = struct.pack('<1H1I', Packet.SYMBOL_START, self.data_size)
+        raw_bytes += self.data_bytes
+        raw_bytes += self.checksum.to_bytes(1, 'little')
+        raw_bytes += Packet.SYMBOL_END_BYTES
+        return raw_bytes
+
+
+def alloc_peak(func):
+    # (result, peak bytes allocated while func runs), result stays alive
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    result = func()
+    return result, tracemalloc.get_traced_memory()[1] - base
+
+
+def object_size(obj):
+    return sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+
+
+def bench_packet(args):
+    wuart = load_module('wireless_uart_server', 'server/wireless_uart_server.py')
+    LegacyPacket.base = wuart.Packet
+    impls = (('legacy', LegacyPacket, lambda pack: LegacyPacket(pack.key_str, pack.val_bytes)),
+             ('slotted', wuart.Packet, lambda pack: pack))
+    print('%8s %2s %-8s %8s %10s %8s %8s %10s %9s' % ('chunk', 'v', 'packet', 'build', 'serialize', 'parse', 'total',
+          'obj bytes', 'us/chunk'))
+    for size in args.size:
+        chunk = os.urandom(size)
+        for version in args.proto:
+            for name, packet_class, from_decoded in impls:
+                decoder = wuart.PacketStreamDecoder(size * 2 + 64, version)
+                tracemalloc.start()
+                pack, build = alloc_peak(lambda: packet_class('data', chunk))
+                raw_bytes, serialize = alloc_peak(lambda: pack.get_bytes(version))
+                decoder.append(raw_bytes)
+                parsed, parse = alloc_peak(lambda: from_decoded(next(decoder.frames())))
+                tracemalloc.stop()
+                assert bytes(parsed.val_bytes) == chunk
+                start = time.perf_counter()
+                for _ in range(args.count):
+                    raw_bytes = packet_class('data', chunk).get_bytes(version)
+                    decoder.append(raw_bytes)
+                    from_decoded(next(decoder.frames()))
+                cost = (time.perf_counter() - start) / args.count * 1e6
+                print('%8d %2d %-8s %8.2f %10.2f %8.2f %8.2f %10d %9.2f' % (
+                    size, version, name, build / size, serialize / size, parse / size,
+                    (build + serialize + parse) / size, object_size(pack), cost))
+
+
+"""
+end to end benchmark
+the real server and client run as subprocesses, the client local uart and the
+server remote uart are pty pairs owned by this script, so the whole path
+pty -> client -> socket -> server -> pty is measured, for every [pattern],
+[direction] and encode setting:
+- bulk: [size] random bytes in [chunk] bytes writes, as fast as possible
+- log: [size] bytes of log lines, one write per line
+- keystroke: [keys] single bytes every [interval] seconds
+throughput is bytes / seconds from the first write to the last byte read,
+latency is the time until the last byte of each write is read on the other
+side, peak rss of both processes comes from /proc, so linux only.
+encode on forces the client to protocol v1 (-P 1), v2/v3 framing never escapes
+data, so -e alone would measure the same path as encode off.
+cpu is the rusage of each process over the whole bridge lifetime, startup
+included, per run tick counts are too coarse for sub second runs.
+a pty takes a burst far faster than any uart, the server drops the oldest bytes
+past its -q client queue for flow controlled clients, so the default server
+args raise -q above [size], a run stops after [idle] seconds without bytes and
+reports the loss.
+results are written as json, --baseline compares a previous json and exits 1
+when throughput drops or p99 latency grows more than [tolerance].
+"""
+class E2eBridge:
+    def __init__(self, args, encode:bool):
+        self.ptys = [os.openpty(), os.openpty()] # client local, server remote
+        for master, slave in self.ptys:
+            tty.setraw(master)
+            tty.setraw(slave)
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = str(probe.getsockname()[1])
+        probe.close()
+        client_args = shlex.split(args.client_args)
+        # the real server accepts any version the client proposes, v2 unless -P is given
+        self.proto = '1' if encode else next((client_args[i + 1] for i, arg in enumerate(client_args[:-1])
+                                                if arg in ('-P', '--proto')), '2')
+        extra = ['-e'] if encode else []
+        self.started = time.perf_counter()
+        self.rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(root_path, 'server/wireless_uart_server.py'), '-i', '127.0.0.1', '-p', port]
+            + extra + shlex.split(args.server_args),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(0.5)
+        self.client = subprocess.Popen(
+            [sys.executable, os.path.join(root_path, 'client/wireless_uart_client.py'), '-i', '127.0.0.1', '-p', port,
+             '-ulp', os.ttyname(self.ptys[0][1]), '-urp', os.ttyname(self.ptys[1][1])] + extra + client_args
+            + (['-P', '1'] if encode else []),
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # bridge is up when a probe byte crosses it
+        deadline = time.monotonic() + 15
+        while True:
+            if time.monotonic() > deadline or self.server.poll() is not None or self.client.poll() is not None:
+                self.close()
+                raise RuntimeError('bridge not ready')
+            os.write(self.ptys[0][0], b'#')
+            if len(select.select([self.ptys[1][0]], [], [], 0.3)[0]) > 0:
+                break
+        self.drain()
+
+    def drain(self):
+        for master, _ in self.ptys:
+            while len(select.select([master], [], [], 0.3)[0]) > 0:
+                os.read(master, 0x10000)
+
+    def peak_rss_kb(self, proc):
+        with open('/proc/%d/status' % proc.pid) as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+        return 0
+
+    def close(self):
+        # reap one process at a time, the RUSAGE_CHILDREN delta is then its own cpu
+        cpu = {}
+        elapsed = time.perf_counter() - self.started
+        for name, proc in (('client', self.client), ('server', self.server)):
+            proc.terminate()
+            proc.wait()
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            sec = usage.ru_utime + usage.ru_stime - self.rusage.ru_utime - self.rusage.ru_stime
+            self.rusage = usage
+            cpu[name] = {'cpu_sec': round(sec, 3), 'cpu_pct': round(100.0 * sec / elapsed, 1)}
+        for master, slave in self.ptys:
+            os.close(master)
+            os.close(slave)
+        return cpu
+
+
+def e2e_writes(args, pattern):
+    if pattern == 'bulk':
+        raw = os.urandom(args.size)
+        return [raw[i:i+args.chunk] for i in range(0, len(raw), args.chunk)], 0
+    if pattern == 'log':
+        raw = codec_samples(args.size)['log']
+        return [line + b'\n' for line in raw.split(b'\n') if len(line) > 0], 0
+    return [bytes([0x61 + i % 26]) for i in range(args.keys)], args.interval
+
+
+def e2e_run(args, bridge, pattern, direction):
+    writes, interval = e2e_writes(args, pattern)
+    src, dst = (bridge.ptys[0][0], bridge.ptys[1][0]) if direction == 'up' else (bridge.ptys[1][0], bridge.ptys[0][0])
+    total = sum(len(w) for w in writes)
+    marks = [] # (end offset, write time)
+    marks_lock = threading.Lock()
+
+    def writer():
+        offset = 0
+        for w in writes:
+            if interval > 0:
+                time.sleep(interval)
+            view = memoryview(w)
+            while len(view) > 0:
+                view = view[os.write(src, view):]
+            offset += len(w)
+            with marks_lock:
+                marks.append((offset, time.perf_counter()))
+
+    start = time.perf_counter()
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+    received = bytearray()
+    latency = []
+    mark_idx = 0
+    deadline = time.monotonic() + args.timeout
+    last_read = start
+    while len(received) < total and time.monotonic() < deadline:
+        if len(select.select([dst], [], [], 0.5)[0]) == 0:
+            if not writer_thread.is_alive() and time.perf_counter() - last_read > args.idle:
+                break
+            continue
+        received += os.read(dst, 0x10000)
+        now = time.perf_counter()
+        last_read = now
+        with marks_lock:
+            while mark_idx < len(marks) and marks[mark_idx][0] <= len(received):
+                latency.append((now - marks[mark_idx][1]) * 1000)
+                mark_idx += 1
+    elapsed = last_read - start
+    writer_thread.join(1)
+    return {
+        'pattern': pattern,
+        'direction': direction,
+        'bytes': total,
+        'received': len(received),
+        'intact': bytes(received) == b''.join(writes),
+        'seconds': round(elapsed, 4),
+        'bytes_per_sec': round(len(received) / elapsed, 1) if elapsed > 0 else 0,
+        'latency_ms': {'p50': round(percentile(latency, 50), 3), 'p90': round(percentile(latency, 90), 3),
+                       'p99': round(percentile(latency, 99), 3), 'max': round(max(latency, default=0), 3)},
+        'server': {'rss_kb': bridge.peak_rss_kb(bridge.server)},
+        'client': {'rss_kb': bridge.peak_rss_kb(bridge.client)},
+    }
+
+
+def e2e_compare(results, cpu, baseline_path, tolerance):
+    with open(baseline_path) as baseline_file:
+        report = json.load(baseline_file)
+    baseline = {(r['pattern'], r['direction'], r['encode']): r for r in report['results']}
+    regress = False
+    print('%-10s %-5s %-6s %12s %12s' % ('pattern', 'dir', 'encode', 'B/s ratio', 'p99 ratio'))
+    for r in results:
+        base = baseline.get((r['pattern'], r['direction'], r['encode']))
+        if base is None or base['bytes_per_sec'] == 0 or base['latency_ms']['p99'] == 0:
+            continue
+        speed = r['bytes_per_sec'] / base['bytes_per_sec']
+        p99 = r['latency_ms']['p99'] / base['latency_ms']['p99']
+        flag = ''
+        if (r['pattern'] != 'keystroke' and speed < 1 - tolerance) or p99 > 1 + tolerance:
+            flag = ' REGRESSION'
+            regress = True
+        print('%-10s %-5s %-6s %12.3f %12.3f%s' % (r['pattern'], r['direction'], r['encode'], speed, p99, flag))
+    # cpu of the whole bridge, informational, the runs only match when the traffic did
+    for encode, usage in cpu.items():
+        base = report.get('cpu', {}).get(encode)
+        if base is not None and base['server']['cpu_sec'] > 0 and base['client']['cpu_sec'] > 0:
+            print('encode %s cpu ratio: server %.3f, client %.3f' % (encode,
+                  usage['server']['cpu_sec'] / base['server']['cpu_sec'], usage['client']['cpu_sec'] / base['client']['cpu_sec']))
+    return regress
+
+
+def bench_e2e(args):
+    git_rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_path,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    results = []
+    cpu = {}
+    print('%-10s %-5s %-6s %-5s %12s %9s %9s %9s %9s %9s' % ('pattern', 'dir', 'encode', 'proto', 'B/s', 'p50 ms',
+          'p99 ms', 'max ms', 'srv rss', 'cli rss'))
+    for encode in args.encode:
+        bridge = E2eBridge(args, encode == 'on')
+        try:
+            for pattern in args.pattern:
+                for direction in args.direction:
+                    r = e2e_run(args, bridge, pattern, direction)
+                    r['encode'] = encode
+                    r['proto'] = bridge.proto
+                    results.append(r)
+                    print('%-10s %-5s %-6s %-5s %12.0f %9.3f %9.3f %9.3f %7dKB %7dKB%s' % (
+                        pattern, direction, encode, bridge.proto, r['bytes_per_sec'], r['latency_ms']['p50'],
+                        r['latency_ms']['p99'], r['latency_ms']['max'], r['server']['rss_kb'], r['client']['rss_kb'],
+                        '' if r['intact'] else ' LOSS %d' % (r['bytes'] - r['received']) if r['received'] < r['bytes']
+                        else ' CORRUPT'))
+                    bridge.drain()
+        finally:
+            cpu[encode] = bridge.close()
+        print('encode %s cpu over bridge lifetime: server %.3fs (%.1f%%), client %.3fs (%.1f%%)' % (
+            encode, cpu[encode]['server']['cpu_sec'], cpu[encode]['server']['cpu_pct'],
+            cpu[encode]['client']['cpu_sec'], cpu[encode]['client']['cpu_pct']))
+    report = {'bench': 'e2e', 'version': app_version, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'git': git_rev,
+              'host': platform.node(), 'python': platform.python_version(), 'args': {
+                  k: v for k, v in vars(args).items() if k != 'func'}, 'results': results, 'cpu': cpu}
+    if len(args.json) > 0:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+        print('result saved to %s' % args.json)
+    if len(args.baseline) > 0 and e2e_compare(results, cpu, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+"""
+multi-client load benchmark
+[clients] synthetic clients run inside this script against one real server
+subprocess, each does the proto/path/baud/start handshake with its own server
+uart, a pty pair owned by this script, then for [seconds] every client offers
+[rate] bytes/s in [chunk] bytes writes:
+- up: data packets on the socket, read back from the pty
+- down: bytes into the pty, read back from data packets on the socket
+one pacer thread writes for all clients and one selector loop reads, so the
+script stays cheaper than the server it loads, its own cpu% is reported too,
+a knee with this script near 100% is the load generator saturating, not the
+server.
+for every client count it reports offered and delivered bytes/s, jain's
+fairness index of per-client delivery (1 is fair, 1/N is one client only),
+write to read latency percentiles, server cpu%, thread count and peak rss,
+summed over the server and its worker processes with --workers.
+the knee is the first count where delivery falls under [knee] of the offered
+load or p99 latency grows past [latency] ms, the saturation point of the host.
+"""
+class LoadClient:
+    def __init__(self, wuart, port:int, timeout:float):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.wuart = wuart
+        self.version = 1
+        self.decoder = wuart.PacketStreamDecoder()
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sent = 0
+        self.received = 0
+        self.marks = collections.deque() # (end offset, write time)
+        self.latency = []
+        self.send_packet('proto', b'2')
+        while self.version == 1:
+            raw_bytes = self.sock.recv(0x10000)
+            if len(raw_bytes) == 0:
+                raise RuntimeError('server closed on proto')
+            for new_packet in self.decoder.feed(raw_bytes):
+                if new_packet.key_str == 'proto':
+                    self.version = self.decoder.version = int(new_packet.val_bytes.decode())
+                    break
+        self.send_packet('path', os.ttyname(self.slave).encode())
+        self.send_packet('baud', b'115200')
+        self.send_packet('start')
+        # the server uart is open when a probe byte comes back
+        deadline = time.monotonic() + timeout
+        probe = bytearray()
+        while len(probe) == 0:
+            if time.monotonic() > deadline:
+                raise RuntimeError('uart %s not ready' % os.ttyname(self.slave))
+            os.write(self.master, b'#')
+            probe = self.recv_data(0.3)
+        self.sock.settimeout(None)
+
+    def send_packet(self, key_str:str, val_bytes:bytes=b''):
+        self.sock.sendall(self.wuart.Packet(key_str, bytearray(val_bytes)).get_bytes(self.version))
+
+    def recv_data(self, timeout:float):
+        data = bytearray()
+        if len(select.select([self.sock], [], [], timeout)[0]) > 0:
+            for new_packet in self.decoder.feed(self.sock.recv(0x10000)):
+                if new_packet.key_str == 'data':
+                    data += new_packet.val_bytes
+        return data
+
+    def write(self, direction:str, raw_bytes:bytes):
+        if direction == 'up':
+            self.sock.sendall(self.wuart.Packet('data', bytearray(raw_bytes)).get_bytes(self.version))
+        else:
+            view = memoryview(raw_bytes)
+            while len(view) > 0:
+                view = view[os.write(self.master, view):]
+        self.sent += len(raw_bytes)
+        self.marks.append((self.sent, time.perf_counter()))
+
+    def read(self, direction:str):
+        if direction == 'up':
+            self.received += len(os.read(self.master, 0x10000))
+        else:
+            raw_bytes = self.sock.recv(0x10000)
+            if len(raw_bytes) == 0:
+                raise RuntimeError('server closed')
+            for new_packet in self.decoder.feed(raw_bytes):
+                if new_packet.key_str == 'data':
+                    self.received += len(new_packet.val_bytes)
+        now = time.perf_counter()
+        while len(self.marks) > 0 and self.marks[0][0] <= self.received:
+            self.latency.append((now - self.marks.popleft()[1]) * 1000)
+
+    def drain(self):
+        while len(select.select([self.master], [], [], 0.1)[0]) > 0:
+            os.read(self.master, 0x10000)
+        while len(self.recv_data(0.1)) > 0:
+            pass
+
+    def close(self):
+        self.sock.close()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def proc_status(pid:int):
+    # ticks, threads and peak rss summed over the process and its children, like server workers
+    status = {'ticks': 0, 'Threads': 0, 'VmHWM': 0}
+    pids = [pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        try:
+            with open('/proc/%d/status' % pid) as status_file:
+                for line in status_file:
+                    key, _, value = line.partition(':')
+                    if key in ('Threads', 'VmHWM'):
+                        status[key] += int(value.split()[0])
+            with open('/proc/%d/stat' % pid) as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+            status['ticks'] += int(fields[11]) + int(fields[12]) # utime + stime
+            for task in os.listdir('/proc/%d/task' % pid):
+                with open('/proc/%d/task/%s/children' % (pid, task)) as children_file:
+                    pids.extend(int(child) for child in children_file.read().split())
+        except OSError:
+            # exited while reading
+            pass
+    return status
+
+
+def load_run(args, wuart, count:int, direction:str):
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(root_path, 'server/wireless_uart_server.py'), '-i', '127.0.0.1', '-p', str(port)]
+        + shlex.split(args.server_args),
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError('server not ready')
+                time.sleep(0.1)
+        for i in range(count):
+            clients.append(LoadClient(wuart, port, args.timeout))
+        for client in clients:
+            client.drain()
+        chunk = bytes(random.Random(count).getrandbits(8) for i in range(args.chunk))
+        running = threading.Event()
+        running.set()
+
+        def pacer():
+            # every client is due rate * elapsed bytes, written in chunks, a blocked write delays all of them
+            begin = time.perf_counter()
+            while running.is_set():
+                due = int(args.rate * (time.perf_counter() - begin))
+                for client in clients:
+                    while client.sent + args.chunk <= due and running.is_set():
+                        client.write(direction, chunk)
+                time.sleep(0.002)
+
+        selector = selectors.DefaultSelector()
+        for client in clients:
+            selector.register(client.master if direction == 'up' else client.sock, selectors.EVENT_READ, client)
+        status = proc_status(server.pid)
+        ticks = status['ticks']
+        threads = status['Threads']
+        own_times = os.times()
+        start = last_read = time.perf_counter()
+        pacer_thread = threading.Thread(target=pacer, daemon=True)
+        pacer_thread.start()
+        while True:
+            now = time.perf_counter()
+            if now - start > args.seconds:
+                running.clear()
+                if now - last_read > args.idle or all(c.received >= c.sent for c in clients):
+                    break
+            events = selector.select(0.2)
+            for key, _ in events:
+                key.data.read(direction)
+            if len(events) > 0:
+                last_read = time.perf_counter()
+            if not running.is_set() and time.perf_counter() - start > args.seconds + args.timeout:
+                break
+            threads = max(threads, proc_status(server.pid)['Threads']) if len(events) == 0 else threads
+        pacer_thread.join(1)
+        selector.close()
+        status = proc_status(server.pid)
+        elapsed = last_read - start
+        own_cpu = sum(os.times()[:2]) - sum(own_times[:2])
+    finally:
+        for client in clients:
+            client.close()
+        server.terminate()
+        server.wait()
+    offered = sum(c.sent for c in clients)
+    delivered = [c.received for c in clients]
+    latency = [ms for c in clients for ms in c.latency]
+    jain = sum(delivered) ** 2 / (count * sum(d * d for d in delivered)) if sum(delivered) > 0 else 0
+    return {
+        'clients': count,
+        'direction': direction,
+        'offered_bytes_per_sec': round(count * args.rate, 1),
+        'bytes': offered,
+        'received': sum(delivered),
+        'seconds': round(elapsed, 4),
+        'bytes_per_sec': round(sum(delivered) / elapsed, 1) if elapsed > 0 else 0,
+        'fairness': round(jain, 4),
+        'client_bytes_per_sec': {'min': round(min(delivered) / elapsed, 1) if elapsed > 0 else 0,
+                                 'max': round(max(delivered) / elapsed, 1) if elapsed > 0 else 0},
+        'latency_ms': {'p50': round(percentile(latency, 50), 3), 'p90': round(percentile(latency, 90), 3),
+                       'p99': round(percentile(latency, 99), 3), 'max': round(max(latency, default=0), 3)},
+        'server': {'cpu_pct': round(100.0 * (status['ticks'] - ticks) / os.sysconf('SC_CLK_TCK') / elapsed, 1)
+                   if elapsed > 0 else 0, 'threads': threads, 'rss_kb': status['VmHWM']},
+        'bench_cpu_pct': round(100.0 * own_cpu / elapsed, 1) if elapsed > 0 else 0,
+    }
+
+
+def bench_load(args):
+    wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+    results = []
+    knee = {}
+    print('%-5s %7s %12s %12s %7s %7s %9s %9s %7s %7s %9s %7s' % ('dir', 'clients', 'offered B/s', 'B/s', 'ratio',
+          'jain', 'p50 ms', 'p99 ms', 'srv cpu', 'threads', 'srv rss', 'own cpu'))
+    for direction in args.direction:
+        for count in args.clients:
+            try:
+                r = load_run(args, wuart, count, direction)
+            except (OSError, RuntimeError) as ex1:
+                print('%-5s %7d failed: %s' % (direction, count, str(ex1)))
+                knee.setdefault(direction, count)
+                break
+            results.append(r)
+            ratio = r['bytes_per_sec'] / r['offered_bytes_per_sec']
+            saturated = ratio < args.knee or r['latency_ms']['p99'] > args.latency
+            print('%-5s %7d %12.0f %12.0f %7.3f %7.3f %9.3f %9.3f %6.1f%% %7d %7dKB %6.1f%%%s' % (
+                direction, count, r['offered_bytes_per_sec'], r['bytes_per_sec'], ratio, r['fairness'],
+                r['latency_ms']['p50'], r['latency_ms']['p99'], r['server']['cpu_pct'], r['server']['threads'],
+                r['server']['rss_kb'], r['bench_cpu_pct'], ' SATURATED' if saturated else ''))
+            if saturated:
+                knee.setdefault(direction, count)
+    for direction in args.direction:
+        if direction in knee:
+            print('%s knee at %d clients of %d B/s' % (direction, knee[direction], args.rate))
+        else:
+            print('%s not saturated up to %d clients of %d B/s' % (direction, max(args.clients), args.rate))
+    report = {'bench': 'load', 'version': app_version, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': platform.node(), 'cpus': os.cpu_count(), 'python': platform.python_version(), 'args': {
+                  k: v for k, v in vars(args).items() if k != 'func'}, 'knee': knee, 'results': results}
+    if len(args.json) > 0:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+        print('result saved to %s' % args.json)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wireless UART Bench ver.%s" % app_version)
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    sub = subparsers.add_parser('decoder', help='PacketStreamDecoder per-byte cost with different backlog')
+    sub.add_argument('-s', '--size', default=16, type=int, help='Set Packet Data Size (Default 16)')
+    sub.add_argument('-l', '--backlog', default=[0x1000, 0x10000, 0x40000, 0x100000], type=int, nargs='+',
+                     help='Set Burst Bytes List (Default 4K 64K 256K 1M)')
+    sub.add_argument('-k', '--chunk', default=0x100000, type=int, help='Set Recv Chunk Size (Default 1M)')
+    sub.add_argument('-b', '--buffer_size', default=0x10000, type=int, help='Set Decoder Buffer Size (Default 64KB)')
+    sub.add_argument('-m', '--legacy_max', default=0x40000, type=int,
+                     help='Set Max Burst Size To Run Legacy Way (Default 256K)')
+    sub.set_defaults(func=bench_decoder)
+    sub = subparsers.add_parser('client_latency', help='uart to socket forwarding latency of the client')
+    sub.add_argument('-c', '--count', default=200, type=int, help='Set Keystroke Count (Default 200)')
+    sub.add_argument('-n', '--interval', default=0.003, type=float, help='Set Keystroke Interval Seconds (Default 0.003)')
+    sub.add_argument('-o', '--mode', default=['legacy', 'reader'], choices=['legacy', 'reader'], nargs='+',
+                     help='Set Client Modes To Compare (Default legacy reader)')
+    sub.set_defaults(func=bench_client_latency)
+    sub = subparsers.add_parser('codec', help='Packet checksum/encode/decode MB/s, fast and bytewise')
+    sub.add_argument('-s', '--size', default=0x10000, type=int, help='Set Sample Size (Default 64KB)')
+    sub.add_argument('-c', '--count', default=5, type=int, help='Set Loop Count (Default 5)')
+    sub.set_defaults(func=bench_codec)
+    sub = subparsers.add_parser('framing', help='wire bytes per data packet of each framing')
+    sub.add_argument('-s', '--size', default=[1, 16, 256, 4096], type=int, nargs='+',
+                     help='Set Payload Size List (Default 1 16 256 4096)')
+    sub.add_argument('-c', '--count', default=2000, type=int, help='Set Resync Packet Count (Default 2000)')
+    sub.add_argument('-p', '--packet', default=64, type=int, help='Set Resync Packet Size (Default 64)')
+    sub.add_argument('-g', '--garbage', default=16, type=int, help='Set Garbage Bytes Before Each Packet (Default 16)')
+    sub.set_defaults(func=bench_framing)
+    sub = subparsers.add_parser('compress', help='stream compression ratio and cpu time per method')
+    sub.add_argument('-s', '--size', default=0x40000, type=int, help='Set Sample Size (Default 256KB)')
+    sub.add_argument('-k', '--chunk', default=64, type=int, help='Set Data Packet Size (Default 64)')
+    sub.set_defaults(func=bench_compress)
+    sub = subparsers.add_parser('udp', help='message latency of tcp and reliable udp under datagram loss')
+    sub.add_argument('-c', '--count', default=2000, type=int, help='Set Message Count (Default 2000)')
+    sub.add_argument('-n', '--interval', default=0.002, type=float, help='Set Message Interval Seconds (Default 0.002)')
+    sub.add_argument('-s', '--size', default=64, type=int, help='Set Message Size (Default 64)')
+    sub.add_argument('-l', '--loss', default=[0.0, 0.05], type=float, nargs='+', help='Set Loss Rate List (Default 0 0.05)')
+    sub.add_argument('-o', '--transport', default=['tcp', 'tcp_stall', 'udp'], choices=['tcp', 'tcp_stall', 'udp'],
+                     nargs='+', help='Set Transports To Compare (Default tcp tcp_stall udp)')
+    sub.add_argument('-m', '--stall', default=200, type=float,
+                     help='Set Modeled TCP Stall Ms Per Lost Segment (Default 200)')
+    sub.set_defaults(func=bench_udp)
+    sub = subparsers.add_parser('metrics', help='metrics hook cost per packet against decoding it')
+    sub.add_argument('-s', '--size', default=[16, 256, 4096], type=int, nargs='+',
+                     help='Set Payload Size List (Default 16 256 4096)')
+    sub.add_argument('-c', '--count', default=100000, type=int, help='Set Packet Count (Default 100000)')
+    sub.add_argument('-r', '--repeat', default=10, type=int, help='Set Runs Per Setting, Best One Counts (Default 10)')
+    sub.set_defaults(func=bench_metrics)
+    sub = subparsers.add_parser('chunk', help='packets and latency per message of each uart chunk mode')
+    sub.add_argument('-a', '--pattern', default=['log', 'binary'], choices=['log', 'binary'], nargs='+',
+                     help='Set Traffic Patterns (Default log binary)')
+    sub.add_argument('-o', '--mode', default=['immediate', 'idle', 'line'], choices=['immediate', 'idle', 'line'],
+                     nargs='+', help='Set Chunk Modes To Compare (Default immediate idle line)')
+    sub.add_argument('-c', '--count', default=300, type=int, help='Set Message Count (Default 300)')
+    sub.add_argument('-b', '--baud', default=115200, type=int, help='Set Paced Baudrate (Default 115200)')
+    sub.add_argument('-u', '--burst', default=16, type=int, help='Set Bytes Per Pty Write (Default 16)')
+    sub.add_argument('-i', '--idle', default=5.0, type=float, help='Set Max Idle Ms Between Messages (Default 5.0)')
+    sub.add_argument('-g', '--gap', default=1.5, type=float, help='Set Idle Gap In Character Times (Default 1.5)')
+    sub.add_argument('-m', '--age', default=10.0, type=float, help='Set Max Chunk Age Ms (Default 10.0)')
+    sub.set_defaults(func=bench_chunk)
+    sub = subparsers.add_parser('packet', help='allocated copies and cost per forwarded chunk of legacy and slotted Packet')
+    sub.add_argument('-s', '--size', default=[64, 1024, 16384], type=int, nargs='+',
+                     help='Set Chunk Size List (Default 64 1024 16384)')
+    sub.add_argument('-P', '--proto', default=[1, 2], type=int, nargs='+', help='Set Protocol Versions (Default 1 2)')
+    sub.add_argument('-c', '--count', default=20000, type=int, help='Set Loop Count For Cost (Default 20000)')
+    sub.set_defaults(func=bench_packet)
+    sub = subparsers.add_parser('e2e', help='throughput, latency, cpu and rss of real server and client over pty uarts')
+    sub.add_argument('-a', '--pattern', default=['bulk', 'log', 'keystroke'], choices=['bulk', 'log', 'keystroke'],
+                     nargs='+', help='Set Traffic Patterns (Default bulk log keystroke)')
+    sub.add_argument('-r', '--direction', default=['up', 'down'], choices=['up', 'down'], nargs='+',
+                     help='Set Directions, up is client uart to server uart (Default up down)')
+    sub.add_argument('-e', '--encode', default=['off', 'on'], choices=['off', 'on'], nargs='+',
+                     help='Set Data Encode Settings (Default off on)')
+    sub.add_argument('-s', '--size', default=0x100000, type=int, help='Set Bulk/Log Bytes (Default 1MB)')
+    sub.add_argument('-k', '--chunk', default=0x1000, type=int, help='Set Bulk Write Size (Default 4KB)')
+    sub.add_argument('-c', '--keys', default=300, type=int, help='Set Keystroke Count (Default 300)')
+    sub.add_argument('-n', '--interval', default=0.005, type=float, help='Set Keystroke Interval Seconds (Default 0.005)')
+    sub.add_argument('-t', '--timeout', default=60, type=float, help='Set Timeout Seconds Per Run (Default 60)')
+    sub.add_argument('-i', '--idle', default=3, type=float, help='Set Seconds Without Bytes To End A Lossy Run (Default 3)')
+    sub.add_argument('-sa', '--server_args', default='-q 4194304', type=str,
+                     help='Set Extra Server Arguments (Default -q 4194304)')
+    sub.add_argument('-ca', '--client_args', default='', type=str, help='Set Extra Client Arguments (Default None)')
+    sub.add_argument('-j', '--json', default='', type=str, help='Set Json Result File (Default None)')
+    sub.add_argument('-B', '--baseline', default='', type=str, help='Set Json Result To Compare With (Default None)')
+    sub.add_argument('-x', '--tolerance', default=0.1, type=float,
+                     help='Set Regression Tolerance Ratio For --baseline (Default 0.1)')
+    sub.set_defaults(func=bench_e2e)
+    sub = subparsers.add_parser('load', help='server throughput, fairness, latency and cpu with many synthetic clients')
+    sub.add_argument('-c', '--clients', default=[1, 2, 4, 8, 16, 32], type=int, nargs='+',
+                     help='Set Client Count List To Sweep (Default 1 2 4 8 16 32)')
+    sub.add_argument('-r', '--direction', default=['up', 'down'], choices=['up', 'down'], nargs='+',
+                     help='Set Directions, up is socket to server uart (Default up down)')
+    sub.add_argument('-b', '--rate', default=11520, type=int, help='Set Bytes/s Per Client (Default 11520, 115200 baud)')
+    sub.add_argument('-k', '--chunk', default=64, type=int, help='Set Write Size (Default 64)')
+    sub.add_argument('-s', '--seconds', default=5, type=float, help='Set Seconds Per Client Count (Default 5)')
+    sub.add_argument('-t', '--timeout', default=10, type=float, help='Set Handshake And Tail Timeout Seconds (Default 10)')
+    sub.add_argument('-i', '--idle', default=1, type=float, help='Set Seconds Without Bytes To End A Run (Default 1)')
+    sub.add_argument('-K', '--knee', default=0.95, type=float,
+                     help='Set Delivered/Offered Ratio Under Which The Server Is Saturated (Default 0.95)')
+    sub.add_argument('-L', '--latency', default=100, type=float,
+                     help='Set P99 Latency Ms Over Which The Server Is Saturated (Default 100)')
+    sub.add_argument('-sa', '--server_args', default='', type=str, help='Set Extra Server Arguments (Default None)')
+    sub.add_argument('-j', '--json', default='', type=str, help='Set Json Result File (Default None)')
+    sub.set_defaults(func=bench_load)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,341 @@
+import argparse
+import bisect
+import importlib.util
+import logging
+import mmap
+import os
+import sys
+import time
+import zlib
+
+app_version = '0.1'
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, rel_path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root_path, rel_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# capture format and Packet come from the client, it also sets up the logger
+wuart = load_module('wireless_uart_client', 'client/wireless_uart_client.py')
+logger = logging.getLogger()
+
+
+"""
+Capture Reader
+memory maps a capture file (see CaptureWriter) and its sparse index file, the
+index is rebuilt by one scan when it is missing, so seek_time() and
+seek_offset() are a binary search on the index plus a scan of at most
+INDEX_INTERVAL bytes, no matter how big the capture is.
+a record with bad crc32 is skipped by searching the next start symbol.
+records are (offset, kind, timestamp, session, raw bytes), in file order, the
+index assumes timestamps only go forward, which holds for one writer unless
+the wall clock is set back.
+"""
+class CaptureReader:
+    def __init__(self, path:str):
+        CaptureWriter = wuart.CaptureWriter
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size < len(CaptureWriter.MAGIC):
+            raise ValueError('%s is not a capture file' % path)
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:len(CaptureWriter.MAGIC)] != CaptureWriter.MAGIC:
+            self.close()
+            raise ValueError('%s is not a capture file' % path)
+        self.start = len(CaptureWriter.MAGIC)
+        self.index_times = []
+        self.index_offsets = []
+        if not self.load_index():
+            self.build_index()
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def load_index(self):
+        CaptureWriter = wuart.CaptureWriter
+        try:
+            with open(self.path + '.idx', 'rb') as index_file:
+                raw_bytes = index_file.read()
+        except OSError:
+            return False
+        if raw_bytes[:len(CaptureWriter.INDEX_MAGIC)] != CaptureWriter.INDEX_MAGIC:
+            logger.warning('[!] bad index file of %s, rebuild.' % self.path)
+            return False
+        entry_size = CaptureWriter.INDEX_ENTRY.size
+        end = len(raw_bytes) - (len(raw_bytes) - len(CaptureWriter.INDEX_MAGIC)) % entry_size
+        for timestamp, offset in CaptureWriter.INDEX_ENTRY.iter_unpack(raw_bytes[len(CaptureWriter.INDEX_MAGIC):end]):
+            # entries past the end are from a capture truncated after indexing
+            if offset >= self.size:
+                break
+            self.index_times.append(timestamp)
+            self.index_offsets.append(offset)
+        return True
+
+    def build_index(self, save:bool=False):
+        CaptureWriter = wuart.CaptureWriter
+        self.index_times = []
+        self.index_offsets = []
+        next_offset = self.start
+        for offset, kind, timestamp, session, raw_start, record_end in self.spans(self.start):
+            if offset >= next_offset:
+                self.index_times.append(timestamp)
+                self.index_offsets.append(offset)
+                next_offset = offset + CaptureWriter.INDEX_INTERVAL
+        if save:
+            with open(self.path + '.idx', 'wb') as index_file:
+                index_file.write(CaptureWriter.INDEX_MAGIC)
+                for timestamp, offset in zip(self.index_times, self.index_offsets):
+                    index_file.write(CaptureWriter.INDEX_ENTRY.pack(timestamp, offset))
+        return len(self.index_offsets)
+
+    def read_record(self, offset:int):
+        # return (kind, timestamp, session, raw start, record end) or None if not a valid record
+        Packet, CaptureWriter = wuart.Packet, wuart.CaptureWriter
+        buf = self.buf
+        try:
+            size, record_idx = Packet.varint_decode(buf, offset + 2, self.size)
+        except ValueError:
+            return None
+        if size is None or size < CaptureWriter.RECORD_HEADER.size:
+            return None
+        record_end = record_idx + size
+        if record_end + 4 > self.size:
+            return None
+        crc = zlib.crc32(memoryview(buf)[offset+1:record_end])
+        if crc != int.from_bytes(buf[record_end:record_end+4], 'big'):
+            return None
+        timestamp, session = CaptureWriter.RECORD_HEADER.unpack_from(buf, record_idx)
+        return buf[offset+1], timestamp, session, record_idx + CaptureWriter.RECORD_HEADER.size, record_end + 4
+
+    def spans(self, offset:int=0, end:int=-1):
+        # yield (offset, kind, timestamp, session, raw start, record end) of records starting in [offset, end)
+        Packet = wuart.Packet
+        offset = max(offset, self.start)
+        end = self.size if end < 0 else min(end, self.size)
+        while offset < end:
+            start_idx = self.buf.find(Packet.SYMBOL_V2_BYTES, offset, end)
+            if start_idx < 0:
+                return
+            record = self.read_record(start_idx)
+            if record is None:
+                if start_idx + 1 < self.size:
+                    logger.debug('bad record at %d, resync.' % start_idx)
+                offset = start_idx + 1
+                continue
+            yield (start_idx,) + record
+            offset = record[4]
+
+    def records(self, offset:int=0, end:int=-1):
+        for start_idx, kind, timestamp, session, raw_start, record_end in self.spans(offset, end):
+            yield start_idx, kind, timestamp, session, self.buf[raw_start:record_end-4]
+
+    def seek_offset(self, offset:int):
+        # return the offset of the first record starting at or after [offset]
+        i = bisect.bisect_right(self.index_offsets, offset) - 1
+        scan = self.start if i < 0 else self.index_offsets[i]
+        for record in self.spans(scan):
+            if record[0] >= offset:
+                return record[0]
+        return self.size
+
+    def seek_time(self, timestamp:float):
+        # return the offset of the first record at or after [timestamp]
+        i = bisect.bisect_left(self.index_times, timestamp) - 1
+        scan = self.start if i < 0 else self.index_offsets[i]
+        for record in self.spans(scan):
+            if record[2] >= timestamp:
+                return record[0]
+        return self.size
+
+    def time_range(self):
+        # return (first, last) timestamp, last is found from the last index entry
+        first = last = None
+        for record in self.spans(self.start):
+            first = record[2]
+            break
+        scan = self.index_offsets[-1] if len(self.index_offsets) > 0 else self.start
+        for record in self.spans(scan):
+            last = record[2]
+        return first, last
+
+
+def parse_time(value:str, first:float):
+    # unix time, +seconds from the capture start, or local 'YYYY-mm-dd HH:MM:SS[.ffffff]'
+    if value.startswith('+'):
+        return first + float(value[1:])
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    date, _, fraction = value.partition('.')
+    timestamp = time.mktime(time.strptime(date, '%Y-%m-%d %H:%M:%S'))
+    return timestamp + (float('0.' + fraction) if len(fraction) > 0 else 0)
+
+
+def select_range(reader:CaptureReader, args):
+    # return (start offset, end offset) of --start/--end times or --offset/--length bytes
+    first, last = reader.time_range()
+    if first is None:
+        return reader.start, reader.start
+    if args.offset >= 0:
+        start = reader.seek_offset(args.offset)
+    elif len(args.start) > 0:
+        start = reader.seek_time(parse_time(args.start, first))
+    else:
+        start = reader.start
+    if args.length >= 0:
+        end = reader.seek_offset(start + args.length)
+    elif len(args.end) > 0:
+        end = reader.seek_time(parse_time(args.end, first))
+    else:
+        end = reader.size
+    return start, max(start, end)
+
+
+def format_time(timestamp:float):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) + ('%.6f' % (timestamp % 1))[1:]
+
+
+def info_capture(args):
+    reader = CaptureReader(args.capture)
+    try:
+        start, end = select_range(reader, args)
+        stats = {}
+        first = last = None
+        for offset, kind, timestamp, session, raw_bytes in reader.records(start, end):
+            first = timestamp if first is None else first
+            last = timestamp
+            count, size = stats.get((session, kind), (0, 0))
+            stats[(session, kind)] = (count + 1, size + len(raw_bytes))
+        print('%s %d bytes, %d index entries' % (args.capture, reader.size, len(reader.index_offsets)))
+        if first is None:
+            print('no record')
+            return
+        print('%s ~ %s (%.3f sec) offset %d ~ %d' % (format_time(first), format_time(last), last - first, start, end))
+        print('%8s %-10s %10s %12s' % ('session', 'kind', 'records', 'bytes'))
+        for (session, kind), (count, size) in sorted(stats.items()):
+            print('%8d %-10s %10d %12d' % (session, wuart.CaptureWriter.KIND_NAMES.get(kind, str(kind)), count, size))
+    finally:
+        reader.close()
+
+
+def index_capture(args):
+    reader = CaptureReader(args.capture)
+    try:
+        count = reader.build_index(save=True)
+        logger.info('+++ %s.idx written, %d entries +++' % (args.capture, count))
+    finally:
+        reader.close()
+
+
+def record_filter(args):
+    names = {v: k for k, v in wuart.CaptureWriter.KIND_NAMES.items()}
+    kinds = set(names[kind] for kind in args.kind)
+
+    def match(kind, session):
+        return (len(kinds) == 0 or kind in kinds) and (args.session < 0 or session == args.session)
+    return match
+
+
+def slice_capture(args):
+    # copy whole records as they are, the new capture gets its own index
+    CaptureWriter = wuart.CaptureWriter
+    reader = CaptureReader(args.capture)
+    match = record_filter(args)
+    try:
+        start, end = select_range(reader, args)
+        records = 0
+        next_offset = 0
+        with open(args.output, 'wb') as out_file, open(args.output + '.idx', 'wb') as index_file:
+            out_file.write(CaptureWriter.MAGIC)
+            index_file.write(CaptureWriter.INDEX_MAGIC)
+            for offset, kind, timestamp, session, raw_start, record_end in reader.spans(start, end):
+                if not match(kind, session):
+                    continue
+                if out_file.tell() >= next_offset:
+                    index_file.write(CaptureWriter.INDEX_ENTRY.pack(timestamp, out_file.tell()))
+                    next_offset = out_file.tell() + CaptureWriter.INDEX_INTERVAL
+                out_file.write(reader.buf[offset:record_end])
+                records += 1
+        logger.info('+++ %d records, offset %d ~ %d sliced to %s +++' % (records, start, end, args.output))
+    finally:
+        reader.close()
+
+
+def export_capture(args):
+    # raw writes the bytes only, like what the uart or socket saw, hex writes one line per record
+    reader = CaptureReader(args.capture)
+    match = record_filter(args)
+    out_file = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        start, end = select_range(reader, args)
+        for offset, kind, timestamp, session, raw_bytes in reader.records(start, end):
+            if not match(kind, session):
+                continue
+            if args.format == 'raw':
+                out_file.write(raw_bytes)
+            else:
+                out_file.write(('%s %5d %-9s %s\n' % (format_time(timestamp), session,
+                                wuart.CaptureWriter.KIND_NAMES.get(kind, str(kind)), raw_bytes.hex())).encode())
+    finally:
+        if out_file is not sys.stdout.buffer:
+            out_file.close()
+        reader.close()
+
+
+def add_range_arguments(sub):
+    sub.add_argument('capture', type=str, help='Capture File Written By --capture Of Server Or Client')
+    sub.add_argument('-S', '--start', default='', type=str,
+                     help='Set Start Time, unix time, +sec from capture start or "YYYY-mm-dd HH:MM:SS" (Default Start)')
+    sub.add_argument('-E', '--end', default='', type=str, help='Set End Time, same formats as --start (Default End)')
+    sub.add_argument('-o', '--offset', default=-1, type=int, help='Set Start Byte Offset Instead Of --start (Default None)')
+    sub.add_argument('-z', '--length', default=-1, type=int, help='Set Byte Length Instead Of --end (Default None)')
+
+
+def add_filter_arguments(sub):
+    sub.add_argument('-k', '--kind', default=[], choices=['socket_rx', 'socket_tx', 'uart_rx', 'uart_tx'],
+                     nargs='+', help='Set Record Kinds (Default All)')
+    sub.add_argument('-n', '--session', default=-1, type=int,
+                     help='Set Session, client id on server captures (Default All)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wireless UART Capture Tool ver.%s" % app_version)
+    parser.add_argument(
+        "-d",
+        "--debug",
+        default=False,
+        action='store_true',
+        help='Set Debug Logger Enable (Default Disable)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sub = subparsers.add_parser('info', help='time range, sessions and kinds of a capture or a range of it')
+    add_range_arguments(sub)
+    sub.set_defaults(func=info_capture)
+    sub = subparsers.add_parser('index', help='rebuild the index file of a capture')
+    sub.add_argument('capture', type=str, help='Capture File Written By --capture Of Server Or Client')
+    sub.set_defaults(func=index_capture)
+    sub = subparsers.add_parser('slice', help='copy a time or byte range of a capture to a new capture')
+    add_range_arguments(sub)
+    add_filter_arguments(sub)
+    sub.add_argument('-w', '--output', required=True, type=str, help='Set Output Capture File')
+    sub.set_defaults(func=slice_capture)
+    sub = subparsers.add_parser('export', help='write raw bytes or a hex dump of a time or byte range')
+    add_range_arguments(sub)
+    add_filter_arguments(sub)
+    sub.add_argument('-f', '--format', default='raw', choices=['raw', 'hex'], help='Set Output Format (Default raw)')
+    sub.add_argument('-w', '--output', default='-', type=str, help='Set Output File, - For Stdout (Default -)')
+    sub.set_defaults(func=export_capture)
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logger.warning('[!] Debug Mode Enable')
+    try:
+        args.func(args)
+    except Exception as ex1:
+        logger.error("[!] capture err: %s" % str(ex1))
@@ -0,0 +1,156 @@
+import argparse
+import importlib.util
+import logging
+import os
+import socket
+import threading
+import time
+
+app_version = '0.1'
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_module(name, rel_path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root_path, rel_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# capture reader from the capture tool, Packet and the logger setup from the client
+capture = load_module('wireless_uart_capture', 'tools/wireless_uart_capture.py')
+wuart = capture.wuart
+logger = logging.getLogger()
+
+
+"""
+Replay
+write the raw bytes of the selected records to a uart (a real one or a virtual
+one like a pty) or to a server socket, with the original gaps between records
+divided by [speed], speed 0 writes as fast as possible.
+replaying 'socket_tx' of a client capture to a server repeats the whole session,
+negotiation included, replies are read and dropped.
+"""
+def replay(args):
+    names = {v: k for k, v in wuart.CaptureWriter.KIND_NAMES.items()}
+    kind = names[args.kind]
+    if len(args.server) > 0:
+        host, port = args.server.rsplit(':', 1)
+        target = socket.create_connection((host, int(port)))
+        target.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        write = target.sendall
+
+        def drain():
+            try:
+                while len(target.recv(0x10000)) > 0:
+                    pass
+            except OSError:
+                pass
+        threading.Thread(target=drain, daemon=True).start()
+        logger.info('+++ replay %s to server(%s) +++' % (args.kind, args.server))
+    else:
+        target = wuart.serial.Serial(args.uart, args.baud)
+        write = target.write
+        logger.info('+++ replay %s to uart(%s, %d) +++' % (args.kind, args.uart, args.baud))
+    reader = capture.CaptureReader(args.capture)
+    first = None
+    start = time.perf_counter()
+    records = 0
+    total = 0
+    try:
+        for offset, record_kind, timestamp, session, raw_bytes in reader.records():
+            if record_kind != kind or (args.session >= 0 and session != args.session):
+                continue
+            if first is None:
+                first = timestamp
+            if args.speed > 0:
+                delay = start + (timestamp - first) / args.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            write(raw_bytes)
+            records += 1
+            total += len(raw_bytes)
+    finally:
+        if len(args.server) > 0:
+            time.sleep(args.linger)
+        target.close()
+        reader.close()
+    logger.info('--- replay %d records, %d bytes in %.3f sec ---' % (records, total, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wireless UART Replay ver.%s" % app_version)
+    parser.add_argument(
+        "capture",
+        type=str,
+        help='Capture File Written By --capture Of Server Or Client')
+    parser.add_argument(
+        "-l",
+        "--list",
+        default=False,
+        action='store_true',
+        help='List Sessions And Kinds Of The Capture Only')
+    parser.add_argument(
+        "-u",
+        "--uart",
+        default='',
+        type=str,
+        help='Set UART Path To Replay To (Default None)')
+    parser.add_argument(
+        "-ub",
+        "--baud",
+        default=115200,
+        type=int,
+        help='Set UART Baudrate (Default 115200)')
+    parser.add_argument(
+        "-s",
+        "--server",
+        default='',
+        type=str,
+        help='Set Server host:port To Replay To (Default None)')
+    parser.add_argument(
+        "-k",
+        "--kind",
+        default='',
+        choices=['socket_rx', 'socket_tx', 'uart_rx', 'uart_tx'],
+        help='Set Record Kind To Replay (Default uart_rx to uart, socket_tx to server)')
+    parser.add_argument(
+        "-n",
+        "--session",
+        default=-1,
+        type=int,
+        help='Set Session To Replay, client id on server captures (Default All)')
+    parser.add_argument(
+        "-x",
+        "--speed",
+        default=1.0,
+        type=float,
+        help='Set Replay Speed Factor, 0 As Fast As Possible (Default 1.0)')
+    parser.add_argument(
+        "-L",
+        "--linger",
+        default=1.0,
+        type=float,
+        help='Set Seconds To Keep Server Connection After Replay (Default 1.0)')
+    parser.add_argument(
+        "-d",
+        "--debug",
+        default=False,
+        action='store_true',
+        help='Set Debug Logger Enable (Default Disable)')
+    args = parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+        logger.warning('[!] Debug Mode Enable')
+    try:
+        if args.list:
+            args.offset, args.length, args.start, args.end = -1, -1, '', ''
+            capture.info_capture(args)
+        elif len(args.uart) == 0 and len(args.server) == 0:
+            logger.error('[!] set --uart or --server to replay to.')
+        else:
+            if len(args.kind) == 0:
+                args.kind = 'socket_tx' if len(args.server) > 0 else 'uart_rx'
+            replay(args)
+    except Exception as ex1:
+        logger.error("[!] replay err: %s" % str(ex1))